@@ -0,0 +1,238 @@
+import os
+import sys
+import zlib
+
+from array import array
+from datetime import date, datetime, timedelta
+from json import dumps as json_dumps, loads as json_loads
+from math import isnan
+from mmap import mmap, ACCESS_READ
+from struct import pack, unpack_from, calcsize
+
+"""
+Columnar archive of closed days of datalogger stats, one file per day.
+Every column is stored as its own zlib compressed block of a typed array
+(timestamps delta encoded) behind a small directory, so a long range
+read only inflates the columns it asks for out of a memory mapped file:
+
+    header     magic, rows, columns
+    directory  per column: encoding, name, block offset, block length
+    blocks     zlib(array bytes, little endian) or zlib(json) for text
+"""
+
+MAGIC = b'GDA1'
+SUFFIX = '.gda'
+HEADER = '<4sIH'
+ENTRY = '<BH'
+BLOCK = '<QI'
+
+DELTA, INTEGER, REAL, TEXT = 0, 1, 2, 3
+TYPECODES = {DELTA: 'q', INTEGER: 'q', REAL: 'd'}
+
+# Stand in for NULL in integer columns, REAL ones use NaN
+NULL_INT = -2 ** 63
+
+DELTA_COLS = ('datetime',)
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def column_encoding(name, kind):
+    if name in DELTA_COLS:
+        return DELTA
+    if kind.startswith('INTEGER'):
+        return INTEGER
+    if kind.startswith('REAL'):
+        return REAL
+    return TEXT
+
+
+def to_le(values):
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def encode_column(encoding, values):
+    if encoding == TEXT:
+        return zlib.compress(json_dumps(values).encode())
+
+    if encoding == DELTA:
+        values = [
+            value - previous
+            for previous, value in zip([0] + values[:-1], values)
+        ]
+    elif encoding == INTEGER:
+        values = [NULL_INT if value is None else value for value in values]
+    else:
+        values = [float('nan') if value is None else value
+                  for value in values]
+    return zlib.compress(to_le(array(TYPECODES[encoding], values)).tobytes())
+
+
+def decode_column(encoding, block):
+    raw = zlib.decompress(block)
+    if encoding == TEXT:
+        return json_loads(raw.decode())
+
+    values = array(TYPECODES[encoding])
+    values.frombytes(raw)
+    values = to_le(values).tolist()
+    if encoding == DELTA:
+        total = 0
+        for index, delta in enumerate(values):
+            total += delta
+            values[index] = total
+    elif encoding == INTEGER:
+        if NULL_INT in values:
+            values = [None if v == NULL_INT else v for v in values]
+    else:
+        values = [None if isnan(value) else value for value in values]
+    return values
+
+
+def write_day(path, cols, rows):
+    '''
+    Writes `rows`, tuples ordered as `cols` ([(name, sql type), ...]),
+    to an archive file. The file is replaced atomically.
+    '''
+    encodings = [column_encoding(name, kind) for name, kind in cols]
+    blocks = [
+        encode_column(encoding, [row[index] for row in rows])
+        for index, encoding in enumerate(encodings)
+    ]
+    names = [name.encode() for name, _ in cols]
+
+    offset = calcsize(HEADER) + sum(
+        calcsize(ENTRY) + len(name) + calcsize(BLOCK) for name in names
+    )
+    directory = b''
+    for encoding, name, block in zip(encodings, names, blocks):
+        directory += pack(ENTRY, encoding, len(name)) + name
+        directory += pack(BLOCK, offset, len(block))
+        offset += len(block)
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fw:
+        fw.write(pack(HEADER, MAGIC, len(rows), len(cols)))
+        fw.write(directory)
+        for block in blocks:
+            fw.write(block)
+        fw.flush()
+        os.fsync(fw.fileno())
+    os.replace(tmp_path, path)
+
+
+class DayArchive(object):
+
+    def __init__(self, path):
+        with open(path, 'rb') as fr:
+            self.mm = mmap(fr.fileno(), 0, access=ACCESS_READ)
+
+        magic, self.count, ncols = unpack_from(HEADER, self.mm)
+        if magic != MAGIC:
+            self.close()
+            raise ArchiveError('{} is not a stats archive'.format(path))
+
+        self.directory = {}
+        pos = calcsize(HEADER)
+        for _ in range(ncols):
+            encoding, name_len = unpack_from(ENTRY, self.mm, pos)
+            pos += calcsize(ENTRY)
+            name = self.mm[pos:pos + name_len].decode()
+            pos += name_len
+            offset, length = unpack_from(BLOCK, self.mm, pos)
+            pos += calcsize(BLOCK)
+            self.directory[name] = (encoding, offset, length)
+
+    @property
+    def cols(self):
+        return list(self.directory)
+
+    def column(self, name):
+        encoding, offset, length = self.directory[name]
+        return decode_column(encoding, self.mm[offset:offset + length])
+
+    def rows(self, names=None):
+        return list(zip(*(self.column(name) for name in names or self.cols)))
+
+    def close(self):
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def day_start(day):
+    return int(datetime(day.year, day.month, day.day).timestamp())
+
+
+def day_path(archive_dir, day):
+    return os.path.join(archive_dir, day.strftime('%Y%m%d') + SUFFIX)
+
+
+def path_day(path):
+    name = os.path.basename(path)[:-len(SUFFIX)]
+    return datetime.strptime(name, '%Y%m%d').date()
+
+
+def archived_days(archive_dir, from_dt, to_dt):
+    ''' Archive files of the local days overlapping the range, in order '''
+    day = date.fromtimestamp(from_dt)
+    last = date.fromtimestamp(to_dt)
+    paths = []
+    while day <= last:
+        path = day_path(archive_dir, day)
+        if os.path.exists(path):
+            paths.append(path)
+        day += timedelta(days=1)
+    return paths
+
+
+class ArchivedTimes(object):
+    '''
+    Timestamps held by the archive files in `paths`, loaded a day at a
+    time as asked. Tells apart the rows of a day both archived and still
+    in sqlite, only timestamps before `end` can be archived.
+    '''
+
+    def __init__(self, archive_dir, paths, time_col='datetime'):
+        self.archive_dir = archive_dir
+        self.paths = set(paths)
+        self.time_col = time_col
+        self.end = day_start(
+            max(path_day(path) for path in paths) + timedelta(days=1)
+        ) if paths else None
+        self.times = {}
+
+    def __contains__(self, timestamp):
+        if self.end is None or timestamp >= self.end:
+            return False
+        path = day_path(self.archive_dir, date.fromtimestamp(timestamp))
+        if path not in self.paths:
+            return False
+        if path not in self.times:
+            with DayArchive(path) as archive:
+                self.times[path] = set(archive.column(self.time_col))
+        return timestamp in self.times[path]
+
+
+def read_range(paths, from_dt, to_dt, names, time_col='datetime'):
+    ''' Rows of `names` with `time_col` within the range, oldest first '''
+    for path in paths:
+        with DayArchive(path) as archive:
+            times = archive.column(time_col)
+            if not times or times[0] > to_dt or times[-1] < from_dt:
+                continue
+            columns = [
+                times if name == time_col else archive.column(name)
+                for name in names
+            ]
+            for index, row in enumerate(zip(*columns)):
+                if from_dt <= times[index] <= to_dt:
+                    yield row
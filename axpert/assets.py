@@ -0,0 +1,111 @@
+import os
+
+from collections import namedtuple
+from gzip import compress as gzip_compress
+from hashlib import sha1
+from mimetypes import guess_type
+from os.path import abspath, dirname, isfile, join, realpath
+from threading import Lock
+
+"""
+Static files of the http server kept in memory, along with a gzip copy
+of the compressible ones and a content hash to version their urls by.
+Files are read again once their mtime or size changes, pages get the
+links to other assets rewritten with the hash of their current content:
+
+    <script src="/jquery">  ->  <script src="/jquery?v=3f2a9c1e0b7d4a65">
+"""
+
+STATIC_DIR = join(dirname(abspath(__file__)), 'static')
+COMPRESSIBLE = (
+    'text/', 'application/javascript', 'application/json', 'image/svg+xml'
+)
+DIGEST_SIZE = 16
+
+Asset = namedtuple('Asset', 'body gzipped digest ctype mtime stamp')
+
+
+def content_type(fname):
+    ctype = guess_type(fname)[0] or 'application/octet-stream'
+    if ctype.startswith('text/') or ctype == 'application/javascript':
+        ctype += '; charset=utf-8'
+    return ctype
+
+
+def accepts_gzip(accept_encoding):
+    for item in (accept_encoding or '').split(','):
+        coding, _, params = item.partition(';')
+        if coding.strip().lower() not in ('gzip', '*'):
+            continue
+        name, _, value = params.partition('=')
+        try:
+            return name.strip() != 'q' or float(value) > 0
+        except ValueError:
+            return False
+    return False
+
+
+def make_asset(body, fname, mtime, stamp):
+    ctype = content_type(fname)
+    gzipped = None
+    if ctype.startswith(COMPRESSIBLE):
+        # No timestamp in the header, the same body gives the same bytes
+        gzipped = gzip_compress(body, 9, mtime=0)
+        if len(gzipped) >= len(body):
+            gzipped = None
+    return Asset(
+        body, gzipped, sha1(body).hexdigest()[:DIGEST_SIZE], ctype, mtime,
+        stamp
+    )
+
+
+class StaticAssets(object):
+    '''
+    Files under `root`. `links` maps the routes pages refer to other
+    assets by onto their file names, html pages get them versioned.
+    '''
+
+    def __init__(self, root=STATIC_DIR, links=None):
+        self.root = realpath(root)
+        self.links = links or {}
+        self.lock = Lock()
+        self.assets = {}
+
+    def path(self, fname):
+        path = realpath(join(self.root, fname))
+        if not path.startswith(self.root + os.sep) or not isfile(path):
+            raise KeyError(fname)
+        return path
+
+    def get(self, fname):
+        ''' Asset of `fname`, KeyError if there is no such file '''
+        path = self.path(fname)
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        page = fname.endswith('.html')
+        if page:
+            # Pages change along with the assets they link to
+            stamp += tuple(
+                self.get(linked).digest for linked in self.links.values()
+            )
+
+        asset = self.assets.get(fname)
+        if asset and asset.stamp == stamp:
+            return asset
+
+        with open(path, 'rb') as fr:
+            body = fr.read()
+        if page:
+            body = self.versioned(body)
+        asset = make_asset(body, fname, st.st_mtime, stamp)
+        with self.lock:
+            self.assets[fname] = asset
+        return asset
+
+    def versioned(self, body):
+        for route, linked in self.links.items():
+            body = body.replace(
+                '"{}"'.format(route).encode(),
+                '"{}?v={}"'.format(route, self.get(linked).digest).encode()
+            )
+        return body
@@ -0,0 +1,127 @@
+import logging
+
+from argparse import ArgumentParser
+from math import sin, pi
+from random import Random
+from sqlite3 import connect
+from time import monotonic
+
+from axpert.datalogger import (
+    ensure_db_structure, series_rows, rollup, rollup_statement, ROLLUPS,
+    STATS_COLS, INTERVAL
+)
+
+"""
+Benchmark of the /graph data path over a synthetic stats table, every
+INTERVAL seconds for as many rows as asked (two million is close to a
+year at 15s):
+
+    $> python3 -m axpert.bench.downsample_bench --rows 2000000
+
+Compares the old fixed bucket averaging query with the downsampled
+series, for a few ranges ending at the newest row, reporting time,
+points returned and how much of the real battery volts peak survives.
+"""
+
+START = 1500000000
+RANGES = (('day', 86400), ('week', 7 * 86400), ('month', 30 * 86400),
+          ('year', 365 * 86400))
+MAX_GROUPED_ITEMS = 2048
+
+
+def synthetic_rows(count, seed=0):
+    ''' Daily charge cycle with noise and a short spike every few days '''
+    rng = Random(seed)
+    volt_index = STATS_COLS.index('batt_volt')
+    watts_index = STATS_COLS.index('pv_watts')
+    template = [0] * len(STATS_COLS)
+    for index in range(count):
+        second = START + index * INTERVAL
+        hour = (second % 86400) / 3600
+        sun = max(0.0, sin(pi * (hour - 7) / 12))
+        row = list(template)
+        row[0] = second
+        row[volt_index] = 50 + 6 * sun + rng.gauss(0, 0.1) + (
+            2.0 if index % 20011 == 0 else 0
+        )
+        row[watts_index] = int(3800 * sun * rng.uniform(0.6, 1.0))
+        yield row
+
+
+def populate(db_conn, count, batch=50000):
+    ensure_db_structure(logging.getLogger('bench'), db_conn)
+    insert = 'INSERT INTO stats VALUES ({})'.format(
+        ', '.join('?' for _ in STATS_COLS)
+    )
+    rows = synthetic_rows(count)
+    while True:
+        chunk = [row for _, row in zip(range(batch), rows)]
+        if not chunk:
+            break
+        db_conn.executemany(insert, chunk)
+        for tab_name, resolution in ROLLUPS:
+            db_conn.executemany(
+                rollup_statement(tab_name), rollup(chunk, resolution)
+            )
+        db_conn.commit()
+
+
+def bucket_average(db_conn, from_dt, to_dt):
+    ''' What /graph used to run over raw stats '''
+    span = to_dt - from_dt
+    coef = INTERVAL * max(1, -(-span // INTERVAL // MAX_GROUPED_ITEMS))
+    return db_conn.execute(
+        'SELECT datetime / ? * ?, AVG(batt_volt) FROM stats '
+        'WHERE datetime >= ? AND datetime <= ? GROUP BY datetime / ?',
+        [coef, coef, from_dt, to_dt, coef]
+    ).fetchall()
+
+
+def timed(fnx, *args, **kwargs):
+    start = monotonic()
+    result = fnx(*args, **kwargs)
+    return monotonic() - start, result
+
+
+def parse_args():
+    parser = ArgumentParser(prog='downsample_bench.py')
+    parser.add_argument('--rows', dest='rows', type=int, default=2000000)
+    parser.add_argument('--points', dest='points', type=int, default=1000)
+    parser.add_argument(
+        '--db', dest='db', default=':memory:',
+        help='Database file to build the synthetic table in'
+    )
+    return vars(parser.parse_args())
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    db_conn = connect(args['db'])
+    elapsed, _ = timed(populate, db_conn, args['rows'])
+    print('Populated {} rows in {:.1f}s'.format(args['rows'], elapsed))
+
+    newest = START + (args['rows'] - 1) * INTERVAL
+    print('{:<6} {:<16} {:>9} {:>7} {:>10}'.format(
+        'range', 'method', 'seconds', 'points', 'peak kept'
+    ))
+    for label, span in RANGES:
+        from_dt = max(START, newest - span)
+        peak = db_conn.execute(
+            'SELECT MAX(batt_volt) - MIN(batt_volt) FROM stats '
+            'WHERE datetime >= ? AND datetime <= ?', [from_dt, newest]
+        ).fetchone()[0]
+
+        runs = [('bucket average',
+                 timed(bucket_average, db_conn, from_dt, newest))]
+        for method in ('lttb', 'minmax'):
+            runs.append((method, timed(
+                series_rows, db_conn, from_dt, newest, ['batt_volt'],
+                args['points'], method
+            )))
+
+        for method, (elapsed, rows) in runs:
+            values = [row[1] for row in rows]
+            kept = (max(values) - min(values)) / peak if peak else 1
+            print('{:<6} {:<16} {:>9.3f} {:>7} {:>9.0%}'.format(
+                label, method, elapsed, len(rows), kept
+            ))
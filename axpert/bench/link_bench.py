@@ -0,0 +1,57 @@
+import logging
+
+from argparse import ArgumentParser
+from collections import Counter
+from threading import Thread
+from time import monotonic
+
+from axpert.connector_serial import SerialConnector
+from axpert.protocol import CMD_REL, execute
+from axpert.simulator import InverterSimulator, open_pty
+
+"""
+End to end benchmark of the serial link against the simulated inverter,
+at the real baud rate unless told otherwise:
+
+    $> python3 -m axpert.bench.link_bench --rounds 20 --drop-rate 0.001
+"""
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def parse_args():
+    parser = ArgumentParser(prog='link_bench.py')
+    parser.add_argument('--rounds', dest='rounds', type=int, default=20)
+    parser.add_argument('--baud', dest='baud', type=int, default=2400)
+    parser.add_argument('--latency', dest='latency', type=float, default=0.05)
+    parser.add_argument(
+        '--drop-rate', dest='drop_rate', type=float, default=0.0
+    )
+    parser.add_argument('--nak-rate', dest='nak_rate', type=float, default=0.0)
+    return vars(parser.parse_args())
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    rounds = args.pop('rounds')
+    log = logging.getLogger('godenerg')
+
+    master, slave, slave_path = open_pty()
+    simulator = InverterSimulator(master, seed=1, **args)
+    Thread(target=simulator.serve_forever, daemon=True).start()
+
+    with SerialConnector(devices=[slave_path], log=log) as connector:
+        for name in ('status', 'operation_mode'):
+            cmd, timings, statuses = CMD_REL[name], [], Counter()
+            for _ in range(rounds):
+                start = monotonic()
+                statuses[execute(log, connector, cmd).status.name] += 1
+                timings.append(monotonic() - start)
+
+            print('{:<16} p50 {:6.3f}s  p95 {:6.3f}s  max {:6.3f}s  {}'.format(
+                cmd.code, percentile(timings, 50), percentile(timings, 95),
+                max(timings), dict(statuses)
+            ))
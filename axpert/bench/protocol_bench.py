@@ -0,0 +1,94 @@
+from timeit import repeat
+from json import dumps as json_dumps
+
+from axpert.protocol import status_json_formatter, parse_status
+
+"""
+Micro-benchmark of the QPIGS parsing, run it with:
+
+    $> python3 -m axpert.bench.protocol_bench
+"""
+
+RAW_STATUS = \
+    '(000.0 00.0 230.0 50.0 0184 0071 003 404 50.10 000 ' \
+    '079 0049 0000 000.0 00.00 00001 01010000 00 00 00000 010\x1d\xb9\r'
+
+NUMBER = 20000
+REPEAT = 5
+
+
+def legacy_typer(frmt):
+
+    def _clean_val(val):
+        if not val or val=='NA':
+            return 0
+        else:
+            return val
+
+    types = {'s': str, 'f': float, 'd': int}
+
+    for frm, type_fnx in types.items():
+        if frm in frmt:
+            return lambda txt: type_fnx(frmt % type_fnx(_clean_val(txt)))
+
+    return lambda txt: txt % frmt
+
+
+def legacy_status_json_formatter(raw, serialize=True):
+    ''' The formatter before the compiled parser, kept for comparison '''
+    from axpert.protocol import parse_device_status
+
+    to_float = legacy_typer('%.2f')
+    to_int = legacy_typer('%d')
+    to_str = legacy_typer('%s')
+
+    structure = (
+        ('grid_volt', to_float), ('grid_freq', to_float),
+        ('ac_volt', to_float), ('ac_freq', to_float),
+        ('ac_va', to_int), ('ac_watt', to_int),
+        ('load_percent', to_int), ('bus_volt', to_int),
+        ('batt_volt', to_float), ('batt_charge_amps', to_int),
+        ('batt_capacity', to_int), ('temp', to_int),
+        ('pv_amps', to_int), ('pv_volts', to_float),
+        ('batt_volt_scc', to_float), ('batt_discharge_amps', to_int),
+        ('raw_status', to_str),
+        ('mask_b', to_str), ('mask_c', to_str),
+        ('pv_watts', to_int), ('mask_d', to_str)
+    )
+
+    if not raw:
+        return None
+
+    # Frames are now read up to the terminator, no padding to skip
+    raw_tokens = raw[1:-3].split(' ')
+    data = {
+        label: formatter(token)
+        for (label, formatter), token in zip(structure, raw_tokens)
+    }
+
+    struct = {
+        **data, **parse_device_status(data.get('raw_status', '00000000'))
+    }
+    return json_dumps(struct) if serialize else struct
+
+
+def bench(label, fnx):
+    best = min(repeat(fnx, number=NUMBER, repeat=REPEAT))
+    print('{:<32} {:>8.2f} us/call'.format(label, best / NUMBER * 1e6))
+    return best
+
+
+if __name__ == '__main__':
+    assert legacy_status_json_formatter(RAW_STATUS, serialize=False) \
+        == status_json_formatter(RAW_STATUS, serialize=False)
+
+    legacy = bench(
+        'legacy formatter (dict)',
+        lambda: legacy_status_json_formatter(RAW_STATUS, serialize=False)
+    )
+    compiled = bench(
+        'compiled formatter (dict)',
+        lambda: status_json_formatter(RAW_STATUS, serialize=False)
+    )
+    bench('compiled parser (record)', lambda: parse_status(RAW_STATUS))
+    print('speedup (dict): {:.2f}x'.format(legacy / compiled))
@@ -0,0 +1,335 @@
+from asyncio import Lock as AsyncLock, get_running_loop, wait_for
+from os import getpid, unlink
+from os.path import exists
+from multiprocessing.connection import Listener, Client
+from threading import Thread, Lock, Event, Condition, local
+from time import time, sleep
+
+from axpert.settings import broker_conf
+from axpert.protocol import (
+    execute, async_execute, is_query, Response, Status, CMD_REL
+)
+from axpert.codec import compile_frames
+from axpert.scheduler import CommandScheduler, WRITE, HTTP, EXCHANGE_TIMEOUT
+from axpert.telemetry import telemetry
+
+"""
+The broker is the only process talking to the inverter. It owns the
+connector and serves every other process (http server, datalogger,
+charger) through a local unix socket, sharing a single response cache
+so concurrent readers of the same command cost one serial round trip.
+"""
+
+FAMILY = 'AF_UNIX'
+EXECUTE, STATS, TELEMETRY = 'execute', 'stats', 'telemetry'
+PUBLISH, FETCH, WAIT = 'publish', 'fetch', 'wait'
+# Published by the datalogger: database writer counters and every new
+# status and operation mode sample
+DB_STATS = 'datalogger_db'
+LIVE_SAMPLE = 'live_sample'
+COMMS_LOCK_TIMEOUT = 5
+BAD_FRAME_RETRIES = 2
+
+
+def cmd_key(cmd):
+    return str(cmd.code + (cmd.val or ''))
+
+
+class ResponseCache(object):
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry and entry['last'] > (time() - self.ttl):
+            return entry['res']
+
+    def set(self, key, response):
+        self.entries[key] = {'res': response, 'last': time()}
+        return response
+
+
+class Flight(object):
+    '''
+    An exchange with the inverter in progress, callers asking for the
+    same command while it runs wait on it and share its response.
+    '''
+
+    def __init__(self):
+        self.done = Event()
+        self.response = None
+        self.waiters = 0
+
+
+class Broker(object):
+
+    def __init__(self, log, connector, address, ttl=broker_conf['cache_ttl']):
+        self.log = log
+        self.connector = connector
+        self.address = address
+        self.cache = ResponseCache(ttl)
+        self.scheduler = CommandScheduler(log, self.exchange)
+        self.flights_lock = Lock()
+        self.flights = {}
+        self.coalesced = 0
+        # Values published by one process for the others to read, with
+        # the number of times each one was published
+        self.board = {}
+        self.board_seqs = {}
+        self.board_changed = Condition()
+        self.ops = {
+            EXECUTE: self.execute, STATS: self.stats,
+            TELEMETRY: telemetry.snapshot,
+            PUBLISH: self.publish, FETCH: self.fetch, WAIT: self.wait
+        }
+
+    def exchange(self, cmd):
+        ''' Runs in the scheduler worker, the only thread on the link '''
+        key = cmd_key(cmd)
+        if is_query(cmd):
+            # Another caller may have refreshed the entry while queued
+            response = self.cache.get(key)
+            if response:
+                return response
+
+        # Corrupted frames are retried right away and never cached
+        for retry in range(BAD_FRAME_RETRIES + 1):
+            response = execute(self.log, self.connector, cmd)
+            if response.status != Status.BF:
+                break
+
+        if response.status != Status.BF and is_query(cmd):
+            self.cache.set(key, response)
+        return response
+
+    def execute(self, cmd, priority=HTTP, timeout=None):
+        key = cmd_key(cmd)
+        if not is_query(cmd):
+            # Settings are never served from cache and always go first
+            priority = WRITE
+        else:
+            response = self.cache.get(key)
+            if response:
+                telemetry.incr('cache_hits', cmd.code)
+                return response
+
+        with self.flights_lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+            else:
+                flight.waiters += 1
+                self.coalesced += 1
+
+        if not leader:
+            telemetry.incr('coalesced', cmd.code)
+            flight.done.wait(timeout=(timeout or 0) + EXCHANGE_TIMEOUT * 2)
+            return flight.response or Response(status=Status.KO, data=None)
+
+        try:
+            flight.response = self.scheduler.submit(cmd, priority, timeout)
+        except Exception as e:
+            self.log.exception(e)
+            flight.response = Response(status=Status.KO, data=None)
+        finally:
+            with self.flights_lock:
+                del self.flights[key]
+            flight.done.set()
+
+        if flight.waiters:
+            self.log.debug(
+                'Coalesced {} callers into {}'.format(flight.waiters, key)
+            )
+        return flight.response
+
+    def publish(self, name, value):
+        with self.board_changed:
+            self.board[name] = value
+            self.board_seqs[name] = self.board_seqs.get(name, 0) + 1
+            self.board_changed.notify_all()
+
+    def fetch(self, name):
+        return self.board.get(name)
+
+    def wait(self, name, seq=0, timeout=None):
+        '''
+        (seq, value) of `name` once published since `seq`, or the same
+        `seq` and None when it was not within `timeout` seconds. A broker
+        restart starts counting again, so any other seq is news.
+        '''
+        with self.board_changed:
+            if self.board_changed.wait_for(
+                lambda: self.board_seqs.get(name, 0) != seq, timeout
+            ):
+                return self.board_seqs.get(name, 0), self.board.get(name)
+        return seq, None
+
+    def stats(self):
+        return {
+            'coalesced': self.coalesced,
+            'in_flight': len(self.flights),
+            'scheduler': self.scheduler.stats()
+        }
+
+    def dispatch(self, msg):
+        op, args = msg[0], msg[1:]
+        return self.ops[op](*args)
+
+    def handle(self, conn):
+        try:
+            while True:
+                msg = conn.recv()
+                try:
+                    conn.send(self.dispatch(msg))
+                except Exception as e:
+                    self.log.exception(e)
+                    conn.send(None)
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def serve_forever(self):
+        # Request frames for the known commands are built once up front
+        compile_frames(CMD_REL)
+
+        if exists(self.address):
+            unlink(self.address)
+
+        with Listener(self.address, family=FAMILY) as listener:
+            self.log.info('Broker listening on {}'.format(self.address))
+            while True:
+                conn = listener.accept()
+                Thread(target=self.handle, args=[conn], daemon=True).start()
+
+
+class AsyncExecutor(object):
+    '''
+    asyncio counterpart of the broker executor for code sharing a single
+    event loop and AsyncConnector: one exchange at a time, a response
+    cache and coalescing of identical in-flight commands.
+    '''
+
+    def __init__(self, log, connector, ttl=broker_conf['cache_ttl']):
+        self.log = log
+        self.connector = connector
+        self.cache = ResponseCache(ttl)
+        self.comms_lock = AsyncLock()
+        self.flights = {}
+        self.coalesced = 0
+
+    async def exchange(self, key, cmd):
+        await wait_for(self.comms_lock.acquire(), COMMS_LOCK_TIMEOUT)
+        try:
+            response = self.cache.get(key)
+            if response:
+                return response
+
+            for retry in range(BAD_FRAME_RETRIES + 1):
+                response = await async_execute(self.log, self.connector, cmd)
+                if response.status != Status.BF:
+                    return self.cache.set(key, response)
+            return response
+        finally:
+            self.comms_lock.release()
+
+    async def __call__(self, cmd):
+        key = cmd_key(cmd)
+        response = self.cache.get(key)
+        if response:
+            return response
+
+        flight = self.flights.get(key)
+        if flight:
+            self.coalesced += 1
+            return await flight
+
+        flight = self.flights[key] = get_running_loop().create_future()
+        response = Response(status=Status.KO, data=None)
+        try:
+            response = await self.exchange(key, cmd)
+        except Exception as e:
+            self.log.exception(e)
+        finally:
+            del self.flights[key]
+            flight.set_result(response)
+        return response
+
+    def stats(self):
+        return {'coalesced': self.coalesced, 'in_flight': len(self.flights)}
+
+
+def broker_create(log, connector, address=broker_conf['address']):
+    try:
+        Broker(log, connector, address).serve_forever()
+    except Exception as e:
+        log.error('Exception in broker')
+        log.exception(e)
+
+
+def wait_for_broker(address=broker_conf['address'],
+                    timeout=broker_conf['start_timeout']):
+    until = time() + timeout
+    while not exists(address) and time() < until:
+        sleep(0.1)
+    return exists(address)
+
+
+class BrokerClient(object):
+    '''
+    Callable drop-in replacement for the old comms executor, safe to be
+    handed to forked processes: connections are opened lazily per process
+    and per thread.
+    '''
+
+    def __init__(self, address=broker_conf['address'], priority=HTTP):
+        self.address = address
+        self.priority = priority
+        self.local = local()
+
+    def _connection(self):
+        if getattr(self.local, 'pid', None) != getpid():
+            self.local.conn, self.local.pid = None, getpid()
+        if not self.local.conn:
+            self.local.conn = Client(self.address, family=FAMILY)
+        return self.local.conn
+
+    def _drop_connection(self):
+        if getattr(self.local, 'conn', None):
+            try:
+                self.local.conn.close()
+            except OSError:
+                pass
+        self.local.conn = None
+
+    def request(self, *msg):
+        for retry in range(2):
+            try:
+                conn = self._connection()
+                conn.send(msg)
+                return conn.recv()
+            except (EOFError, OSError):
+                self._drop_connection()
+
+    def stats(self):
+        return self.request(STATS) or {}
+
+    def telemetry(self):
+        return self.request(TELEMETRY) or {}
+
+    def publish(self, name, value):
+        self.request(PUBLISH, name, value)
+
+    def fetch(self, name):
+        return self.request(FETCH, name)
+
+    def wait(self, name, seq=0, timeout=None):
+        ''' Blocks this thread's connection, see Broker.wait '''
+        return self.request(WAIT, name, seq, timeout)
+
+    def __call__(self, cmd, timeout=None):
+        response = self.request(EXECUTE, cmd, self.priority, timeout)
+        return response if response else Response(status=Status.KO, data=None)
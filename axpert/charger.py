@@ -5,7 +5,8 @@ from axpert.protocol import (
     CMD_REL, parse_inverter_conf, empty_inverter_conf, CmdSpec
 )
 from axpert.settings import charger_conf
-from axpert.datalogger import get_avg_last
+from axpert.datalogger import get_avg_last, LAST_INTERVAL
+from axpert.rolling import ROLLING
 
 FLOAT_VOL = charger_conf['float_voltage']
 ABSORB_VOL = charger_conf['absorbtion_voltage']
@@ -14,6 +15,12 @@ ABSORB_AMPS_THRESHOLD = charger_conf['absorbtion_amps_threshold']
 CHARGE_START_CHECK = charger_conf['charge_check_start']
 CHARGE_END_CHECK = charger_conf['charge_check_end']
 
+# Rolling stats older than this are considered stale
+ROLLING_MAX_AGE = LAST_INTERVAL * 10
+# Share of the window the rolling stats must span to be used, they start
+# empty whenever the datalogger (re)starts
+ROLLING_MIN_COVERAGE = 0.9
+
 
 def get_inverter_conf(executor):
     try:
@@ -32,6 +39,32 @@ def set_float_volts_to(log, executor, target):
         log.exception(e)
 
 
+def get_rolling_avg(log, executor, minutes=30):
+    '''
+    Average battery volts and charge amps over the last minutes, from the
+    rolling stats published by the datalogger. Falls back to querying the
+    database when they are stale, do not cover most of the window yet or
+    the window is not tracked.
+    '''
+    seconds = minutes * 60
+    try:
+        rolling = executor.fetch(ROLLING)
+        oldest = datetime.now().timestamp() - ROLLING_MAX_AGE
+        if rolling and (rolling['datetime'] or 0) >= oldest:
+            volts = rolling['batt_volt'][seconds]
+            amps = rolling['batt_charge_amps'][seconds]
+            covered = min(
+                rolling['datetime'] - (window['oldest'] or rolling['datetime'])
+                for window in (volts, amps)
+            )
+            if covered >= seconds * ROLLING_MIN_COVERAGE \
+                    and volts['avg'] is not None and amps['avg'] is not None:
+                return volts['avg'], amps['avg']
+    except (AttributeError, KeyError):
+        pass
+    return get_avg_last(log, minutes=minutes)
+
+
 def manual_charger(log, executor):
 
     def _stop_charge_check(now):
@@ -44,8 +77,8 @@ def manual_charger(log, executor):
                     or inverter_conf.float_volt == FLOAT_VOL:
                 return
 
-            avg_last_batt_volts, avg_last_batt_amps = get_avg_last(
-                log, minutes=30
+            avg_last_batt_volts, avg_last_batt_amps = get_rolling_avg(
+                log, executor, minutes=30
             )
             if (ABSORB_VOL - 0.20) < avg_last_batt_volts < (ABSORB_VOL + 0.20)\
                     and avg_last_batt_amps < ABSORB_AMPS_THRESHOLD:
@@ -91,6 +91,10 @@ def parse_datalogging_extraction_params(parser):
         '--col', dest='extract_cols', action='append',
         help='File where to save the extracted datalogging'
     )
+    parser.add_argument(
+        '--extract-gzip', dest='extract_gzip', action='store_true',
+        help='Gzip the extracted datalogging (also if the file ends in .gz)'
+    )
     return parser
 
 
@@ -124,6 +128,7 @@ def compose_datalogging_response(args, response):
         args['extract_cols']                                \
         if 'extract_cols' in args and args['extract_cols']  \
         else None
+    response['gzip'] = bool(args.get('extract_gzip'))
 
     return response
 
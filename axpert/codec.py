@@ -0,0 +1,83 @@
+from functools import lru_cache
+from struct import pack, unpack
+from crc16 import crc16xmodem
+
+"""
+Frame codec for the inverter link. Every frame, request or response,
+is made of the payload, its CRC16 (xmodem) as two big endian bytes and
+a carriage return as terminator.
+"""
+
+TERMINATOR = b'\r'
+CRC_SIZE = 2
+ENCODING = 'latin-1'
+
+# The inverter never sends these bytes as part of a CRC, since they are
+# frame delimiters, it adds one to the offending CRC byte instead.
+RESERVED_CRC_BYTES = (0x28, 0x0d, 0x0a)
+
+
+class FrameError(Exception):
+    pass
+
+
+class TerminatorError(FrameError):
+    pass
+
+
+class CRCError(FrameError):
+    pass
+
+
+def to_bytes(raw):
+    if isinstance(raw, (bytes, bytearray)):
+        return bytes(raw)
+    return raw.encode(ENCODING)
+
+
+def to_text(raw):
+    if isinstance(raw, (bytes, bytearray)):
+        return raw.decode(ENCODING)
+    return raw
+
+
+@lru_cache(maxsize=128)
+def request_frame(code, val=''):
+    payload = code.encode() + (val or '').encode()
+    return payload + pack('>H', crc16xmodem(payload)) + TERMINATOR
+
+
+def compile_frames(cmds):
+    return {
+        name: request_frame(cmd.code, cmd.val) for name, cmd in cmds.items()
+    }
+
+
+def reserved_crc(crc):
+    high, low = crc >> 8, crc & 0xff
+    high += 1 if high in RESERVED_CRC_BYTES else 0
+    low += 1 if low in RESERVED_CRC_BYTES else 0
+    return (high << 8) | low
+
+
+def validate_response(raw):
+    '''
+    Checks the terminator and CRC of a response frame and returns its
+    payload (the bytes before the CRC), raises a FrameError subclass
+    when the frame is truncated or corrupted.
+    '''
+    data = to_bytes(raw)
+    end = data.find(TERMINATOR)
+    if end < 0:
+        raise TerminatorError('Missing frame terminator in %r' % data)
+    if end <= CRC_SIZE:
+        raise TerminatorError('Frame too short %r' % data)
+
+    payload = data[:end - CRC_SIZE]
+    crc, = unpack('>H', data[end - CRC_SIZE:end])
+    expected = crc16xmodem(payload)
+    if crc != expected and crc != reserved_crc(expected):
+        raise CRCError(
+            'CRC mismatch, got %04X expected %04X' % (crc, expected)
+        )
+    return payload
@@ -1,11 +1,27 @@
+from asyncio import get_running_loop, wait_for, TimeoutError
 from importlib import import_module
+from time import monotonic
+
+from axpert.codec import TERMINATOR
 
 IMPLEMENT = 'Implement in subclass'
+
+BAUD_RATE = 2400
+BITS_PER_BYTE = 10  # 8N1, start + 8 data + stop bits
+FRAME_LATENCY = 1
+# Room for a '(NAK' answer whatever the expected size of the command is
+MIN_FRAME_SIZE = 8
+
 connector_registry = {
-    'serial': 'axpert.connector_serial.ConnectorSerial',
+    'serial': 'axpert.connector_serial.SerialConnector',
     'usb': 'axpert.connector_usbhid.USBConnector'
 }
 
+async_connector_registry = {
+    'serial': 'axpert.connector_serial.AsyncSerialConnector',
+    'usb': 'axpert.connector_usbhid.AsyncUSBConnector'
+}
+
 
 class Connector(object):
 
@@ -27,7 +43,26 @@ class Connector(object):
     def write(self, data):
         raise NotImplementedError(IMPLEMENT)
 
-    def read(self, size):
+    def read(self, size, timeout=None):
+        '''
+        Reads a response frame of at most `size` bytes, returning as soon
+        as the terminator arrives or the deadline for the command is due.
+        '''
+        size = max(size, MIN_FRAME_SIZE)
+        deadline = monotonic() + (timeout or frame_deadline(size))
+        frame = bytearray()
+        while len(frame) < size:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+
+            chunk = self.read_chunk(size - len(frame), remaining)
+            if chunk and feed_frame(frame, chunk):
+                break
+
+        return bytes(frame)
+
+    def read_chunk(self, size, timeout):
         raise NotImplementedError(IMPLEMENT)
 
     def open(self):
@@ -37,10 +72,74 @@ class Connector(object):
         raise NotImplementedError(IMPLEMENT)
 
 
-def resolve_connector(args):
-    for option, cls_namespace in connector_registry.items():
+class AsyncConnector(Connector):
+    '''
+    Non blocking connector for asyncio, waits for the device file
+    descriptor to be readable in the running loop instead of blocking
+    on reads. Subclasses provide fileno() and a read_chunk() that
+    returns whatever is available without waiting.
+    '''
+
+    async def write(self, data):
+        raise NotImplementedError(IMPLEMENT)
+
+    async def read(self, size, timeout=None):
+        size = max(size, MIN_FRAME_SIZE)
+        deadline = monotonic() + (timeout or frame_deadline(size))
+        frame = bytearray()
+        while len(frame) < size:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+
+            chunk = self.read_chunk(size - len(frame), remaining)
+            if not chunk:
+                await self.readable(remaining)
+            elif feed_frame(frame, chunk):
+                break
+
+        return bytes(frame)
+
+    async def readable(self, timeout):
+        loop = get_running_loop()
+        ready = loop.create_future()
+        fd = self.fileno()
+        loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await wait_for(ready, timeout)
+        except TimeoutError:
+            pass
+        finally:
+            loop.remove_reader(fd)
+
+    def fileno(self):
+        raise NotImplementedError(IMPLEMENT)
+
+
+def feed_frame(frame, chunk):
+    ''' Appends chunk to frame, True when the frame is complete '''
+    start = len(frame)
+    frame += chunk
+    end = frame.find(TERMINATOR, start)
+    if end >= 0:
+        del frame[end + 1:]
+        return True
+    return False
+
+
+def frame_deadline(size):
+    return FRAME_LATENCY + (size * BITS_PER_BYTE / BAUD_RATE)
+
+
+def resolve_connector(args, registry=None):
+    registry = registry or connector_registry
+    for option, cls_namespace in registry.items():
         if option in args and args[option]:
             tokens = cls_namespace.split('.')
             module_path, cls_name = '.'.join(tokens[:-1]), tokens[-1]
             module = import_module(module_path)
             return getattr(module, cls_name)
+
+
+def resolve_async_connector(args):
+    return resolve_connector(args, async_connector_registry)
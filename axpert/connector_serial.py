@@ -1,6 +1,8 @@
 from time import sleep
 from serial import (Serial, SerialException)
-from axpert.connector import Connector
+from axpert.connector import Connector, AsyncConnector, BAUD_RATE
+from axpert.codec import TERMINATOR
+from axpert.telemetry import telemetry
 
 
 MAX_CONNECT_RETRIES = 5
@@ -21,6 +23,7 @@ def serial_reconnecter(fnx):
                 # connection lost, try reconnecting after
                 # sleeping for a bit
                 self.log.error('Error connecting to serial device')
+                telemetry.incr('reconnects')
                 sleep(SLEEP_BETWEEN_RETRIES)
 
         self.log.error(
@@ -40,15 +43,43 @@ class SerialConnector(Connector):
         self.serial.flush()
 
     @serial_reconnecter
-    def read(self, size):
+    def read(self, size, timeout=None):
         try:
-            return self.serial.read(size)
+            return super(SerialConnector, self).read(size, timeout)
         except SerialException as e:
             return None
 
+    def read_chunk(self, size, timeout):
+        self.serial.timeout = timeout
+        return self.serial.read_until(TERMINATOR, size)
+
+    def open(self):
+        for port in self.devices:
+            serial = Serial(port, BAUD_RATE, timeout=1, rtscts=False)
+            if serial:
+                self.serial = serial
+                return
+
+    def close(self):
+        self.serial.close()
+
+
+class AsyncSerialConnector(AsyncConnector):
+
+    async def write(self, data):
+        # Frames are at most 16 bytes, they fit in the tty output buffer
+        self.serial.write(data)
+
+    def read_chunk(self, size, timeout):
+        return self.serial.read(size)
+
+    def fileno(self):
+        return self.serial.fileno()
+
     def open(self):
         for port in self.devices:
-            serial = Serial(port, 2400, timeout=1, rtscts=False)
+            # timeout=0 makes reads return whatever is already buffered
+            serial = Serial(port, BAUD_RATE, timeout=0, rtscts=False)
             if serial:
                 self.serial = serial
                 return
@@ -1,7 +1,13 @@
 import hidraw
 
-from connector import (Connector)
-from time import sleep
+from os import (
+    open as os_open, read as os_read, write as os_write, close as os_close,
+    O_RDWR, O_NONBLOCK
+)
+
+from axpert.connector import (Connector, AsyncConnector)
+
+REPORT_SIZE = 8
 
 
 class USBConnector(Connector):
@@ -9,17 +15,10 @@ class USBConnector(Connector):
     def write(self, data):
         self.dev.write(data)
 
-    def read(self, size):
-        retry=0
-        return self._read(size)
-
-    def _read(self, size):
-        data = ''
-        while True:
-            data += ''.join(map(chr, self.dev.read(size)))
-            if not data or '\r' in data or len(data) >= size:
-                break
-        return data
+    def read_chunk(self, size, timeout):
+        # A zero timeout blocks forever on hidraw, wait at least 1 ms
+        timeout_ms = max(1, int(timeout * 1000))
+        return bytes(self.dev.read(REPORT_SIZE, timeout_ms))
 
     def open(self):
         device = self.devices[0]
@@ -31,3 +30,31 @@ class USBConnector(Connector):
 
     def close(self):
         self.dev.close()
+
+
+class AsyncUSBConnector(AsyncConnector):
+    '''
+    Talks to the /dev/hidrawN node directly, hidapi does not expose the
+    file descriptor the event loop needs to watch.
+    '''
+
+    async def write(self, data):
+        os_write(self.fd, data)
+
+    def read_chunk(self, size, timeout):
+        try:
+            return os_read(self.fd, REPORT_SIZE)
+        except BlockingIOError:
+            return b''
+
+    def fileno(self):
+        return self.fd
+
+    def open(self):
+        try:
+            self.fd = os_open(self.devices[0], O_RDWR | O_NONBLOCK)
+        except Exception as e:
+            self.log.error(e)
+
+    def close(self):
+        os_close(self.fd)
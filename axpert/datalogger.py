@@ -1,22 +1,59 @@
-from http.server import HTTPServer
-from sqlite3 import connect
-from time import sleep
-from datetime import datetime, timedelta
+from sqlite3 import connect, OperationalError
+from signal import signal, SIGTERM
+from collections import defaultdict
+from threading import local
+from time import sleep, monotonic
+from datetime import date, datetime, timedelta
+from os import getpid, listdir, makedirs
+from os.path import exists, join
+from itertools import islice
 from json import dumps as json_dumps
 from math import ceil
+from urllib.parse import quote
+from zlib import compressobj
 from pygal import Line
 from pygal.style import Style
-from functools import reduce
+from functools import reduce, lru_cache
 
 from axpert.settings import datalogger_conf
+from axpert.rolling import RollingStats, ROLLING
+from axpert.partitions import Partitions, month_of, month_start
+from axpert.downsample import downsample, MIN_POINTS
+from axpert.spool import Spool
+from axpert.snapshot import SnapshotWriter
+from axpert.broker import DB_STATS, LIVE_SAMPLE
+from axpert.archive import (
+    write_day, read_range, archived_days, day_path, day_start, DayArchive,
+    ArchivedTimes, SUFFIX as ARCHIVE_SUFFIX
+)
 from axpert.http_handler import (
-    BaseGodenergHandler, html_response
+    BaseGodenergHandler, PooledHTTPServer, html_response, json_response
 )
 
 DT_FORMAT = '%Y%m%d%H%M%S'
 INTERVAL = datalogger_conf['interval']
 LAST_INTERVAL = datalogger_conf['last_interval']
 SAMPLES = datalogger_conf['samples']
+COMMIT_ROWS = datalogger_conf['commit_rows']
+COMMIT_INTERVAL = datalogger_conf['commit_interval']
+ARCHIVE_DIR = datalogger_conf['archive_dir']
+ARCHIVE_KEEP_DAYS = datalogger_conf['archive_keep_days']
+ARCHIVE_CHECK_INTERVAL = datalogger_conf['archive_check_interval']
+WRITE_TIMEOUT = datalogger_conf['write_timeout']
+CHECKPOINT_INTERVAL = datalogger_conf['checkpoint_interval']
+CHECKPOINT_TRUNCATE_PAGES = datalogger_conf['checkpoint_truncate_pages']
+SPOOL_DIR = datalogger_conf['spool_dir']
+SPOOL_FSYNC = datalogger_conf['spool_fsync']
+RESTART_DELAY = 10
+EXPORT_CHUNK_ROWS = 500
+GRAPH_POINTS = 1000
+# Source points read per point drawn, enough for the downsampler to
+# find the peaks
+SERIES_OVERSAMPLING = 8
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+READ_CACHED_STATEMENTS = 256
+READ_MMAP_SIZE = datalogger_conf['read_mmap_size']
+READ_CACHE_KIB = datalogger_conf['read_cache_kib']
 
 DB = {'stats': [
         ('datetime', 'INTEGER'), ('grid_volt', 'REAL'),
@@ -33,11 +70,18 @@ DB = {'stats': [
         ('mode', 'TEXT')
     ],
 
+    # Ring buffer of the last SAMPLES samples, see SampleRing
     'last_stats': [
-        ('datetime', 'INTEGER'),
+        ('slot', 'INTEGER PRIMARY KEY'), ('datetime', 'INTEGER'),
         ('batt_volt', 'REAL'),
         ('batt_charge_amps', 'INTEGER'),
         ('pv_amps', 'INTEGER'), ('pv_watts', 'INTEGER')
+    ],
+
+    # Spool position drained so far, see BufferedWriter
+    'spool_state': [
+        ('id', 'INTEGER PRIMARY KEY'), ('segment', 'INTEGER'),
+        ('byte_offset', 'INTEGER')
     ]
 }
 
@@ -50,12 +94,36 @@ INDEXES = {
     ]
 }
 
+# Rollups of stats by bucket of `resolution` seconds, coarsest last. They
+# hold count plus sum, min and max of every numeric column.
+ROLLUPS = [
+    ('stats_1m', 60), ('stats_15m', 900),
+    ('stats_1h', 3600), ('stats_1d', 86400)
+]
+ROLLUP_COLS = [
+    col for col, kind in DB['stats']
+    if kind in ('REAL', 'INTEGER') and col != 'datetime'
+]
+ROLLUP_AGGS = ('sum', 'min', 'max')
+STATS_COLS = [col for col, _ in DB['stats']]
+
+for tab_name, _ in ROLLUPS:
+    DB[tab_name] = [('bucket', 'INTEGER PRIMARY KEY'), ('cnt', 'INTEGER')] + [
+        ('{}_{}'.format(col, agg), 'REAL')
+        for col in ROLLUP_COLS for agg in ROLLUP_AGGS
+    ]
+
+# Tables holding transient or derived data, dropped and recreated on
+# schema changes
+RECREATE_ON_CHANGE = ('last_stats',) + tuple(tab for tab, _ in ROLLUPS)
+
 CREATE_TABLE_STATEMENT = 'CREATE TABLE {} ({})'
+SPOOL_STATE_STATEMENT = 'INSERT OR REPLACE INTO spool_state VALUES (1, ?, ?)'
 
 
 def ensure_db_indexes(log, tab, cursor):
     try:
-        for col in INDEXES[tab]:
+        for col in INDEXES.get(tab, []):
             cursor.execute(
                 'CREATE INDEX idx_{tab}_{col} ON '
                 '{tab} (datetime, {col})'.format(
@@ -66,9 +134,24 @@ def ensure_db_indexes(log, tab, cursor):
     except Exception as e:
         log.exception(e)
 
+def drop_changed_tables(log, db_conn, table_names):
+    for tab in RECREATE_ON_CHANGE:
+        if tab not in table_names:
+            continue
+        cols = [row[1] for row in db_conn.execute(
+            'PRAGMA table_info({})'.format(tab)
+        )]
+        if cols != [col for col, _ in DB[tab]]:
+            log.info('Table {} structure changed, recreating'.format(tab))
+            db_conn.execute('DROP TABLE {}'.format(tab))
+            table_names.remove(tab)
+    return table_names
+
+
 def ensure_db_structure(log, db_conn):
     query = "SELECT name FROM sqlite_master WHERE type='table'"
     table_names = [row[0] for row in db_conn.cursor().execute(query)]
+    table_names = drop_changed_tables(log, db_conn, table_names)
     diff = set(DB.keys()) - set(table_names)
     if not diff:
         log.debug('No difference in tables, not recreating')
@@ -86,97 +169,603 @@ def ensure_db_structure(log, db_conn):
         ensure_db_indexes(log, tab, cursor)
 
     db_conn.commit()
+    for tab, resolution in ROLLUPS:
+        if tab in diff:
+            backfill_rollup(log, db_conn, tab, resolution)
+
     log.info('Database structure created')
 
 
-def save_datapoint(log, db_conn, tab_name, data):
-    try:
-        COLS = DB[tab_name]
-        cursor = db_conn.cursor()
-        log.debug('Saving datapoint for {}'.format(tab_name))
-        data['datetime'] = int(datetime.now().timestamp())
-        column_values = [data[col_name] for col_name, _ in COLS]
-        column_vars = ', '.join('?' for _ in range(len(COLS)))
-        statement = 'INSERT INTO {} VALUES ({})'.format(
-            tab_name, column_vars
+def backfill_rollup(log, db_conn, tab_name, resolution):
+    log.info('Backfilling {} from stats'.format(tab_name))
+    statement = (
+        'INSERT INTO {tab} SELECT datetime / {res} * {res}, COUNT(1), {aggs} '
+        'FROM {{}} WHERE 1 GROUP BY datetime / {res} {merge};'
+    ).format(
+        tab=tab_name, res=resolution, merge=rollup_merge(tab_name),
+        aggs=', '.join(
+            '{}({})'.format(agg.upper(), col)
+            for col in ROLLUP_COLS for agg in ROLLUP_AGGS
         )
-        log.debug(column_values)
-        cursor.execute(statement, column_values)
+    )
+    # One transaction per partition, they can only be attached outside
+    for table in Partitions(db_conn).tables():
+        db_conn.execute(statement.format(table))
         db_conn.commit()
-    except Exception as e:
-        db_conn.rollback()
-        log.error('Error saving datapoint')
-        log.exception(e)
 
+    # Archived days are no longer in stats
+    for path in archive_paths():
+        with DayArchive(path) as archive:
+            db_conn.executemany(
+                rollup_statement(tab_name),
+                rollup(archive.rows(STATS_COLS), resolution)
+            )
+    db_conn.commit()
 
-def delete_first_datapoint(db_conn):
-    cursor = db_conn.cursor()
-    count, = cursor.execute(
-        'SELECT COUNT(1) FROM last_stats;'
-    ).fetchone()
 
-    if count < SAMPLES:
-        return
+@lru_cache(maxsize=None)
+def rollup_merge(tab_name):
+    ''' Upsert clause merging a partial bucket into the stored one '''
+    merges = ['cnt = cnt + excluded.cnt']
+    for col in ROLLUP_COLS:
+        name = '{}_sum'.format(col)
+        merges.append('{0} = COALESCE({0}, 0) + COALESCE(excluded.{0}, 0)'
+                      .format(name))
+        for agg in ('min', 'max'):
+            merges.append(
+                '{0} = {1}(COALESCE({0}, excluded.{0}), '
+                'COALESCE(excluded.{0}, {0}))'.format(
+                    '{}_{}'.format(col, agg), agg.upper()
+                )
+            )
+    return 'ON CONFLICT(bucket) DO UPDATE SET {}'.format(', '.join(merges))
+
+
+@lru_cache(maxsize=None)
+def rollup_statement(tab_name):
+    return 'INSERT INTO {} VALUES ({}) {}'.format(
+        tab_name, ', '.join('?' for _ in DB[tab_name]), rollup_merge(tab_name)
+    )
+
+
+def rollup(rows, resolution):
+    '''
+    Aggregates stats rows, as lists in DB['stats'] order, into rollup
+    rows of `resolution` seconds buckets.
+    '''
+    indexes = [STATS_COLS.index(col) for col in ROLLUP_COLS]
+    buckets = {}
+    for row in rows:
+        bucket = row[0] // resolution * resolution
+        agg = buckets.get(bucket)
+        if agg is None:
+            agg = buckets[bucket] = [bucket, 0] + [None] * (len(indexes) * 3)
+        agg[1] += 1
+        for pos, index in enumerate(indexes):
+            value = row[index]
+            if value is None:
+                continue
+            base = 2 + pos * 3
+            if agg[base] is None:
+                agg[base:base + 3] = [value, value, value]
+            else:
+                agg[base] += value
+                agg[base + 1] = min(agg[base + 1], value)
+                agg[base + 2] = max(agg[base + 2], value)
+    return list(buckets.values())
+
+
+def set_synchronous(db_conn, mode=datalogger_conf['synchronous']):
+    mode = mode.upper()
+    if mode not in SYNCHRONOUS_MODES:
+        raise ValueError('Unknown synchronous mode {}'.format(mode))
+    db_conn.execute('PRAGMA synchronous={}'.format(mode))
+
+
+def open_write_connection(db_filename, timeout=WRITE_TIMEOUT):
+    '''
+    The one connection writing to the database. WAL lets readers go on
+    while it writes and the other way round.
+    '''
+    db_conn = connect(db_filename, timeout=timeout)
+    db_conn.execute('PRAGMA journal_mode = WAL')
+    # Checkpoints are run by the writer between samples, see Checkpointer
+    db_conn.execute('PRAGMA wal_autocheckpoint = 0')
+    set_synchronous(db_conn)
+    return db_conn
+
+
+def is_busy(error):
+    message = str(error)
+    return 'locked' in message or 'busy' in message
+
+
+class Checkpointer(object):
+    '''
+    Passive WAL checkpoints every `interval` seconds, never waiting for
+    readers, and a truncating one when the WAL grows past
+    `truncate_pages` so it does not keep growing under constant reads.
+    '''
+
+    def __init__(self, db_conn, stats, interval=CHECKPOINT_INTERVAL,
+                 truncate_pages=CHECKPOINT_TRUNCATE_PAGES):
+        self.db_conn = db_conn
+        self.stats = stats
+        self.interval = interval
+        self.truncate_pages = truncate_pages
+        self.last = monotonic()
+
+    def due(self):
+        return monotonic() - self.last >= self.interval
+
+    def run(self, mode='PASSIVE'):
+        self.last = monotonic()
+        busy, frames, _ = self.db_conn.execute(
+            'PRAGMA wal_checkpoint({})'.format(mode)
+        ).fetchone()
+        if frames > self.truncate_pages and mode != 'TRUNCATE':
+            busy, frames, _ = self.db_conn.execute(
+                'PRAGMA wal_checkpoint(TRUNCATE)'
+            ).fetchone()
+        self.stats['checkpoints'] += 1
+        self.stats['checkpoint_busy'] += busy
+        self.stats['wal_frames'] = max(frames, 0)
+
+
+class SampleRing(object):
+    '''
+    Fixed capacity window of samples over a slot indexed table. Appending
+    overwrites the oldest slot, no counting or deleting involved.
+    '''
+
+    def __init__(self, db_conn, tab_name='last_stats', capacity=None):
+        self.capacity = capacity = capacity or SAMPLES
+        db_conn.execute(
+            'DELETE FROM {} WHERE slot >= ?'.format(tab_name), [capacity]
+        )
+        # Do not sit on the write lock until the first flush
+        db_conn.commit()
+        newest = db_conn.execute(
+            'SELECT slot FROM {} ORDER BY datetime DESC LIMIT 1'.format(
+                tab_name
+            )
+        ).fetchone()
+        self.next_slot = (newest[0] + 1) % capacity if newest else 0
+
+    def slot(self):
+        slot, self.next_slot = \
+            self.next_slot, (self.next_slot + 1) % self.capacity
+        return slot
+
+
+class BufferedWriter(object):
+    '''
+    Group commit of datapoints: rows are kept in memory and written with
+    executemany in a single transaction once `max_rows` are pending or
+    the oldest pending row is `max_delay` seconds old. Rows that find the
+    database locked stay pending for the next flush.
+
+    With a `spool` every row is appended to it before anything else and
+    the spool position goes in with each commit, rows left behind by a
+    crash or a restart are replayed on start.
+    '''
+
+    def __init__(self, log, db_conn, max_rows=COMMIT_ROWS,
+                 max_delay=COMMIT_INTERVAL, partitions=None, spool=None):
+        self.log = log
+        self.db_conn = db_conn
+        self.partitions = partitions
+        self.spool = spool
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.pending = defaultdict(list)
+        self.pending_rows = 0
+        self.first_pending = None
+        self.rings = {'last_stats': SampleRing(db_conn)}
+        self.stats = dict(
+            flushes=0, rows=0, busy=0, dropped=0, flush_seconds=0.0,
+            flush_seconds_max=0.0, checkpoints=0, checkpoint_busy=0,
+            wal_frames=0, spooled=0, replayed=0, spool_backlog=0,
+            drain_rate=0.0, errors=0
+        )
+        self.checkpointer = Checkpointer(db_conn, self.stats)
+        self.last_drain = monotonic()
+        if spool:
+            self.replay()
+
+    def insert_statement(self, tab_name, table=None):
+        return '{} INTO {} VALUES ({})'.format(
+            'INSERT OR REPLACE' if tab_name in self.rings else 'INSERT',
+            table or tab_name, ', '.join('?' for _ in DB[tab_name])
+        )
 
-    first_dt, = cursor.execute(
-        'SELECT datetime FROM last_stats '
-        'ORDER BY datetime ASC LIMIT 1;'
-    ).fetchone()
+    def targets(self):
+        '''
+        (tab_name, table, rows) to insert, stats rows going to the
+        partition of their month. Partitions get attached here, before
+        the transaction starts.
+        '''
+        targets = []
+        for tab_name, rows in self.pending.items():
+            if tab_name != 'stats' or not self.partitions:
+                targets.append((tab_name, tab_name, rows))
+                continue
+
+            months = defaultdict(list)
+            for row in rows:
+                months[month_of(row[0])].append(row)
+            for month, month_rows in sorted(months.items()):
+                table = self.partitions.table(month, create=True)
+                targets.append((tab_name, table, month_rows))
+        return targets
+
+    def replay(self):
+        position = self.db_conn.execute(
+            'SELECT segment, byte_offset FROM spool_state'
+        ).fetchone()
+        rows = self.spool.replay(tuple(position) if position else (0, 0))
+        for tab_name, row in rows:
+            if tab_name not in DB:
+                continue
+            if tab_name in self.rings:
+                # Slot first, new samples go after the replayed ones
+                ring = self.rings[tab_name]
+                ring.next_slot = (row[0] + 1) % ring.capacity
+            self.pend(tab_name, row)
+        self.stats['replayed'] += len(rows)
+        if rows:
+            self.log.info('Replayed {} spooled datapoints'.format(len(rows)))
+
+    def add(self, tab_name, data):
+        data['datetime'] = int(datetime.now().timestamp())
+        if tab_name in self.rings:
+            data['slot'] = self.rings[tab_name].slot()
+        row = [data[col_name] for col_name, _ in DB[tab_name]]
+        if self.spool:
+            self.spool.append(tab_name, row)
+            self.stats['spooled'] += 1
+        self.pend(tab_name, row)
+
+        if self.due():
+            self.flush()
+
+    def pend(self, tab_name, row):
+        self.pending[tab_name].append(row)
+        self.pending_rows += 1
+        if self.first_pending is None:
+            self.first_pending = monotonic()
+
+    def due(self):
+        return self.pending_rows >= self.max_rows \
+            or (monotonic() - self.first_pending) >= self.max_delay
+
+    def flush(self):
+        if not self.pending_rows:
+            return
+
+        start = monotonic()
+        try:
+            targets = self.targets()
+            cursor = self.db_conn.cursor()
+            for tab_name, table, rows in targets:
+                self.log.debug(
+                    'Saving {} datapoints for {}'.format(len(rows), table)
+                )
+                cursor.executemany(
+                    self.insert_statement(tab_name, table), rows
+                )
+            for tab_name, resolution in ROLLUPS:
+                cursor.executemany(
+                    rollup_statement(tab_name),
+                    rollup(self.pending['stats'], resolution)
+                )
+            if self.spool:
+                # Every pending row is spooled and the other way round
+                position = self.spool.position
+                cursor.execute(SPOOL_STATE_STATEMENT, position)
+            self.db_conn.commit()
+            self.stats['flushes'] += 1
+            self.stats['rows'] += self.pending_rows
+
+        except OperationalError as e:
+            self.db_conn.rollback()
+            if not is_busy(e):
+                return self.drop(e)
+            self.stats['busy'] += 1
+            if self.spool:
+                self.stats['spool_backlog'] = self.spool.backlog()
+            self.log.warning('Database busy, keeping {} datapoints pending'
+                             .format(self.pending_rows))
+            return
+
+        except Exception as e:
+            self.db_conn.rollback()
+            return self.drop(e)
+
+        finally:
+            elapsed = monotonic() - start
+            self.stats['flush_seconds'] += elapsed
+            self.stats['flush_seconds_max'] = max(
+                self.stats['flush_seconds_max'], elapsed
+            )
 
-    try:
-        cursor.execute('DELETE FROM last_stats WHERE datetime=?', [first_dt])
-        db_conn.commit()
-    except:
-        db_conn.rollback()
+        self.drained(self.pending_rows)
+        self.clear()
+        if self.checkpointer.due():
+            self.checkpoint()
+
+    def checkpoint(self, mode='PASSIVE'):
+        try:
+            self.checkpointer.run(mode)
+        except OperationalError as e:
+            self.stats['checkpoint_busy'] += 1
+            self.log.warning('Checkpoint failed: {}'.format(e))
+
+    def drained(self, rows):
+        now = monotonic()
+        self.stats['drain_rate'] = rows / max(now - self.last_drain, 1e-3)
+        self.last_drain = now
+        if self.spool:
+            self.spool.drain(self.spool.position)
+            self.stats['spool_backlog'] = self.spool.backlog()
+
+    def drop(self, error):
+        self.log.error('Error saving datapoints')
+        self.log.exception(error)
+        self.stats['dropped'] += self.pending_rows
+        if self.spool:
+            # Not to be replayed over and over again
+            try:
+                self.db_conn.execute(
+                    SPOOL_STATE_STATEMENT, self.spool.position
+                )
+                self.db_conn.commit()
+                self.spool.drain(self.spool.position)
+            except Exception as e:
+                self.db_conn.rollback()
+                self.log.exception(e)
+        self.clear()
+
+    def clear(self):
+        self.pending.clear()
+        self.pending_rows = 0
+        self.first_pending = None
+
+
+def archive_paths(archive_dir=None):
+    archive_dir = archive_dir or ARCHIVE_DIR
+    if not exists(archive_dir):
+        return []
+    return sorted(
+        join(archive_dir, fname) for fname in listdir(archive_dir)
+        if fname.endswith(ARCHIVE_SUFFIX)
+    )
+
+
+def archive_closed_days(log, db_conn, archive_dir=None, keep_days=None,
+                        max_days=None):
+    '''
+    Moves every day older than `keep_days` out of stats and its monthly
+    partitions into archive files, up to `max_days` of them, dropping the
+    partitions of closed months once empty. Rollups keep covering
+    archived days. Returns the number of days archived.
+    '''
+    archive_dir = archive_dir or ARCHIVE_DIR
+    keep_days = ARCHIVE_KEEP_DAYS if keep_days is None else keep_days
+    makedirs(archive_dir, exist_ok=True)
+    cutoff = day_start(date.today() - timedelta(days=keep_days))
+
+    archived = archive_table(
+        log, db_conn, 'main.stats', archive_dir, cutoff, max_days
+    )
+
+    partitions = Partitions(db_conn)
+    current_month = month_of(datetime.now().timestamp())
+    for month in partitions.months():
+        if month_start(month) >= cutoff or archived == max_days:
+            break
+        table = partitions.table(month)
+        archived += archive_table(
+            log, db_conn, table, archive_dir, cutoff,
+            max_days - archived if max_days else None
+        )
+        empty = not db_conn.execute(
+            'SELECT 1 FROM {} LIMIT 1'.format(table)
+        ).fetchone()
+        if empty and month != current_month:
+            if partitions.drop(month):
+                log.info('Dropped archived partition {}'.format(month))
+            else:
+                log.info('Partition {} still in use, dropped later'.format(
+                    month
+                ))
+    return archived
+
+
+def archive_table(log, db_conn, table, archive_dir, cutoff, max_days=None):
+    ''' Archives the days of `table` before `cutoff`, a day at a time '''
+    archived = 0
+    while archived != max_days:
+        oldest, = db_conn.execute(
+            'SELECT MIN(datetime) FROM {}'.format(table)
+        ).fetchone()
+        if oldest is None or oldest >= cutoff:
+            break
+
+        day = date.fromtimestamp(oldest)
+        params = dict(
+            start=day_start(day), end=day_start(day + timedelta(days=1))
+        )
+        rows = db_conn.execute(
+            'SELECT * FROM {} WHERE datetime >= :start AND '
+            'datetime < :end ORDER BY datetime;'.format(table), params
+        ).fetchall()
+
+        path = day_path(archive_dir, day)
+        if exists(path):
+            # Late rows of an already archived day, or rows a run cut
+            # short archived already: one row per timestamp
+            with DayArchive(path) as archive:
+                merged = {row[0]: row for row in archive.rows(STATS_COLS)}
+            merged.update((row[0], row) for row in rows)
+            rows = sorted(merged.values(), key=lambda row: row[0])
+
+        try:
+            # The rows only leave the table once the file is written
+            db_conn.execute(
+                'DELETE FROM {} WHERE datetime >= :start AND '
+                'datetime < :end;'.format(table), params
+            )
+            write_day(path, DB['stats'], rows)
+            db_conn.commit()
+        except BaseException:
+            db_conn.rollback()
+            raise
+        archived += 1
+        log.info('Archived {} rows of {}'.format(len(rows), day))
+    return archived
+
+
+class Archiver(object):
+    '''
+    Archives closed days on the writer connection between samples, a day
+    per run, running again right away while there are more to go.
+    '''
+
+    def __init__(self, log, writer, interval=ARCHIVE_CHECK_INTERVAL):
+        self.log = log
+        self.writer = writer
+        self.interval = interval
+        self.next_run = monotonic()
+
+    def run_due(self):
+        if monotonic() < self.next_run:
+            return
+        try:
+            # Archived days must not have rows still pending
+            self.writer.flush()
+            archived = archive_closed_days(
+                self.log, self.writer.db_conn, max_days=1
+            )
+        except Exception as e:
+            self.writer.db_conn.rollback()
+            self.log.error('Exception in datalogger archiver')
+            self.log.exception(e)
+            archived = 0
+        self.next_run = monotonic() + (0 if archived else self.interval)
 
 
-def datalogger_interval_record(log, db_conn, status_data, mode_data, last):
+def datalogger_interval_record(writer, status_data, mode_data, last):
     now = int(datetime.now().timestamp())
     if (last + INTERVAL) > now:
         return last
 
     if status_data and mode_data:
-        save_datapoint(
-            log, db_conn, 'stats', {**status_data, **mode_data}
-        )
+        writer.add('stats', {**status_data, **mode_data})
 
     return now
 
-def datalogger_sampler_record(log, db_conn, status_data, mode_data):
-    delete_first_datapoint(db_conn)
+
+def datalogger_sampler_record(writer, status_data, mode_data):
     if status_data and mode_data:
-        save_datapoint(
-            log, db_conn, 'last_stats', {**status_data, **mode_data}
-        )
+        writer.add('last_stats', {**status_data, **mode_data})
 
 
-def datalogger_create(log, comms_executor, cmds):
+def datalogger_live_record(publish, snapshot, status_data, mode_data):
+    if status_data and mode_data:
+        sample = {'status': status_data, 'operation_mode': mode_data}
+        if snapshot:
+            snapshot.publish(sample)
+        publish(LIVE_SAMPLE, sample)
+
+
+def create_snapshot(log):
+    try:
+        return SnapshotWriter()
+    except Exception as e:
+        # /cmds goes to the broker instead
+        log.error('Cannot create the shared memory snapshot')
+        log.exception(e)
+
+
+def datalogger_rolling_record(rolling, publish, status_data):
+    if status_data:
+        rolling.add(int(datetime.now().timestamp()), status_data)
+        publish(ROLLING, rolling.snapshot())
+
+
+def exit_on_sigterm(*args):
+    # Unwind through the finally clauses so pending rows get flushed
+    raise SystemExit(0)
+
+
+def datalogger_run(log, comms_executor, cmds):
 
     def _execute_cmd(cmd):
         response = comms_executor(cmd)
         return cmd.json(response.data, serialize=False)
 
+    status_cmd, mode_cmd = cmds['status'], cmds['operation_mode']
+    db_conn = open_write_connection(datalogger_conf['db_filename'])
+    spool = Spool(SPOOL_DIR, fsync=SPOOL_FSYNC) if SPOOL_DIR else None
     try:
-        status_cmd, mode_cmd = cmds['status'], cmds['operation_mode']
-
-        with connect(datalogger_conf['db_filename'], timeout=1) as db_conn:
-            ensure_db_structure(log, db_conn)
+        ensure_db_structure(log, db_conn)
+        partitions = Partitions(db_conn, DB['stats'], INDEXES['stats']) \
+            if datalogger_conf['partition_by_month'] else None
+        writer = BufferedWriter(
+            log, db_conn, partitions=partitions, spool=spool
+        )
+        archiver = Archiver(log, writer)
+        snapshot = create_snapshot(log)
+        rolling = RollingStats(
+            datalogger_conf['rolling_cols'],
+            datalogger_conf['rolling_windows']
+        )
 
+        try:
             last = 0
             while True:
-                status_data = _execute_cmd(status_cmd)
-                mode_data = _execute_cmd(mode_cmd)
-                last = datalogger_interval_record(
-                    log, db_conn, status_data, mode_data, last
-                )
-                datalogger_sampler_record(
-                    log, db_conn, status_data, mode_data
-                )
+                try:
+                    status_data = _execute_cmd(status_cmd)
+                    mode_data = _execute_cmd(mode_cmd)
+                    last = datalogger_interval_record(
+                        writer, status_data, mode_data, last
+                    )
+                    datalogger_live_record(
+                        comms_executor.publish, snapshot, status_data,
+                        mode_data
+                    )
+                    datalogger_sampler_record(writer, status_data, mode_data)
+                    datalogger_rolling_record(
+                        rolling, comms_executor.publish, status_data
+                    )
+                    archiver.run_due()
+                    comms_executor.publish(DB_STATS, writer.stats)
+                except Exception as e:
+                    # A bad sample or a broker hiccup, not worth a restart
+                    writer.stats['errors'] += 1
+                    log.error('Exception in datalogger sample')
+                    log.exception(e)
                 sleep(LAST_INTERVAL)
+        finally:
+            writer.flush()
+            writer.checkpoint('TRUNCATE')
+    finally:
+        if spool:
+            spool.close()
+        db_conn.close()
 
-    except Exception as e:
-        log.error('Exception in datalogger')
-        log.exception(e)
+
+def datalogger_create(log, comms_executor, cmds):
+    signal(SIGTERM, exit_on_sigterm)
+    while True:
+        try:
+            datalogger_run(log, comms_executor, cmds)
+        except Exception as e:
+            # Spooled rows are replayed by the next run
+            log.error('Exception in datalogger, restarting')
+            log.exception(e)
+            sleep(RESTART_DELAY)
 
 
 def txt_dt_to_int(txt):
@@ -184,108 +773,264 @@ def txt_dt_to_int(txt):
     return int(datetime.strptime(txt_dt, DT_FORMAT).timestamp())
 
 
-def get_last_data_datetime(log):
-    with connect(datalogger_conf['db_filename'], timeout=1) as db_conn:
-        cursor = db_conn.cursor()
-        cursor.execute(
-            'SELECT datetime FROM stats '
-            'ORDER BY datetime DESC LIMIT 1;'
-        )
-        dt = cursor.fetchone()
-        if dt:
-            try:
-                return datetime.fromtimestamp(dt[0])
-            except Exception as e:
-                log.exception(e)
-                return 0
-        else:
-            return 0
+def open_read_connection(db_filename):
+    db_conn = connect(
+        'file:{}?mode=ro'.format(quote(db_filename)), uri=True, timeout=1,
+        cached_statements=READ_CACHED_STATEMENTS
+    )
+    db_conn.execute('PRAGMA query_only = 1')
+    db_conn.execute('PRAGMA mmap_size = {:d}'.format(READ_MMAP_SIZE))
+    # Negative sizes are in KiB instead of pages
+    db_conn.execute('PRAGMA cache_size = -{:d}'.format(READ_CACHE_KIB))
+    return db_conn
 
 
-def get_avg_last(log, minutes=30):
-    with connect(datalogger_conf['db_filename'], timeout=1) as db_conn:
-        cursor = db_conn.cursor()
-        from_dt = datetime.now() - timedelta(minutes=minutes)
-        cursor.execute(
-            '''SELECT AVG(batt_volt), AVG(batt_charge_amps)
-               FROM last_stats WHERE datetime >= {};
-            '''.format(int(from_dt.timestamp()))
-        )
-        row = cursor.fetchone()
-        if row:
-            try:
-                return float(row[0]), float(row[1])
-            except Exception as e:
-                log.exception(e)
-        return (0,0)
+class ReadConnections(object):
+    '''
+    Long lived read only connections to the datalogger database, one per
+    process, thread and database file, so the queries of the http
+    servers, the charger and the watchdog reuse their prepared statements
+    and page cache instead of reconnecting every time.
+    '''
 
+    def __init__(self):
+        self.local = local()
 
-def get_range(from_dt, to_dt, extract_cols=None,
-              as_json=False, raw_data=False, grouped=False):
+    def get(self, db_filename):
+        if getattr(self.local, 'pid', None) != getpid():
+            self.local.conns, self.local.pid = {}, getpid()
+        db_conn = self.local.conns.get(db_filename)
+        if db_conn is None:
+            db_conn = self.local.conns[db_filename] = \
+                open_read_connection(db_filename)
+        return db_conn
 
-    MAX_GROUPED_ITEMS = 2048
 
-    def _build_query(db_conn, params):
-        cols_stat = '*' if not extract_cols  else ', '.join(extract_cols)
+read_connections = ReadConnections()
 
-        where_stat = 'WHERE datetime >= :from_dt AND datetime <= :to_dt'
-        if not grouped:
-            return 'SELECT {cols_stat} ' \
-                   'FROM stats {where_stat};'.format(
-                        cols_stat=cols_stat,
-                        where_stat=where_stat
-            )
 
-        total_items, = db_conn.cursor().execute(
-            'SELECT COUNT(1) FROM stats {where_stat};'.format(
-                where_stat=where_stat
-            ),
-            params
-        ).fetchone()
+def read_connection():
+    return read_connections.get(datalogger_conf['db_filename'])
 
-        if total_items <= MAX_GROUPED_ITEMS:
-            return 'SELECT 1, datetime, {cols_stat} ' \
-            'FROM stats {where_stat};'.format(
-                cols_stat=cols_stat,
-                where_stat=where_stat
-            )
 
-        return '''
-            SELECT {group_coe}, (datetime / {group_coe}), {cols}
-            FROM stats {where_stat} GROUP BY (datetime / {group_coe});
-        '''.format(
-                **dict(
-                    group_coe=INTERVAL * ceil(total_items / MAX_GROUPED_ITEMS),
-                    cols=','.join('AVG({})'.format(c) for c in extract_cols),
-                    where_stat=where_stat
-                )
-            )
+def get_last_data_datetime(log):
+    db_conn = read_connection()
+    # Only the newest partition can hold newer rows than main
+    partitions = Partitions(db_conn)
+    last_month = partitions.months()[-1:]
+    tables = ['main.stats'] + [
+        partitions.table(month) for month in last_month
+    ]
+    dt = max((
+        db_conn.execute(
+            'SELECT datetime FROM {} ORDER BY datetime DESC LIMIT 1;'
+            .format(table)
+        ).fetchone() for table in tables
+    ), key=lambda row: row or (0,))
+    if dt:
+        try:
+            return datetime.fromtimestamp(dt[0])
+        except Exception as e:
+            log.exception(e)
+            return 0
+    else:
+        return 0
 
-    def _process_rows(rows):
-        return json_dumps(rows) if as_json else '\n'.join(rows)
 
-    def _process_cols(cols):
-        txt_cols = (str(col) for col in cols)
-        return txt_cols if as_json else ';'.join(txt_cols)
+def get_avg_last(log, minutes=30):
+    from_dt = datetime.now() - timedelta(minutes=minutes)
+    row = read_connection().execute(
+        '''SELECT AVG(batt_volt), AVG(batt_charge_amps)
+           FROM last_stats WHERE datetime >= ?;
+        ''', [int(from_dt.timestamp())]
+    ).fetchone()
+    if row:
+        try:
+            return float(row[0]), float(row[1])
+        except Exception as e:
+            log.exception(e)
+    return (0,0)
+
+
+def get_last_window(seconds, cols=None):
+    '''
+    Samples of the last `seconds` from the last_stats ring buffer, oldest
+    first, as (datetime, col, ...) rows.
+    '''
+    available = [col for col, _ in DB['last_stats'] if col != 'slot']
+    cols = cols or available[1:]
+    unknown = set(cols) - set(available)
+    if unknown:
+        raise KeyError('Unknown columns {}'.format(', '.join(unknown)))
+
+    from_dt = int(datetime.now().timestamp()) - seconds
+    return read_connection().execute(
+        'SELECT datetime, {} FROM last_stats WHERE datetime >= ? '
+        'ORDER BY datetime;'.format(', '.join(cols)), [from_dt]
+    ).fetchall()
+
+
+def range_rows(db_conn, from_dt, to_dt, cols):
+    '''
+    Rows of `cols` within the range, oldest first, out of the archive
+    files, the main stats table and the overlapping monthly partitions.
+    Rows of a day being archived, in a file and still in a table, come
+    out once.
+    '''
+    names = ['datetime'] + list(cols)
+    paths = archived_days(ARCHIVE_DIR, from_dt, to_dt)
+    for row in read_range(paths, from_dt, to_dt, names):
+        yield row[1:]
+
+    archived = ArchivedTimes(ARCHIVE_DIR, paths)
+    params = dict(from_dt=from_dt, to_dt=to_dt)
+    for table in Partitions(db_conn).tables(from_dt, to_dt):
+        for row in db_conn.execute(
+            'SELECT {} FROM {} WHERE datetime >= :from_dt AND '
+            'datetime <= :to_dt ORDER BY datetime;'.format(
+                ', '.join(names), table
+            ), params
+        ):
+            if row[0] not in archived:
+                yield row[1:]
+
+
+def series_source(span, cols, points):
+    '''
+    Coarsest rollup with at least SERIES_OVERSAMPLING buckets per point
+    over `span` seconds, None when raw stats should be read instead.
+    '''
+    wanted = points * SERIES_OVERSAMPLING
+    if span / INTERVAL <= wanted or set(cols) - set(ROLLUP_COLS):
+        return None
+    for tab_name, resolution in reversed(ROLLUPS):
+        if span / resolution >= wanted:
+            return tab_name, resolution
+    return None
+
+
+def series_rows(db_conn, from_dt, to_dt, cols, points=GRAPH_POINTS,
+                method='lttb'):
+    '''
+    At most `points` (datetime, col, ...) rows over the range, chosen to
+    keep the shape of every series.
+    '''
+    source = series_source(to_dt - from_dt, cols, points)
+    if not source:
+        rows = [
+            row for row in range_rows(
+                db_conn, from_dt, to_dt, ['datetime'] + cols
+            ) if None not in row
+        ]
+    elif method == 'minmax':
+        # Lowest and highest of every bucket, half a bucket apart
+        tab_name, resolution = source
+        rows = []
+        for row in db_conn.execute(
+            'SELECT bucket, {}, {} FROM {} WHERE bucket > :from_dt - {} '
+            'AND bucket <= :to_dt ORDER BY bucket;'.format(
+                ', '.join('{}_min'.format(col) for col in cols),
+                ', '.join('{}_max'.format(col) for col in cols),
+                tab_name, resolution
+            ), dict(from_dt=from_dt, to_dt=to_dt)
+        ):
+            if None not in row:
+                rows.append(row[:len(cols) + 1])
+                rows.append((row[0] + resolution // 2,) + row[len(cols) + 1:])
+    else:
+        tab_name, resolution = source
+        rows = db_conn.execute(
+            'SELECT bucket, {} FROM {} WHERE bucket > :from_dt - {} '
+            'AND bucket <= :to_dt ORDER BY bucket;'.format(
+                ', '.join('{}_sum / cnt'.format(col) for col in cols),
+                tab_name, resolution
+            ), dict(from_dt=from_dt, to_dt=to_dt)
+        ).fetchall()
+        rows = [row for row in rows if None not in row]
+
+    return downsample(
+        rows, points, method, cols=range(1, len(cols) + 1)
+    )
+
+
+def get_series(from_dt, to_dt, cols, points=GRAPH_POINTS, method='lttb'):
+    return series_rows(
+        read_connection(), txt_dt_to_int(from_dt), txt_dt_to_int(to_dt),
+        cols, points, method
+    )
 
 
-    with connect(datalogger_conf['db_filename'], timeout=1) as db_conn:
-        params = dict(
-            from_dt=txt_dt_to_int(from_dt), to_dt=txt_dt_to_int(to_dt)
+def get_range(from_dt, to_dt, extract_cols=None,
+              as_json=False, raw_data=False):
+    rows = list(range_rows(
+        read_connection(), txt_dt_to_int(from_dt), txt_dt_to_int(to_dt),
+        list(extract_cols or STATS_COLS)
+    ))
+    if raw_data:
+        return rows
+
+    return ''.join(export_chunks(rows, as_json))
+
+
+def iter_range(from_dt, to_dt, extract_cols=None):
+    '''
+    Rows of the range as they are read, for exports of any size. Takes
+    timestamps, unknown columns raise KeyError.
+    '''
+    cols = list(extract_cols or STATS_COLS)
+    unknown = set(cols) - set(STATS_COLS)
+    if unknown:
+        raise KeyError('Unknown columns {}'.format(', '.join(sorted(unknown))))
+
+    return range_rows(read_connection(), from_dt, to_dt, cols)
+
+
+def export_chunks(rows, as_json=False, chunk_rows=EXPORT_CHUNK_ROWS):
+    '''
+    CSV (; separated) or JSON text of `rows` in chunks of `chunk_rows`
+    rows, the whole document is never held in memory.
+    '''
+    separator = ', ' if as_json else '\n'
+    rows = iter(rows)
+    if as_json:
+        yield '['
+
+    first = True
+    while True:
+        batch = list(islice(rows, chunk_rows))
+        if not batch:
+            break
+        text = separator.join(
+            json_dumps([str(col) for col in row]) if as_json
+            else ';'.join(str(col) for col in row)
+            for row in batch
         )
-        cursor = db_conn.cursor()
-        cursor.execute(_build_query(db_conn, params), params)
-        if raw_data:
-            return cursor.fetchall()
+        yield text if first else separator + text
+        first = False
 
-        return _process_rows(
-            _process_cols(row) for row in cursor.fetchall()
-        )
+    if as_json:
+        yield ']'
+
+
+def encode_chunks(chunks, compress=False):
+    ''' Text chunks as bytes, optionally as a gzip stream '''
+    if not compress:
+        for chunk in chunks:
+            yield chunk.encode()
+        return
+
+    # wbits 31 writes the gzip header and trailer
+    gzip = compressobj(wbits=31)
+    for chunk in chunks:
+        data = gzip.compress(chunk.encode())
+        if data:
+            yield data
+    yield gzip.flush()
 
 
 def datalogger_http_server_create(log):
     http_handler = create_base_datalogger_handler(log)
-    server = HTTPServer(('', datalogger_conf['port']), http_handler)
+    server = PooledHTTPServer(('', datalogger_conf['port']), http_handler)
     server.serve_forever()
 
 def create_base_datalogger_handler(log):
@@ -302,7 +1047,14 @@ def create_base_datalogger_handler(log):
 class BaseDataLoggerHandler(BaseGodenergHandler):
 
     routes = {
-        '/graph': 'plot_datalogger'
+        '/graph': 'plot_datalogger',
+        '/last': 'last_window',
+        '/export': 'export'
+    }
+
+    slow_routes = {
+        '/graph': 60,
+        '/export': 300
     }
 
     MAX_X_LABELS = 40
@@ -394,9 +1146,24 @@ class BaseDataLoggerHandler(BaseGodenergHandler):
         col_2 = req.get('col_2', [None])[0]
         cols = [col for col in [col_1, col_2] if col]
 
-        data = get_range(
-            from_dt, to_dt, cols, raw_data=True, grouped=True,
-        )
+        unknown = set(cols) - set(STATS_COLS)
+        if unknown:
+            raise KeyError('Unknown columns {}'.format(', '.join(unknown)))
+
+        method = req.get('method', ['lttb'])[0]
+        if method not in MIN_POINTS:
+            raise KeyError('Unknown downsampling method {}'.format(method))
+        points = req.get('points', [str(GRAPH_POINTS)])[0]
+        least = MIN_POINTS[method] * len(cols)
+        if not points.isdigit() or int(points) < least:
+            raise KeyError('Invalid number of points {}, {} at least'.format(
+                points, least
+            ))
+
+        # As (coef, datetime, col, ...) rows with a coef of one
+        data = [(1,) + row for row in get_series(
+            from_dt, to_dt, cols, points=int(points), method=method
+        )]
 
         line_chart = self.build_line(data, col_2)
 
@@ -409,3 +1176,63 @@ class BaseDataLoggerHandler(BaseGodenergHandler):
 
         line_chart.x_labels = chart_data['labels']
         return line_chart.render()
+
+    @json_response
+    def last_window(self, req):
+        '''
+        Recent samples from the ring buffer, columns as in last_stats:
+            * Req: /last?seconds=600&col=batt_volt&col=pv_watts
+            * Res: [[datetime, batt_volt, pv_watts], ...]
+        '''
+        seconds = int(req.get('seconds', [SAMPLES * LAST_INTERVAL])[0])
+        return get_last_window(seconds, req.get('col'))
+
+    def export(self, req):
+        '''
+        Range as a chunked download, memory use does not grow with it:
+            * Req: /export?from=20171101&to=20180101&col=batt_volt
+                   &format=json&gzip=1
+            * Res: csv (default) or json, gzip encoded if asked
+        '''
+        try:
+            as_json = req.get('format', ['csv'])[0] == 'json'
+            compress = req.get('gzip', ['0'])[0] == '1'
+            rows = iter_range(
+                txt_dt_to_int(req['from'][0]), txt_dt_to_int(req['to'][0]),
+                req.get('col')
+            )
+        except (KeyError, ValueError) as e:
+            self.send_response(400)
+            self.send_header('Content-type', 'text/plain')
+            self.end_headers()
+            self.wfile.write(str(e).encode())
+            return
+
+        # Chunked transfer needs HTTP/1.1, older clients get the body as
+        # is and its end is the connection closing. Not reused either way.
+        chunked = self.request_version == 'HTTP/1.1'
+        if chunked:
+            self.protocol_version = 'HTTP/1.1'
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header(
+            'Content-type', 'application/json' if as_json else 'text/csv'
+        )
+        if compress:
+            self.send_header('Content-Encoding', 'gzip')
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+
+        try:
+            for data in encode_chunks(export_chunks(rows, as_json), compress):
+                if data and chunked:
+                    self.wfile.write(b'%X\r\n%s\r\n' % (len(data), data))
+                elif data:
+                    self.wfile.write(data)
+            if chunked:
+                self.wfile.write(b'0\r\n\r\n')
+        except Exception as e:
+            # Too late for an error status, the download ends short
+            self.log.exception(e)
@@ -0,0 +1,106 @@
+from itertools import accumulate
+
+"""
+Downsampling of time series to a fixed number of points for charts,
+keeping the peaks and dips that bucket averages flatten out:
+
+    lttb    Largest-Triangle-Three-Buckets, the point of every bucket
+            forming the largest triangle with the previously selected
+            point and the average of the next bucket.
+    minmax  The lowest and highest point of every bucket.
+
+Both return the indexes of the selected points, in order. Bucket
+averages come out of prefix sums, so each bucket costs one pass over
+its own points. Budgets below what a method needs get evenly spaced
+points instead.
+"""
+
+# Fewest points per series each method works with
+MIN_POINTS = {'lttb': 3, 'minmax': 2}
+
+
+def spread(size, threshold):
+    ''' `threshold` indexes evenly spaced over `size`, ends included '''
+    if threshold >= size:
+        return list(range(size))
+    if threshold < 2:
+        return [0] * threshold
+    every = (size - 1) / (threshold - 1)
+    return [round(step * every) for step in range(threshold)]
+
+
+def lttb(xs, ys, threshold):
+    size = len(ys)
+    if threshold >= size or threshold < MIN_POINTS['lttb']:
+        return spread(size, threshold)
+
+    prefix_x = [0] + list(accumulate(xs))
+    prefix_y = [0] + list(accumulate(ys))
+    every = (size - 2) / (threshold - 2)
+
+    selected, prev = [0], 0
+    for bucket in range(threshold - 2):
+        start = int(bucket * every) + 1
+        end = int((bucket + 1) * every) + 1
+        next_end = min(int((bucket + 2) * every) + 1, size)
+        if next_end <= end:
+            # The last bucket is followed by the last point only
+            next_end = size
+        count = next_end - end
+        avg_x = (prefix_x[next_end] - prefix_x[end]) / count
+        avg_y = (prefix_y[next_end] - prefix_y[end]) / count
+
+        # Twice the triangle area is |a * y + b * x + c|
+        prev_x, prev_y = xs[prev], ys[prev]
+        a = prev_x - avg_x
+        b = avg_y - prev_y
+        c = -a * prev_y - b * prev_x
+        prev = max(
+            range(start, end), key=lambda i: abs(a * ys[i] + b * xs[i] + c)
+        )
+        selected.append(prev)
+
+    selected.append(size - 1)
+    return selected
+
+
+def minmax(ys, threshold):
+    size = len(ys)
+    if threshold >= size or threshold < MIN_POINTS['minmax']:
+        return spread(size, threshold)
+
+    buckets = threshold // 2
+    every = size / buckets
+    selected = []
+    for bucket in range(buckets):
+        start, end = int(bucket * every), int((bucket + 1) * every)
+        indexes = range(start, end)
+        low = min(indexes, key=ys.__getitem__)
+        high = max(indexes, key=ys.__getitem__)
+        selected.extend(sorted({low, high}))
+    return selected
+
+
+def downsample(rows, threshold, method='lttb', cols=(1,)):
+    '''
+    At most `threshold` of (x, y, ...) `rows`, shared between the series
+    in `cols` so the shape of each one is kept.
+    '''
+    if len(rows) <= threshold:
+        return rows
+
+    per_col = threshold // len(cols)
+    if not per_col:
+        # Not even a point per series, their shapes are lost anyway
+        return [rows[index] for index in spread(len(rows), threshold)]
+    xs = [row[0] for row in rows]
+    selected = set()
+    for col in cols:
+        ys = [row[col] for row in rows]
+        if method == 'minmax':
+            selected.update(minmax(ys, per_col))
+        elif method == 'lttb':
+            selected.update(lttb(xs, ys, per_col))
+        else:
+            raise ValueError('Unknown downsampling method {}'.format(method))
+    return [rows[index] for index in sorted(selected)]
@@ -1,29 +1,316 @@
 from http.server import HTTPServer
 from http.server import BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
+from email.utils import formatdate, parsedate_to_datetime
 from json import dumps as json_dumps
 from functools import reduce
+from queue import Queue, Full
+from socket import SHUT_RDWR
+from threading import Thread, Semaphore, Lock
 from time import sleep
 from datetime import datetime
+from zlib import crc32
 
 from axpert.settings import http_conf
 from axpert.protocol import CMD_REL
 from axpert.weather import get_weather_stats
+from axpert.telemetry import prometheus_text
+from axpert.rolling import ROLLING
+from axpert.broker import DB_STATS, LIVE_SAMPLE
+from axpert.snapshot import SnapshotReader
+from axpert.assets import StaticAssets, accepts_gzip
+
+
+STREAM_KEEPALIVE = 15
+STREAM_SEND_TIMEOUT = 1
+KEEPALIVE_EVENT = b': keepalive\n\n'
+
+# Versioned asset urls never change, images are linked to from scripts
+# and only get a day
+IMMUTABLE = 'public, max-age=31536000, immutable'
+IMG_MAX_AGE = 86400
+
+REJECT_RESPONSE = (
+    b'HTTP/1.0 503 Service Unavailable\r\nRetry-After: 1\r\n'
+    b'Content-Length: 0\r\nConnection: close\r\n\r\n'
+)
+
+
+class PooledHTTPServer(HTTPServer):
+    '''
+    HTTP server handing requests to a fixed pool of `workers` threads.
+    Up to `queue_size` requests wait for a free worker, any other one is
+    turned away with a 503 right away. Slow routes (see
+    BaseGodenergHandler.slow_routes) run on at most `slow_workers` of
+    them and never wait for one, so the rest are always there for the
+    real-time ones.
+    '''
+
+    def __init__(self, server_address, handler, workers=None,
+                 slow_workers=None, queue_size=None):
+        super(PooledHTTPServer, self).__init__(server_address, handler)
+        self.requests = Queue(queue_size or http_conf['queue_size'])
+        self.slow_lane = Semaphore(slow_workers or http_conf['slow_workers'])
+        self.stats_lock = Lock()
+        self.stats = dict(served=0, rejected=0, slow_rejected=0)
+        self.detached = set()
+        for _ in range(workers or http_conf['workers']):
+            Thread(target=self.work, daemon=True).start()
+
+    def count(self, key):
+        with self.stats_lock:
+            self.stats[key] += 1
+
+    def process_request(self, request, client_address):
+        try:
+            self.requests.put_nowait((request, client_address))
+        except Full:
+            self.count('rejected')
+            try:
+                request.sendall(REJECT_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+
+    def work(self):
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                if request in self.detached:
+                    self.detached.discard(request)
+                else:
+                    self.shutdown_request(request)
+                self.count('served')
+
+    def detach(self, request):
+        ''' The connection outlives its handler, someone else closes it '''
+        self.detached.add(request)
+
+
+static_assets = StaticAssets(links={
+    '/jquery': 'jquery-3.2.1.min.js',
+    '/no_sleep': 'NoSleep.js'
+})
+
+
+def merge_cmds(data, names, merge):
+    '''
+    Responses of the `names` commands out of `data`, merged into a
+    single dictionary if asked to or if there is a single one.
+    '''
+    if merge or len(names) == 1:
+        return reduce(
+            lambda merged, name: merged.update(data.get(name) or {})
+            or merged, names, {}
+        )
+    return {name: data.get(name) or {} for name in names}
+
+
+class EncodedCmds(object):
+    '''
+    JSON bytes and ETag of /cmds responses out of a snapshot sample, per
+    (command names, merge). Only the entries of the latest sample are
+    kept, every poll in between gets the same bytes.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.seq = None
+        self.entries = {}
+
+    def get(self, seq, sample, names, merge):
+        key = (tuple(names), merge)
+        with self.lock:
+            if seq != self.seq:
+                self.seq, self.entries = seq, {}
+            entry = self.entries.get(key)
+        if entry:
+            return entry
+
+        body = json_dumps(merge_cmds(sample, names, merge)).encode()
+        entry = body, '"{:x}-{:08x}"'.format(seq, crc32(body))
+        with self.lock:
+            if seq == self.seq:
+                self.entries[key] = entry
+        return entry
+
+
+def sse_event(seq, data, event='sample'):
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+        seq, event, json_dumps(data)
+    ).encode()
+
+
+class EventStream(object):
+    '''
+    Server-Sent Events of the broker board value `name`. A single thread
+    waits for every new value and writes it to all the subscribed
+    connections, so viewers do not hold a worker and do not add a single
+    command on the inverter link. Connections failing a write are closed.
+    '''
+
+    def __init__(self, log, comms_executor, name=LIVE_SAMPLE,
+                 keepalive=STREAM_KEEPALIVE, send_timeout=STREAM_SEND_TIMEOUT):
+        self.log = log
+        self.comms_executor = comms_executor
+        self.name = name
+        self.keepalive = keepalive
+        self.send_timeout = send_timeout
+        self.lock = Lock()
+        # Connection: (command names, merge)
+        self.subscribers = {}
+        self.seq, self.value = 0, None
+        self.thread = None
+
+    def subscribe(self, conn, names, merge):
+        conn.settimeout(self.send_timeout)
+        with self.lock:
+            if self.value is not None:
+                event = sse_event(
+                    self.seq, merge_cmds(self.value, names, merge)
+                )
+                if not self.send(conn, event):
+                    return
+            self.subscribers[conn] = (names, merge)
+            if not self.thread:
+                self.thread = Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def send(self, conn, event):
+        try:
+            conn.sendall(event)
+            return True
+        except OSError:
+            self.subscribers.pop(conn, None)
+            try:
+                conn.shutdown(SHUT_RDWR)
+            except OSError:
+                pass
+            conn.close()
+            return False
+
+    def broadcast(self, seq, value):
+        events = {}
+        for conn, (names, merge) in list(self.subscribers.items()):
+            if value is None:
+                event = KEEPALIVE_EVENT
+            else:
+                key = (tuple(names), merge)
+                if key not in events:
+                    events[key] = sse_event(
+                        seq, merge_cmds(value, names, merge)
+                    )
+                event = events[key]
+            self.send(conn, event)
+
+    def run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                # Viewers would hang for good if this thread went away
+                self.log.error('Exception in event stream')
+                self.log.exception(e)
+                sleep(1)
+
+    def run_once(self):
+        result = self.comms_executor.wait(self.name, self.seq, self.keepalive)
+        if result is None:
+            # Broker unreachable, try again in a while
+            sleep(1)
+            return
+        seq, value = result
+        if value is not None and not isinstance(value, dict):
+            self.seq = seq
+            raise ValueError('Unexpected {} sample'.format(type(value)))
+        with self.lock:
+            self.seq = seq
+            if value is not None:
+                self.value = value
+            self.broadcast(seq, value)
 
 
 class BaseGodenergHandler(BaseHTTPRequestHandler):
 
     routes = {}
 
+    # Seconds a slow route may block on the client, routes not listed
+    # here get `timeout`. Slow requests finding every slow worker busy
+    # are answered 503 straight away, never holding a worker waiting.
+    slow_routes = {}
+    timeout = http_conf['request_timeout']
+
     def do_GET(self):
         parsed_path = urlparse(self.path)
         route = parsed_path.path
         if route not in self.routes:
             self.send_response(404)
             self.wfile.write(b'Route not found')
-        else:
-            route_fnx = getattr(self, self.routes[route])
-            route_fnx(parse_qs(parsed_path.query))
+            return
+
+        route_fnx = getattr(self, self.routes[route])
+        req = parse_qs(parsed_path.query)
+        slow_lane = getattr(self.server, 'slow_lane', None)
+        if route not in self.slow_routes or slow_lane is None:
+            return route_fnx(req)
+
+        if not slow_lane.acquire(blocking=False):
+            self.server.count('slow_rejected')
+            self.send_error(503, 'Too many slow requests')
+            return
+        self.connection.settimeout(self.slow_routes[route])
+        try:
+            return route_fnx(req)
+        finally:
+            slow_lane.release()
+
+    def not_modified(self, etag, mtime=None):
+        ''' Whether the client holds this version already '''
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags or 'W/' + etag in tags
+
+        since = self.headers.get('If-Modified-Since')
+        if since and mtime is not None:
+            try:
+                return int(mtime) <= parsedate_to_datetime(since).timestamp()
+            except (TypeError, ValueError):
+                pass
+        return False
+
+    def send_cached(self, body, etag, mtime=None, ctype='text/html',
+                    cache_control='no-cache', headers=()):
+        '''
+        `body` with its validators, or a bodyless 304 if the request
+        says the client has it already.
+        '''
+        validators = [('ETag', etag), ('Cache-Control', cache_control)]
+        if mtime is not None:
+            validators.append(
+                ('Last-Modified', formatdate(mtime, usegmt=True))
+            )
+
+        if self.not_modified(etag, mtime):
+            self.send_response(304)
+            for header in validators + [
+                header for header in headers if header[0] == 'Vary'
+            ]:
+                self.send_header(*header)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        for header in validators + list(headers):
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
 
 
 def html_response(ctype='text/html'):
@@ -34,8 +321,12 @@ def html_response(ctype='text/html'):
                 response = fnx(*args, **kwargs)
                 self.send_response(200)
 
+            except KeyError as ke:
+                response = str(ke).encode()
+                self.send_response(400)
+
             except Exception as e:
-                response = str(e)
+                response = str(e).encode()
                 self.send_response(500)
                 self.log.exception(e)
 
@@ -75,13 +366,16 @@ def json_response(fnx):
 
 def http_server_create(log, comms_executor):
     http_handler = create_base_remote_cmd_handler(
-        log, comms_executor, CMD_REL
+        log, comms_executor, CMD_REL, EventStream(log, comms_executor),
+        SnapshotReader()
     )
-    server = HTTPServer(('', http_conf['port']), http_handler)
+    server = PooledHTTPServer(('', http_conf['port']), http_handler)
     server.serve_forever()
 
 
-def create_base_remote_cmd_handler(log, comms_executor, cmds):
+def create_base_remote_cmd_handler(log, comms_executor, cmds, events=None,
+                                   snapshot=None):
+    encoded = EncodedCmds()
 
     class RemoteCommandsHandler(BaseRemoteCommandsHandler):
 
@@ -89,6 +383,9 @@ def create_base_remote_cmd_handler(log, comms_executor, cmds):
             self.log = log
             self.comms_executor = comms_executor
             self.cmds = cmds
+            self.events = events
+            self.snapshot = snapshot
+            self.encoded = encoded
             super(RemoteCommandsHandler, self).__init__(*args, **kwargs)
 
     return RemoteCommandsHandler
@@ -102,46 +399,149 @@ class BaseRemoteCommandsHandler(BaseGodenergHandler):
         '/jquery': 'jquery',
         '/no_sleep': 'no_sleep',
         '/img': 'img',
-        '/weather': 'weather'
+        '/weather': 'weather',
+        '/metrics': 'metrics',
+        '/metrics.json': 'metrics_json',
+        '/rolling': 'rolling',
+        '/stream': 'stream'
+    }
+
+    slow_routes = {
+        '/weather': 30
     }
 
-    def execute_cmd(self, cmd_name):
+    def execute_cmd(self, cmd_name, snapshot=None):
+        # The datalogger sample, when fresh, saves a trip to the inverter
+        if snapshot and snapshot[2].get(cmd_name):
+            return snapshot[2][cmd_name]
         return self.cmds[cmd_name].json(
             self.comms_executor(self.cmds[cmd_name]).data,
             serialize=False
         )
 
-    @html_response()
+    assets = static_assets
+
     def viewer(self, req):
-        return self.serve_static('viewer.html')
+        return self.serve_static(req, 'viewer.html')
 
-    @html_response()
     def jquery(self, req):
-        return self.serve_static('jquery-3.2.1.min.js')
+        return self.serve_static(req, 'jquery-3.2.1.min.js')
 
-    @html_response()
     def no_sleep(self, req):
-        return self.serve_static('NoSleep.js')
+        return self.serve_static(req, 'NoSleep.js')
 
-    @html_response(ctype='image/gif')
     def img(self, req):
-        img_fname = req['src'][0]
-        return self.serve_static('img/' + img_fname, binary=True)
+        img_fname = req.get('src', [''])[0]
+        return self.serve_static(req, 'img/' + img_fname, IMG_MAX_AGE)
 
-    def serve_static(self, fname, binary=False):
-        mode = 'rb' if binary else 'r'
-        with open('/home/pi/godenerg/axpert/static/' + fname, mode) as fr:
-            if binary:
-                return fr.read()
-            return fr.read().encode('utf-8')
+    def serve_static(self, req, fname, max_age=0):
+        '''
+        `fname` out of the static assets, gzipped if the client takes it.
+        Urls versioned with the current content hash are cached for good,
+        the rest for `max_age` or revalidated against the ETag.
+        '''
+        try:
+            asset = self.assets.get(fname)
+        except KeyError:
+            return self.send_error(404, 'No such file')
+        except Exception as e:
+            self.log.exception(e)
+            return self.send_error(500)
 
+        if req.get('v', [None])[0] == asset.digest:
+            cache_control = IMMUTABLE
+        elif max_age:
+            cache_control = 'public, max-age={:d}'.format(max_age)
+        else:
+            cache_control = 'no-cache'
+
+        body, etag, headers = asset.body, '"{}"'.format(asset.digest), []
+        if asset.gzipped:
+            headers.append(('Vary', 'Accept-Encoding'))
+            if accepts_gzip(self.headers.get('Accept-Encoding')):
+                body, etag = asset.gzipped, '"{}-gz"'.format(asset.digest)
+                headers.append(('Content-Encoding', 'gzip'))
+        return self.send_cached(
+            body, etag, asset.mtime, asset.ctype, cache_control, headers
+        )
 
     @json_response
     def weather(self, req):
         return get_weather_stats(self.log)
 
+    @staticmethod
+    def broker_gauges(stats):
+        scheduler = stats.get('scheduler', {})
+        gauges = {
+            'coalesced_callers': stats.get('coalesced', 0),
+            'in_flight_commands': stats.get('in_flight', 0),
+            'queue_depth': scheduler.get('queue_depth', 0),
+            'budget_wait_seconds': scheduler.get('budget_wait', 0)
+        }
+        for label, values in scheduler.get('classes', {}).items():
+            for key, value in values.items():
+                gauges['queue_{}_{}'.format(label, key)] = value
+        return gauges
+
+    @json_response
+    def metrics_json(self, req):
+        return {
+            'link': self.comms_executor.telemetry(),
+            'broker': self.comms_executor.stats(),
+            'database': self.comms_executor.fetch(DB_STATS) or {}
+        }
 
     @json_response
+    def rolling(self, req):
+        '''
+        Rolling stats published by the datalogger, per column and window:
+            * Req: /rolling
+            * Res: {"batt_volt": {"300": {"avg": ..., "slope": ...}}, ...}
+        '''
+        return self.comms_executor.fetch(ROLLING) or {}
+
+    def stream(self, req):
+        '''
+        Status and operation mode samples as Server-Sent Events, pushed
+        as the datalogger takes them (same cmd and merge as /cmds):
+            * Req: /stream?cmd=status&cmd=operation_mode&merge=1
+            * Res: event: sample, data: {...} every new sample
+        '''
+        names = req.get('cmd', ['status', 'operation_mode'])
+        unknown = set(names) - set(self.cmds)
+        if unknown:
+            return self.send_error(
+                400, 'Unknown commands {}'.format(', '.join(unknown))
+            )
+        if not self.events or not hasattr(self.server, 'detach'):
+            return self.send_error(503, 'Live stream not available')
+
+        self.send_response(200)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.server.detach(self.request)
+        self.events.subscribe(
+            self.request, names, req.get('merge', ['0'])[0] == '1'
+        )
+
+    @html_response(ctype='text/plain; version=0.0.4')
+    def metrics(self, req):
+        gauges = self.broker_gauges(self.comms_executor.stats())
+        for key, value in (self.comms_executor.fetch(DB_STATS) or {}).items():
+            gauges['db_' + key] = value
+        for key, value in getattr(self.server, 'stats', {}).items():
+            gauges['http_' + key] = value
+        if self.snapshot:
+            for key, value in self.snapshot.stats.items():
+                gauges['snapshot_' + key] = value
+        return prometheus_text(
+            self.comms_executor.telemetry() or
+            {'counters': {}, 'histograms': {}},
+            gauges
+        ).encode()
+
+
     def get_cmds(self, req):
         '''
         - Get two commands as json in two separated
@@ -158,23 +558,35 @@ class BaseRemoteCommandsHandler(BaseGodenergHandler):
           response will be merge into the same output dictionary.
             * Req: /cmds?cmd=info&cmd=operation_mode&merge=1
             * Res: {...}
+
+        Answered out of the datalogger snapshot when it has every
+        command, as the same bytes until the next sample, with an ETag
+        and a Last-Modified of the sample time (304 if unchanged).
         '''
+        names = req.get('cmd')
+        merge = 'merge' in req and req['merge'][0] == '1'
+        snapshot = self.snapshot.fresh() if self.snapshot and names \
+            else None
+        if snapshot and all(snapshot[2].get(name) for name in names):
+            seq, acquired, sample = snapshot
+            body, etag = self.encoded.get(seq, sample, names, merge)
+            return self.send_cached(
+                body, etag, acquired, ctype='application/json'
+            )
+        return self.execute_cmds(req, snapshot)
+
+    @json_response
+    def execute_cmds(self, req, snapshot=None):
         if 'cmd' not in req or not req:
             raise KeyError(
                 'Missing param "cmd" in querystring or value for param'
             )
 
+        data = {
+            cmd_name: self.execute_cmd(cmd_name, snapshot)
+            for cmd_name in req['cmd']
+        }
         # If we are ask to merge (merge=1 in QS) or we have a single command.
-        if ('merge' in req and req['merge'][0] == '1') or len(req['cmd']) == 1:
-            data = (self.execute_cmd(cmd) for cmd in req['cmd'])
-            return reduce(
-                lambda merged, item: \
-                    merged.update(item if item else {}) or merged,
-                data, {}
-            )
-
-        else:
-            return {
-                cmd_name: self.execute_cmd(cmd_name) or {}
-                for cmd_name in req['cmd']
-            }
+        return merge_cmds(
+            data, req['cmd'], 'merge' in req and req['merge'][0] == '1'
+        )
@@ -7,8 +7,8 @@ from signal import SIGKILL
 from urllib.request import urlopen
 from urllib.error import HTTPError
 from functools import partial
-from time import sleep, time
-from multiprocessing import Process, Lock
+from time import sleep
+from multiprocessing import Process
 from threading import Thread, Event
 from datetime import datetime
 
@@ -19,17 +19,24 @@ root_dir = os.path.abspath(os.path.join(curr_dir, '..'))
 if root_dir not in sys.path:
     sys.path.append(root_dir)
 
-from axpert.settings import http_conf, logger_conf, datalogger_conf
+from axpert.settings import (
+    http_conf, logger_conf, datalogger_conf, broker_conf
+)                                                               # noqa
 from axpert.connector import resolve_connector                  # noqa
 from axpert.cmd_parser import parse_args                        # noqa
 from axpert.http_handler import http_server_create              # noqa
 from axpert.charger import manual_charger                       # noqa
+from axpert.broker import (
+    broker_create, wait_for_broker, BrokerClient
+)                                                               # noqa
+from axpert.scheduler import CHARGER, DATALOGGER, HTTP          # noqa
 from axpert.protocol import (
-    CMD_REL, execute, Status, Response, CmdSpec
+    CMD_REL, execute, Status, CmdSpec
 )                                                               # noqa
 from axpert.datalogger import (
-    datalogger_create, get_range, DT_FORMAT,
-    get_last_data_datetime, datalogger_http_server_create
+    datalogger_create, DT_FORMAT, get_last_data_datetime,
+    datalogger_http_server_create, iter_range, export_chunks, encode_chunks,
+    txt_dt_to_int
 )                                                               # noqa
 
 MAX_RETRIES_FAILS = 1
@@ -41,8 +48,6 @@ WATCHDOG_MAX_TIMEOUT = 20
 WATCHDOG_INTERVAL = 40
 MAX_CONNECTOR_ACQUIRE_TIME = 10
 
-CMDS_CACHE = {}
-
 class ShutdownDaemonAndRestart(Exception):
     pass
 
@@ -66,6 +71,9 @@ def run_cmd(args):
         elif response.status == Status.KO:
             log.error("Command not understood by inverter:")
             log.error(response.data)
+        elif response.status == Status.BF:
+            log.error("Corrupted response from inverter:")
+            log.error(response.error)
 
 
 def start_http_server(comms_executor):
@@ -101,6 +109,19 @@ def start_datalogger(comms_executor):
     return datalogger
 
 
+def start_broker(connector):
+    log.info('Starting inverter broker')
+    process = Process(
+        target=broker_create,
+        args=[log, connector, broker_conf['address']]
+    )
+    process.start()
+    if not wait_for_broker(broker_conf['address']):
+        log.error('Inverter broker not listening yet')
+    log.info('Started inverter broker')
+    return process
+
+
 def start_datalogger_http():
     log.info('Starting data logger HTTP Server')
     datalogger_http = Process(
@@ -112,32 +133,6 @@ def start_datalogger_http():
     return datalogger_http
 
 
-def atomic_execute(comms_lock, connector, cmd):
-    acquired_lock = False
-    try:
-        now = time()
-        key = str(cmd.code + cmd.val)
-        if key in CMDS_CACHE and CMDS_CACHE[key]['last'] > (time() - 1):
-            return CMDS_CACHE[key]['res']
-
-        acquired_lock = comms_lock.acquire(timeout=5)
-        if not acquired_lock:
-            return Response(status=Status.KO, data=None)
-
-        CMDS_CACHE[key] = {
-            'res': execute(log, connector, cmd),
-            'last': time()
-        }
-        return CMDS_CACHE[key]['res']
-
-    except Exception as e:
-        log.exception(e)
-
-    finally:
-        if acquired_lock:
-            comms_lock.release()
-
-
 def watchdog_http_server(fail_event):
     if not fail_event.is_set():
         try:
@@ -161,8 +156,10 @@ def watchdog_datalogger_server(fail_event):
     last_dt = get_last_data_datetime(log)
     now = datetime.now()
     delta = (now - last_dt).total_seconds()
-    datalogger_interval = datalogger_conf['interval']
-    if delta > (datalogger_interval * 2):
+    # Samples reach the database in batches, allow for the commit delay
+    max_delta = datalogger_conf['interval'] * 2 \
+        + datalogger_conf['commit_interval']
+    if delta > max_delta:
         fail_event.set()
 
 
@@ -251,20 +248,27 @@ def run_as_daemon(daemon, args, connector=None):
     log.info('Starting Godenerg as daemon')
     http_server_fail_event = Event()        # Thread Event
     datalogger_server_fail_event = Event()  # Thread Event
-    comms_lock = Lock()                     # Process Lock
     try:
-        comms_executor = partial(
-            atomic_execute, comms_lock, connector
-        )
+        # The broker process owns the connector, every other process
+        # talks to the inverter through it (see axpert.broker)
+        broker = start_broker(connector)
+        address = broker_conf['address']
 
         # The starters are passed later on to the process checker
         # I curry the started calls to be able to have a generic
         # process checker that know nothing about the start parameters
         # (see check_process fnx)
-        http_server_start = partial(start_http_server, comms_executor)
-        datalogger_server_start = partial(start_datalogger, comms_executor)
+        # Each process gets a broker client with its scheduling priority
+        http_server_start = partial(
+            start_http_server, BrokerClient(address, priority=HTTP)
+        )
+        datalogger_server_start = partial(
+            start_datalogger, BrokerClient(address, priority=DATALOGGER)
+        )
         datalogger_http_server_start = partial(start_datalogger_http)
-        charger_start = partial(start_charger, comms_executor)
+        charger_start = partial(
+            start_charger, BrokerClient(address, priority=CHARGER)
+        )
 
         http_server = http_server_start()
         datalogger_server = datalogger_server_start()
@@ -277,6 +281,10 @@ def run_as_daemon(daemon, args, connector=None):
 
         restart_count_http, restart_count_datalogger = 0, 0
         while True:
+            if not broker.is_alive():
+                log.error('Inverter broker died')
+                raise ShutdownDaemonAndRestart()
+
             http_server, restart_count_http = check_process(
                 http_server, http_server_start, http_server_fail_event,
                 'HTTP Server', restart_count_http
@@ -293,6 +301,7 @@ def run_as_daemon(daemon, args, connector=None):
         kill_process(datalogger_server, 'Datalogger Server')
         kill_process(datalogger_http_server, 'Datalogger HTTP Server')
         kill_process(charger, 'Charger')
+        kill_process(broker, 'Inverter Broker')
         log.error('Restart all Locks, Events and Processes')
 
     except Exception as e:
@@ -322,12 +331,14 @@ def extract(args):
             _get_dt(extract_from), _get_dt(extract_to), extract_file
         )
     )
-    with open(extract_file, 'w') as fw:
-        content = get_range(
-            extract_from, extract_to, as_json=args['extract'] == 'json',
-            extract_cols=args['cols']
-        )
-        fw.write(content)
+    rows = iter_range(
+        txt_dt_to_int(extract_from), txt_dt_to_int(extract_to), args['cols']
+    )
+    chunks = export_chunks(rows, as_json=args['extract'] == 'json')
+    compress = args.get('gzip') or extract_file.endswith('.gz')
+    with open(extract_file, 'wb') as fw:
+        for data in encode_chunks(chunks, compress):
+            fw.write(data)
 
     log.info('File written successfuly')
 
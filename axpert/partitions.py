@@ -0,0 +1,168 @@
+from collections import OrderedDict
+from datetime import datetime
+from os import listdir, unlink
+from os.path import basename, dirname, exists, splitext
+
+"""
+Monthly partitions of the stats table. Every month lives in its own
+database file next to the main one (godenerg-201801.db for January 2018
+of godenerg.db), attached on demand to the connection asking for it, so
+index maintenance, vacuums and backups only deal with one month at a
+time. The main database keeps everything else, plus any stats rows
+written before partitioning was enabled.
+
+Readers in other processes keep partitions attached to their long lived
+connections, a partition file can only go once they let it go. The
+database runs in WAL mode and sqlite removes the -shm file when the last
+connection to it closes, so a partition with one left is kept for now.
+"""
+
+MONTH_FORMAT = '%Y%m'
+TABLE = 'stats'
+
+# sqlite refuses to attach more than 10 databases by default
+MAX_ATTACHED = 8
+
+
+def month_of(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime(MONTH_FORMAT)
+
+
+def month_start(month):
+    return int(datetime.strptime(month, MONTH_FORMAT).timestamp())
+
+
+def months_between(from_dt, to_dt):
+    first = datetime.fromtimestamp(from_dt)
+    last = datetime.fromtimestamp(to_dt)
+    year, month, months = first.year, first.month, []
+    while (year, month) <= (last.year, last.month):
+        months.append('{:04d}{:02d}'.format(year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return months
+
+
+def partition_path(db_filename, month):
+    base, ext = splitext(db_filename)
+    return '{}-{}{}'.format(base, month, ext)
+
+
+def main_db_filename(db_conn):
+    for _, name, filename in db_conn.execute('PRAGMA database_list'):
+        if name == 'main':
+            return filename
+
+
+class Partitions(object):
+    '''
+    Monthly stats partitions of the database `db_conn` is connected to.
+    In memory databases have no partitions.
+    '''
+
+    def __init__(self, db_conn, cols=None, indexes=()):
+        self.db_conn = db_conn
+        self.db_filename = main_db_filename(db_conn)
+        self.cols = cols
+        self.indexes = indexes
+        # Long lived connections may have partitions attached already
+        self.attached = OrderedDict(
+            (name[1:], name)
+            for _, name, _ in db_conn.execute('PRAGMA database_list')
+            if name.startswith('p') and name[1:].isdigit()
+        )
+
+    def months(self):
+        ''' Months with a partition file, oldest first '''
+        if not self.db_filename:
+            return []
+        base, ext = splitext(basename(self.db_filename))
+        prefix, months = base + '-', []
+        for fname in listdir(dirname(self.db_filename) or '.'):
+            name, fext = splitext(fname)
+            month = name[len(prefix):]
+            if name.startswith(prefix) and fext == ext and month.isdigit() \
+                    and len(month) == 6:
+                months.append(month)
+        return sorted(months)
+
+    def create_table(self, schema):
+        self.db_conn.execute('CREATE TABLE IF NOT EXISTS {}.{} ({})'.format(
+            schema, TABLE, ', '.join('{} {}'.format(*col) for col in self.cols)
+        ))
+        for col in self.indexes:
+            self.db_conn.execute(
+                'CREATE INDEX IF NOT EXISTS {schema}.idx_{tab}_{col} ON '
+                '{tab} (datetime, {col})'.format(
+                    schema=schema, tab=TABLE, col=col
+                )
+            )
+
+    def attach(self, month, create=False):
+        '''
+        Schema name of the partition of `month`, attaching it if needed.
+        None if there is no such partition and we are not asked to create
+        it. Must be called outside of transactions.
+        '''
+        if month in self.attached:
+            self.attached.move_to_end(month)
+            return self.attached[month]
+
+        if not self.db_filename:
+            return None
+        path = partition_path(self.db_filename, month)
+        if not create and not exists(path):
+            return None
+
+        while len(self.attached) >= MAX_ATTACHED:
+            self.detach(next(iter(self.attached)))
+
+        schema = 'p' + month
+        self.db_conn.execute('ATTACH DATABASE ? AS {}'.format(schema), [path])
+        self.attached[month] = schema
+        if create:
+            self.create_table(schema)
+            # Same journal as the main database, WAL is kept by the file
+            mode, = self.db_conn.execute('PRAGMA main.journal_mode').fetchone()
+            self.db_conn.execute(
+                'PRAGMA {}.journal_mode = {}'.format(schema, mode)
+            )
+        return schema
+
+    def detach(self, month):
+        schema = self.attached.pop(month)
+        self.db_conn.execute('DETACH DATABASE {}'.format(schema))
+
+    def table(self, month, create=False):
+        schema = self.attach(month, create)
+        return '{}.{}'.format(schema, TABLE) if schema else None
+
+    def tables(self, from_dt=None, to_dt=None):
+        '''
+        Yields the main stats table and then every partition overlapping
+        the range, oldest first. Partitions are attached one at a time,
+        each table is to be read before asking for the next one.
+        '''
+        yield 'main.{}'.format(TABLE)
+        months = self.months()
+        if from_dt is not None:
+            overlapping = months_between(from_dt, to_dt)
+            months = [month for month in months if month in overlapping]
+        for month in months:
+            table = self.table(month)
+            if table:
+                yield table
+
+    def drop(self, month):
+        '''
+        Removes the partition file of `month`, False if some other
+        connection still has it open and it has to be dropped later.
+        '''
+        if month in self.attached:
+            self.detach(month)
+        path = partition_path(self.db_filename, month)
+        if exists(path + '-shm'):
+            return False
+        for suffix in ('', '-journal', '-wal'):
+            if exists(path + suffix):
+                unlink(path + suffix)
+        return True
@@ -1,15 +1,20 @@
 from collections import namedtuple
 from json import dumps as json_dumps
-from struct import pack
-from crc16 import crc16xmodem
 from enum import IntEnum
 
+from axpert.codec import (
+    request_frame, validate_response, to_text, FrameError, TerminatorError
+)
+from axpert.telemetry import telemetry
+
 """
 """
 
 
 CmdSpec = namedtuple('CmdSpec', ['code', 'size', 'val', 'json'])
-Response = namedtuple('Response', ['status', 'data'])
+Response = namedtuple(
+    'Response', ['status', 'data', 'error'], defaults=[None]
+)
 InverterConf = namedtuple('Inverter', ['bulk_volt', 'float_volt'])
 
 SOLAR_CHARGING = 'solar_charging'
@@ -22,6 +27,11 @@ class Status(IntEnum):
     OK = 1
     KO = 2
     NN = 3
+    BF = 4  # Bad frame, wrong terminator or CRC
+
+
+def is_query(cmd):
+    return cmd.code.startswith('Q')
 
 
 def empty_inverter_conf():
@@ -41,10 +51,7 @@ def parse_inverter_conf(data):
 
 
 def execute(log, connector, cmd):
-    value = cmd.val if cmd.val else ''
-    encoded_cmd = cmd.code.encode() + value.encode()
-    checksum = crc16xmodem(encoded_cmd)
-    request = encoded_cmd + pack('>H', checksum) + b'\r'
+    request = request_frame(cmd.code, cmd.val)
 
     log.debug(
         'Request {} done as "{}"'.format(
@@ -54,15 +61,60 @@ def execute(log, connector, cmd):
 
     # No commands take more than 16 bytes
     # Take first 8 and second 8 if any
-    connector.write(request[:8])
-    if len(request) > 8:
-        connector.write(request[8:])
+    with telemetry.timer('write', cmd.code):
+        connector.write(request[:8])
+        if len(request) > 8:
+            connector.write(request[8:])
+
+    with telemetry.timer('read', cmd.code):
+        response = connector.read(int(cmd.size))
+
+    with telemetry.timer('parse', cmd.code):
+        return parse_response(log, cmd, response)
+
+
+async def async_execute(log, connector, cmd):
+    ''' Same as execute but for an AsyncConnector '''
+    request = request_frame(cmd.code, cmd.val)
+    log.debug('Request {} done as "{}"'.format(cmd, request))
+
+    with telemetry.timer('write', cmd.code):
+        await connector.write(request[:8])
+        if len(request) > 8:
+            await connector.write(request[8:])
 
-    response = connector.read(int(cmd.size))
+    with telemetry.timer('read', cmd.code):
+        response = await connector.read(int(cmd.size))
+
+    with telemetry.timer('parse', cmd.code):
+        return parse_response(log, cmd, response)
+
+
+def parse_response(log, cmd, response):
     log.debug('Response from connector to {} is:'.format(cmd))
     log.debug(response)
 
-    return Response(data=response, status=parse_response_status(response))
+    telemetry.incr('exchanges', cmd.code)
+    if not response:
+        telemetry.incr('empty_reads', cmd.code)
+        return Response(data=response, status=Status.NN)
+
+    try:
+        validate_response(response)
+    except FrameError as e:
+        log.error('Bad frame in response to {}: {}'.format(cmd.code, e))
+        # A frame without terminator means the read deadline was hit
+        telemetry.incr(
+            'timeouts' if isinstance(e, TerminatorError) else 'crc_errors',
+            cmd.code
+        )
+        return Response(data=None, status=Status.BF, error=e)
+
+    response = to_text(response)
+    status = parse_response_status(response)
+    if status == Status.KO:
+        telemetry.incr('naks', cmd.code)
+    return Response(data=response, status=status)
 
 
 def parse_response_status(data):
@@ -96,55 +148,73 @@ def parse_device_status(raw_status):
     }
 
 
-def typer(frmt):
+def clean_token(fnx):
+    def _inner(txt):
+        return fnx(txt) if txt and txt != 'NA' else fnx(0)
+    return _inner
 
-    def _clean_val(val):
-        if not val or val=='NA':
-            return 0
-        else:
-            return val
 
-    types = {'s': str, 'f': float, 'd': int}
+to_float = clean_token(lambda txt: round(float(txt), 2))
+to_int = clean_token(int)
+to_str = clean_token(str)
 
-    for frm, type_fnx in types.items():
-        if frm in frmt:
-            return lambda txt: type_fnx(frmt % type_fnx(_clean_val(txt)))
 
-    return lambda txt: txt % frmt
+def frame_payload(raw):
+    # Ignore initial '(' and the CRC + '\r' (plus any padding) at the end
+    end = raw.find('\r')
+    return raw[1:end - 2] if end > 2 else raw[1:]
 
 
-def status_json_formatter(raw, serialize=True):
-    to_float = typer('%.2f')
-    to_int = typer('%d')
-    to_str = typer('%s')
-
-    structure = (
-        ('grid_volt', to_float), ('grid_freq', to_float),
-        ('ac_volt', to_float), ('ac_freq', to_float),
-        ('ac_va', to_int), ('ac_watt', to_int),
-        ('load_percent', to_int), ('bus_volt', to_int),
-        ('batt_volt', to_float), ('batt_charge_amps', to_int),
-        ('batt_capacity', to_int), ('temp', to_int),
-        ('pv_amps', to_int), ('pv_volts', to_float),
-        ('batt_volt_scc', to_float), ('batt_discharge_amps', to_int),
-        ('raw_status', to_str),
-        ('mask_b', to_str), ('mask_c', to_str),
-        ('pv_watts', to_int), ('mask_d', to_str)
-    )
+def compile_parser(name, fields):
+    '''
+    Builds, once, a parser turning a space separated response frame into
+    a namedtuple record with the given fields. Returns None for frames
+    with missing tokens.
+    '''
+    record = namedtuple(name, [label for label, _ in fields])
+    converters = tuple(converter for _, converter in fields)
+    size = len(converters)
 
-    if not raw:
-        return None
+    def _parse(raw):
+        if not raw:
+            return None
+        tokens = frame_payload(raw).split(' ')
+        if len(tokens) < size:
+            return None
+        return record._make(
+            [converter(token) for converter, token in zip(converters, tokens)]
+        )
 
-    # Ignore initial '(' and end 5 byte split
-    raw_tokens = raw[1:-5].split(' ')
-    data = {
-        label: formatter(token)
-        for (label, formatter), token in zip(structure, raw_tokens)
-    }
+    _parse.record = record
+    return _parse
 
-    struct = {
-        **data, **parse_device_status(data.get('raw_status', '00000000'))
-    }
+
+# Labels match the columns of the datalogger stats table
+STATUS_FIELDS = (
+    ('grid_volt', to_float), ('grid_freq', to_float),
+    ('ac_volt', to_float), ('ac_freq', to_float),
+    ('ac_va', to_int), ('ac_watt', to_int),
+    ('load_percent', to_int), ('bus_volt', to_int),
+    ('batt_volt', to_float), ('batt_charge_amps', to_int),
+    ('batt_capacity', to_int), ('temp', to_int),
+    ('pv_amps', to_int), ('pv_volts', to_float),
+    ('batt_volt_scc', to_float), ('batt_discharge_amps', to_int),
+    ('raw_status', to_str),
+    ('mask_b', to_str), ('mask_c', to_str),
+    ('pv_watts', to_int), ('mask_d', to_str)
+)
+
+parse_status = compile_parser('StatusRecord', STATUS_FIELDS)
+StatusRecord = parse_status.record
+
+
+def status_json_formatter(raw, serialize=True):
+    record = parse_status(raw)
+    if not record:
+        return None
+
+    struct = record._asdict()
+    struct.update(parse_device_status(record.raw_status))
     return json_dumps(struct) if serialize else struct
 
 
@@ -0,0 +1,134 @@
+from collections import deque
+from math import exp
+
+"""
+Rolling statistics kept at ingest time by the datalogger. Every sample
+updates them in amortized O(1), readers get the published snapshot
+without touching the database.
+"""
+
+# Name the snapshot is published under in the broker
+ROLLING = 'rolling'
+
+
+class RollingWindow(object):
+    '''
+    Sum, count, min, max, EWMA and least squares slope (units per second)
+    of a value over the last `seconds`.
+    '''
+
+    def __init__(self, seconds, tau=None):
+        self.seconds = seconds
+        self.tau = tau or seconds
+        self.samples = deque()
+        # Monotonic deques, their heads are the window min / max
+        self.mins = deque()
+        self.maxs = deque()
+        self.ewma = None
+        self.last_t = None
+        self.rebase(None)
+
+    def rebase(self, origin):
+        '''
+        Timestamps are summed relative to an origin to keep the slope
+        sums small, it is moved forward every now and then.
+        '''
+        self.origin = origin
+        self.sum = self.sum_t = self.sum_tt = self.sum_tv = 0.0
+        for t, value in self.samples:
+            self.accumulate(t, value, 1)
+
+    def accumulate(self, t, value, sign):
+        rel_t = t - self.origin
+        self.sum += sign * value
+        self.sum_t += sign * rel_t
+        self.sum_tt += sign * rel_t * rel_t
+        self.sum_tv += sign * rel_t * value
+
+    def add(self, t, value):
+        if self.origin is None:
+            self.origin = t
+
+        self.samples.append((t, value))
+        self.accumulate(t, value, 1)
+
+        while self.mins and self.mins[-1][1] >= value:
+            self.mins.pop()
+        self.mins.append((t, value))
+        while self.maxs and self.maxs[-1][1] <= value:
+            self.maxs.pop()
+        self.maxs.append((t, value))
+
+        if self.ewma is None:
+            self.ewma = value
+        else:
+            alpha = 1 - exp(-(t - self.last_t) / self.tau)
+            self.ewma += alpha * (value - self.ewma)
+        self.last_t = t
+
+        self.evict(t)
+
+    def evict(self, now):
+        oldest = now - self.seconds
+        while self.samples and self.samples[0][0] <= oldest:
+            t, value = self.samples.popleft()
+            self.accumulate(t, value, -1)
+        while self.mins and self.mins[0][0] <= oldest:
+            self.mins.popleft()
+        while self.maxs and self.maxs[0][0] <= oldest:
+            self.maxs.popleft()
+
+        if self.samples and (now - self.origin) > self.seconds * 4:
+            self.rebase(self.samples[0][0])
+
+    def slope(self):
+        count = len(self.samples)
+        denominator = count * self.sum_tt - self.sum_t * self.sum_t
+        if count < 2 or denominator <= 0:
+            return 0.0
+        return (count * self.sum_tv - self.sum_t * self.sum) / denominator
+
+    def snapshot(self):
+        count = len(self.samples)
+        return {
+            'count': count,
+            'sum': self.sum,
+            'avg': self.sum / count if count else None,
+            'min': self.mins[0][1] if self.mins else None,
+            'max': self.maxs[0][1] if self.maxs else None,
+            'ewma': self.ewma,
+            'slope': self.slope(),
+            # Tells how much of the window is covered yet
+            'oldest': self.samples[0][0] if self.samples else None
+        }
+
+
+class RollingStats(object):
+    ''' RollingWindow for each configured column and window length '''
+
+    def __init__(self, cols, windows):
+        self.windows = {
+            col: {seconds: RollingWindow(seconds) for seconds in windows}
+            for col in cols
+        }
+        self.last = None
+
+    def add(self, t, data):
+        self.last = t
+        for col, windows in self.windows.items():
+            value = data.get(col)
+            if value is None:
+                continue
+            for window in windows.values():
+                window.add(t, value)
+
+    def snapshot(self):
+        stats = {
+            col: {
+                seconds: window.snapshot()
+                for seconds, window in windows.items()
+            }
+            for col, windows in self.windows.items()
+        }
+        stats['datetime'] = self.last
+        return stats
@@ -0,0 +1,170 @@
+from heapq import heappush, heappop
+from itertools import count
+from threading import Thread, Condition, Event
+from time import monotonic
+
+from axpert.settings import broker_conf
+from axpert.protocol import Response, Status
+from axpert.codec import request_frame
+from axpert.connector import BAUD_RATE, BITS_PER_BYTE
+from axpert.telemetry import telemetry
+
+"""
+Single queue in front of the connector. Commands are served one at a
+time by priority class, dropped when their deadline passes while still
+queued, and paced so the bytes sent and received stay within a budget
+of the link bandwidth.
+"""
+
+# Priority classes, lower is served first
+WRITE, CHARGER, DATALOGGER, HTTP = 0, 1, 2, 3
+
+PRIORITIES = {
+    WRITE: 'write', CHARGER: 'charger', DATALOGGER: 'datalogger', HTTP: 'http'
+}
+
+DEADLINES = {WRITE: 10, CHARGER: 5, DATALOGGER: 4, HTTP: 5}
+
+# Extra time a caller waits on top of its deadline for the exchange
+EXCHANGE_TIMEOUT = 10
+
+LINK_RATE = BAUD_RATE / BITS_PER_BYTE * broker_conf['link_budget']
+
+
+def frame_cost(cmd):
+    return len(request_frame(cmd.code, cmd.val)) + int(cmd.size)
+
+
+class LinkBudget(object):
+    ''' Token bucket of bytes per second, bursts of up to a second '''
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = rate
+        self.tokens = rate
+        self.last = monotonic()
+
+    def refill(self):
+        now = monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.last) * self.rate
+        )
+        self.last = now
+
+    def wait_time(self, cost):
+        self.refill()
+        missing = min(cost, self.capacity) - self.tokens
+        return missing / self.rate if missing > 0 else 0
+
+    def consume(self, cost):
+        self.refill()
+        self.tokens -= min(cost, self.capacity)
+
+
+class Job(object):
+
+    def __init__(self, cmd, priority, deadline):
+        self.cmd = cmd
+        self.priority = priority
+        self.deadline = deadline
+        self.enqueued = monotonic()
+        self.done = Event()
+        self.response = None
+
+
+class CommandScheduler(object):
+
+    def __init__(self, log, run, rate=LINK_RATE):
+        self.log = log
+        self.run = run
+        self.budget = LinkBudget(rate)
+        self.queue = []
+        self.seq = count()
+        self.cond = Condition()
+        self.budget_wait = 0.0
+        self.classes = {
+            priority: dict(served=0, expired=0, wait_total=0.0, wait_max=0.0)
+            for priority in PRIORITIES
+        }
+        Thread(target=self.serve_forever, daemon=True).start()
+
+    def submit(self, cmd, priority=HTTP, timeout=None):
+        timeout = timeout or DEADLINES[priority]
+        job = Job(cmd, priority, monotonic() + timeout)
+        with self.cond:
+            heappush(self.queue, (priority, next(self.seq), job))
+            self.cond.notify()
+
+        if not job.done.wait(timeout + EXCHANGE_TIMEOUT):
+            return Response(status=Status.KO, data=None)
+        return job.response
+
+    def next_job(self):
+        with self.cond:
+            while True:
+                if not self.queue:
+                    self.cond.wait()
+                    continue
+
+                job = self.queue[0][-1]
+                delay = self.budget.wait_time(frame_cost(job.cmd))
+                if delay <= 0 or job.deadline <= monotonic():
+                    return heappop(self.queue)[-1]
+
+                # Out of budget, wait for it or for a more urgent job
+                self.budget_wait += delay
+                self.cond.wait(delay)
+
+    def serve(self, job):
+        stats = self.classes[job.priority]
+        waited = monotonic() - job.enqueued
+        stats['wait_total'] += waited
+        stats['wait_max'] = max(stats['wait_max'], waited)
+        telemetry.observe('lock_wait', job.cmd.code, waited)
+
+        try:
+            if job.deadline <= monotonic():
+                stats['expired'] += 1
+                telemetry.incr('lock_timeouts', job.cmd.code)
+                self.log.error('Command {} expired in queue after {:.2f}s'
+                               .format(job.cmd.code, waited))
+                job.response = Response(status=Status.KO, data=None)
+                return
+
+            self.budget.consume(frame_cost(job.cmd))
+            job.response = self.run(job.cmd)
+            stats['served'] += 1
+
+        except Exception as e:
+            self.log.exception(e)
+            job.response = Response(status=Status.KO, data=None)
+
+        finally:
+            job.done.set()
+
+    def serve_forever(self):
+        while True:
+            self.serve(self.next_job())
+
+    def stats(self):
+        with self.cond:
+            queued = [job.priority for _, _, job in self.queue]
+
+        classes = {}
+        for priority, label in PRIORITIES.items():
+            stats = self.classes[priority]
+            handled = stats['served'] + stats['expired']
+            classes[label] = {
+                'queued': queued.count(priority),
+                'served': stats['served'],
+                'expired': stats['expired'],
+                'wait_avg': stats['wait_total'] / handled if handled else 0,
+                'wait_max': stats['wait_max']
+            }
+
+        return {
+            'queue_depth': len(queued),
+            'link_rate': self.budget.rate,
+            'budget_wait': self.budget_wait,
+            'classes': classes
+        }
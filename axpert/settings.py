@@ -7,7 +7,14 @@ logger_conf = {
 }
 
 http_conf = {
-    'port': 8889
+    'port': 8889,
+    # Both http servers answer from a pool of workers, slow routes get
+    # at most slow_workers of them. Past queue_size waiting requests the
+    # server answers 503.
+    'workers': 8,
+    'slow_workers': 2,
+    'queue_size': 32,
+    'request_timeout': 10
 }
 
 
@@ -16,7 +23,36 @@ datalogger_conf = {
     'interval': 15,
     'last_interval': 2,
     'samples': 7200,
-    'port': 8890
+    'port': 8890,
+    # Group commit, flush every commit_rows or commit_interval seconds
+    'commit_rows': 60,
+    'commit_interval': 30,
+    'synchronous': 'NORMAL',
+    # Busy timeout of the writer, WAL checkpoints run by it every
+    # checkpoint_interval seconds (truncating past that many pages)
+    'write_timeout': 10,
+    'checkpoint_interval': 300,
+    'checkpoint_truncate_pages': 4000,
+    # Samples are appended to spool_dir before reaching the database,
+    # fsync on every sample to survive power loss too
+    'spool_dir': APP_PATH + 'spool/',
+    'spool_fsync': False,
+    # Shared memory block with the latest sample, /cmds answers from it
+    # while it is at most snapshot_max_age seconds old
+    'snapshot_name': 'godenerg_live',
+    'snapshot_max_age': 5,
+    # Rolling statistics kept at ingest, window lengths in seconds
+    'rolling_cols': ['batt_volt', 'batt_charge_amps', 'pv_watts'],
+    'rolling_windows': [300, 1800],
+    # Days older than archive_keep_days move out of sqlite into archive_dir
+    'archive_dir': APP_PATH + 'archive/',
+    'archive_keep_days': 7,
+    'archive_check_interval': 3600,
+    # Write stats to one database file per month next to db_filename
+    'partition_by_month': True,
+    # Page cache of the long lived read connections
+    'read_mmap_size': 64 * 1024 * 1024,
+    'read_cache_kib': 8192
 }
 
 charger_conf = {
@@ -35,3 +71,11 @@ weather_api_conf = {
     'lng': '2.9024177',
     'api_key_file': APP_PATH + 'apixu_api_key.txt'
 }
+
+broker_conf = {
+    'address': APP_PATH + 'godenerg.sock',
+    'cache_ttl': 1,
+    'start_timeout': 5,
+    # Share of the link bandwidth the scheduler may use
+    'link_budget': 0.9
+}
@@ -0,0 +1,275 @@
+import logging
+import os
+import sys
+import tty
+
+from argparse import ArgumentParser
+from datetime import datetime
+from math import sin, pi
+from random import Random
+from struct import pack
+from time import sleep, monotonic
+
+curr_dir = os.path.dirname(os.path.realpath(__file__))
+root_dir = os.path.abspath(os.path.join(curr_dir, '..'))
+
+if root_dir not in sys.path:
+    sys.path.append(root_dir)
+
+from crc16 import crc16xmodem                                    # noqa
+from axpert.codec import (
+    validate_response, reserved_crc, FrameError, TERMINATOR
+)                                                               # noqa
+from axpert.connector import BAUD_RATE, BITS_PER_BYTE           # noqa
+from axpert.settings import charger_conf                        # noqa
+
+"""
+Simulated Axpert inverter served on a pseudo terminal, so the serial
+connector and the daemon can be exercised end to end without hardware:
+
+    $> python3 axpert/simulator.py --profile cloudy --speed 60
+    Simulated inverter on /dev/pts/3
+    $> python3 axpert/main.py --serial -d /dev/pts/3 --daemon
+
+Answers QPIGS, QPIRI, QMOD, QDI and PBFT with valid CRCs, following a
+physical profile of the PV input and a simple battery model. Latency,
+baud rate, dropped bytes and NAKs are configurable.
+"""
+
+PV_PEAK_WATTS = 3800
+LOAD_WATTS = 300
+MAX_CHARGE_AMPS = 60
+
+ACK, NAK = '(ACK', '(NAK'
+
+
+def sun(hour):
+    return max(0.0, sin(pi * (hour - 7) / 12))
+
+
+def clear_day(hour):
+    return sun(hour)
+
+
+def cloudy_day(hour):
+    clouds = 0.55 + 0.45 * sin(hour * 7.3) * sin(hour * 2.9)
+    return sun(hour) * min(1.0, max(0.1, clouds))
+
+
+PROFILES = {
+    # (pv factor by hour of the day, initial battery state of charge)
+    'clear': (clear_day, 0.8),
+    'cloudy': (cloudy_day, 0.8),
+    'charge': (clear_day, 0.3)
+}
+
+
+def response_frame(payload):
+    data = payload.encode()
+    crc = reserved_crc(crc16xmodem(data))
+    return data + pack('>H', crc) + TERMINATOR
+
+
+class Battery(object):
+    '''
+    Lead acid bank as an open circuit voltage growing with the state of
+    charge plus an internal resistance. Limiting the terminal voltage to
+    the charge target gives the tapering absorption current for free.
+    '''
+
+    EMPTY_VOLT, FULL_VOLT = 46.0, 56.0
+    RESISTANCE = 0.04
+
+    def __init__(self, soc, capacity_ah=550):
+        self.soc = soc
+        self.capacity_ah = capacity_ah
+        self.amps = 0.0
+
+    def rest_volt(self):
+        return self.EMPTY_VOLT + (self.FULL_VOLT - self.EMPTY_VOLT) * self.soc
+
+    def volt(self):
+        return self.rest_volt() + self.amps * self.RESISTANCE
+
+    def step(self, hours, available_amps, target_volt):
+        ceiling = (target_volt - self.rest_volt()) / self.RESISTANCE
+        self.amps = min(available_amps, MAX_CHARGE_AMPS, max(0.0, ceiling)) \
+            if available_amps > 0 else available_amps
+        self.soc += self.amps * hours / self.capacity_ah
+        self.soc = min(1.0, max(0.0, self.soc))
+
+
+class InverterSimulator(object):
+
+    def __init__(self, fd, profile='cloudy', baud=BAUD_RATE, latency=0.05,
+                 drop_rate=0.0, nak_rate=0.0, speed=1, start_hour=None,
+                 seed=None):
+        self.fd = fd
+        self.pv_factor, soc = PROFILES[profile]
+        self.battery = Battery(soc)
+        self.baud = baud
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.nak_rate = nak_rate
+        self.speed = speed
+        self.rng = Random(seed)
+        now = datetime.now()
+        self.start_hour = start_hour if start_hour is not None \
+            else now.hour + now.minute / 60
+        self.started = self.last = monotonic()
+        self.bulk_volt = charger_conf['absorbtion_voltage']
+        self.float_volt = charger_conf['float_voltage']
+        self.pv_watts = 0.0
+        self.handlers = {
+            'QPIGS': self.qpigs, 'QPIRI': self.qpiri, 'QMOD': self.qmod,
+            'QDI': self.qdi, 'PBFT': self.pbft
+        }
+
+    def hour(self):
+        elapsed = (monotonic() - self.started) * self.speed
+        return (self.start_hour + elapsed / 3600) % 24
+
+    def update(self):
+        now = monotonic()
+        hours = (now - self.last) * self.speed / 3600
+        self.last = now
+        self.pv_watts = PV_PEAK_WATTS * self.pv_factor(self.hour())
+        available_amps = (self.pv_watts - LOAD_WATTS) / self.battery.volt()
+        self.battery.step(hours, available_amps, self.float_volt)
+
+    def qpigs(self, val):
+        self.update()
+        battery = self.battery
+        charge = max(0, int(round(battery.amps)))
+        discharge = max(0, int(round(-battery.amps)))
+        pv_volts = 120.0 if self.pv_watts else 0.0
+        pv_amps = int(self.pv_watts / pv_volts) if pv_volts else 0
+        status = '00010110' if charge else '00010000'
+        return (
+            '(000.0 00.0 230.0 50.0 {va:04d} {load:04d} {load_pct:03d} 400 '
+            '{volt:05.2f} {charge:03d} {capacity:03d} 0045 {pv_amps:04d} '
+            '{pv_volts:05.1f} {scc_volt:05.2f} {discharge:05d} {status} '
+            '00 00 {pv_watts:05d} 010'
+        ).format(
+            va=int(LOAD_WATTS * 1.2), load=LOAD_WATTS,
+            load_pct=int(LOAD_WATTS / 50), volt=battery.volt(),
+            charge=charge, capacity=int(battery.soc * 100),
+            pv_amps=pv_amps, pv_volts=pv_volts,
+            scc_volt=battery.volt() if charge else 0.0,
+            discharge=discharge, status=status,
+            pv_watts=int(self.pv_watts)
+        )
+
+    def qpiri(self, val):
+        return (
+            '(230.0 21.7 230.0 50.0 21.7 5000 4000 48.0 46.0 42.0 '
+            '{bulk:.1f} {float:.1f} 2 02 060 0 2 3 1 01 0 0 54.0 0 1'
+        ).format(bulk=self.bulk_volt, float=self.float_volt)
+
+    def qmod(self, val):
+        return '(B'
+
+    def qdi(self, val):
+        return (
+            '(230.0 50.0 0030 42.0 54.0 56.4 46.0 60 0 0 2 0 0 0 0 0 1 1 '
+            '0 0 1 0 54.0 0 1 000'
+        )
+
+    def pbft(self, val):
+        try:
+            self.float_volt = float(val)
+            return ACK
+        except ValueError:
+            return NAK
+
+    def answer(self, request):
+        try:
+            payload = validate_response(request).decode()
+        except (FrameError, UnicodeDecodeError):
+            return NAK
+
+        if self.rng.random() < self.nak_rate:
+            return NAK
+
+        for code, handler in self.handlers.items():
+            if payload.startswith(code):
+                return handler(payload[len(code):])
+        return NAK
+
+    def send(self, payload):
+        frame = bytearray(response_frame(payload))
+        if self.drop_rate:
+            frame = bytearray(
+                byte for byte in frame if self.rng.random() >= self.drop_rate
+            )
+        sleep(self.latency)
+        for index in range(0, len(frame), 8):
+            chunk = frame[index:index + 8]
+            sleep(len(chunk) * BITS_PER_BYTE / self.baud)
+            os.write(self.fd, chunk)
+
+    def serve_forever(self):
+        pending = bytearray()
+        while True:
+            try:
+                pending += os.read(self.fd, 64)
+            except OSError:
+                # Nobody has the terminal open yet
+                sleep(0.1)
+                continue
+
+            end = pending.find(TERMINATOR)
+            while end >= 0:
+                request, pending = bytes(pending[:end + 1]), pending[end + 1:]
+                self.send(self.answer(request))
+                end = pending.find(TERMINATOR)
+
+
+def open_pty():
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    return master, slave, os.ttyname(slave)
+
+
+def parse_args():
+    parser = ArgumentParser(prog='simulator.py')
+    parser.add_argument(
+        '--profile', dest='profile', default='cloudy',
+        choices=sorted(PROFILES), help='PV and battery profile'
+    )
+    parser.add_argument(
+        '--baud', dest='baud', type=int, default=BAUD_RATE,
+        help='Simulated link speed'
+    )
+    parser.add_argument(
+        '--latency', dest='latency', type=float, default=0.05,
+        help='Seconds the inverter takes before answering'
+    )
+    parser.add_argument(
+        '--drop-rate', dest='drop_rate', type=float, default=0.0,
+        help='Probability of dropping each byte sent'
+    )
+    parser.add_argument(
+        '--nak-rate', dest='nak_rate', type=float, default=0.0,
+        help='Probability of answering NAK to a valid request'
+    )
+    parser.add_argument(
+        '--speed', dest='speed', type=float, default=1,
+        help='Simulated seconds per real second'
+    )
+    parser.add_argument(
+        '--start-hour', dest='start_hour', type=float, default=None,
+        help='Simulated hour of the day to start at'
+    )
+    return vars(parser.parse_args())
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    log = logging.getLogger('godenerg')
+    log.setLevel(logging.INFO)
+    log.addHandler(logging.StreamHandler(sys.stdout))
+
+    master, slave, slave_path = open_pty()
+    log.info('Simulated inverter on {}'.format(slave_path))
+    InverterSimulator(master, **args).serve_forever()
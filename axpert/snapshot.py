@@ -0,0 +1,144 @@
+from json import dumps as json_dumps, loads as json_loads
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from struct import pack_into, unpack_from, calcsize
+from threading import Lock
+from time import time, monotonic
+from zlib import crc32
+
+from axpert.settings import datalogger_conf
+
+"""
+Latest sample taken by the datalogger, in a shared memory block the http
+server reads without a round trip to the broker or the inverter. The
+block follows a seqlock layout:
+
+    seq       uint64, odd while the writer is half way through
+    acquired  float64, unix time the sample was taken at
+    length    uint32, bytes of payload
+    crc       uint32, crc32 of the payload
+    payload   JSON of {command name: parsed response}
+
+Readers copy the block and retry if seq was odd or changed meanwhile.
+Python gives no memory barriers, the crc catches what the sequence
+number alone could miss on weakly ordered CPUs.
+"""
+
+HEADER = '<QdII'
+HEADER_SIZE = calcsize(HEADER)
+SEQ = '<Q'
+SIZE = 4096
+READ_RETRIES = 64
+# A stale block may belong to a datalogger long gone, readers attach
+# again by name at most this often
+REATTACH_INTERVAL = 10
+SNAPSHOT_NAME = datalogger_conf['snapshot_name']
+SNAPSHOT_MAX_AGE = datalogger_conf['snapshot_max_age']
+
+
+def untrack(shm):
+    # Before 3.13 attaching registers the block to be unlinked when the
+    # process exits, the block has to outlive the datalogger and readers
+    try:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+
+
+class SnapshotWriter(object):
+
+    def __init__(self, name=SNAPSHOT_NAME, size=SIZE):
+        try:
+            self.shm = SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            # Left by a previous run, readers may still be attached to it
+            self.shm = SharedMemory(name)
+        untrack(self.shm)
+        seq, = unpack_from(SEQ, self.shm.buf)
+        self.seq = seq + seq % 2
+
+    def publish(self, sample, acquired=None):
+        payload = json_dumps(sample).encode()
+        if HEADER_SIZE + len(payload) > self.shm.size:
+            raise ValueError('Sample of {} bytes does not fit'.format(
+                len(payload)
+            ))
+        buf = self.shm.buf
+        self.seq += 1
+        pack_into(SEQ, buf, 0, self.seq)
+        pack_into(HEADER, buf, 0, self.seq, acquired or time(),
+                  len(payload), crc32(payload))
+        buf[HEADER_SIZE:HEADER_SIZE + len(payload)] = payload
+        self.seq += 1
+        pack_into(SEQ, buf, 0, self.seq)
+
+    def close(self):
+        self.shm.close()
+
+
+class SnapshotReader(object):
+    '''
+    Reads the block published by SnapshotWriter, attaching to it on
+    first use. Safe to share between threads.
+    '''
+
+    def __init__(self, name=SNAPSHOT_NAME, max_age=SNAPSHOT_MAX_AGE):
+        self.name = name
+        self.max_age = max_age
+        self.lock = Lock()
+        self.shm = None
+        self.attached = None
+        self.stats = dict(hits=0, misses=0)
+
+    def attach(self):
+        with self.lock:
+            if self.shm is None and (
+                self.attached is None
+                or monotonic() - self.attached >= REATTACH_INTERVAL
+            ):
+                self.attached = monotonic()
+                try:
+                    self.shm = SharedMemory(self.name)
+                    untrack(self.shm)
+                except FileNotFoundError:
+                    pass
+            return self.shm
+
+    def read(self):
+        ''' (seq, acquired, sample) or None if there is none yet '''
+        shm = self.attach()
+        if shm is None:
+            return None
+        buf = shm.buf
+        for _ in range(READ_RETRIES):
+            seq, acquired, length, crc = unpack_from(HEADER, buf)
+            if seq == 0:
+                return None
+            if seq % 2 or HEADER_SIZE + length > shm.size:
+                continue
+            payload = bytes(buf[HEADER_SIZE:HEADER_SIZE + length])
+            if unpack_from(SEQ, buf)[0] == seq and crc32(payload) == crc:
+                return seq, acquired, json_loads(payload.decode())
+        return None
+
+    def fresh(self):
+        ''' (seq, acquired, sample) if taken within `max_age` seconds '''
+        snapshot = self.read()
+        if snapshot and time() - snapshot[1] <= self.max_age:
+            with self.lock:
+                self.stats['hits'] += 1
+            return snapshot
+
+        with self.lock:
+            self.stats['misses'] += 1
+        if snapshot:
+            self.detach()
+        return None
+
+    def detach(self):
+        ''' Attach again later, the datalogger may use a new block '''
+        with self.lock:
+            if self.shm is not None and \
+                    monotonic() - self.attached >= REATTACH_INTERVAL:
+                # Not closed here, other threads may be reading from it
+                self.shm = None
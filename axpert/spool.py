@@ -0,0 +1,131 @@
+import os
+
+from json import dumps as json_dumps, loads as json_loads
+
+"""
+Append only on disk spool in front of the datalogger database. Samples
+are written here first, one JSON line per row, and drained into sqlite
+in batches, so a locked database or a restart costs latency instead of
+data:
+
+    spool-000001.jsonl    ["stats", [1514764800, 230.1, ...]]
+                          ["last_stats", [17, 1514764800, 52.1, ...]]
+
+A position is (segment, offset) right after the last drained row. The
+writer stores it in the same transaction as the rows, drained segments
+get removed once a newer one is in use.
+"""
+
+PREFIX = 'spool-'
+SUFFIX = '.jsonl'
+SEGMENT_BYTES = 4 * 1024 * 1024
+
+
+def segment_path(directory, segment):
+    fname = '{}{:06d}{}'.format(PREFIX, segment, SUFFIX)
+    return os.path.join(directory, fname)
+
+
+def segments(directory):
+    ''' Segment numbers in `directory`, oldest first '''
+    if not os.path.exists(directory):
+        return []
+    found = []
+    for fname in os.listdir(directory):
+        number = fname[len(PREFIX):-len(SUFFIX)]
+        if fname.startswith(PREFIX) and fname.endswith(SUFFIX) \
+                and number.isdigit():
+            found.append(int(number))
+    return sorted(found)
+
+
+def read_segment(path, offset=0):
+    '''
+    Yields (tab_name, row, end offset) of every complete line of the
+    segment after `offset`. A torn last line, left by a crash in the
+    middle of a write, is not yielded.
+    '''
+    with open(path, 'rb') as fr:
+        fr.seek(offset)
+        for line in fr:
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            tab_name, row = json_loads(line.decode())
+            yield tab_name, row, offset
+
+
+class Spool(object):
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, fsync=False):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.fw = None
+        self.segment = None
+        self.drained = (0, 0)
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def position(self):
+        ''' Position right after the last row appended '''
+        return self.segment, self.fw.tell()
+
+    def backlog(self):
+        ''' Bytes appended but not drained yet '''
+        segment, offset = self.drained
+        total = -offset
+        for number in segments(self.directory):
+            if number >= segment:
+                total += os.path.getsize(segment_path(self.directory, number))
+        return max(total, 0)
+
+    def replay(self, position=(0, 0)):
+        '''
+        Rows appended after `position`, as (tab_name, row), to drain again
+        after a restart. Appending goes on in a new segment.
+        '''
+        self.close()
+        self.drained = position
+        rows = []
+        for number in segments(self.directory):
+            if number < position[0]:
+                continue
+            offset = position[1] if number == position[0] else 0
+            path = segment_path(self.directory, number)
+            rows.extend(
+                (tab_name, row)
+                for tab_name, row, _ in read_segment(path, offset)
+            )
+        self.open((segments(self.directory) or [0])[-1] + 1)
+        return rows
+
+    def open(self, segment):
+        self.close()
+        self.segment = segment
+        self.fw = open(segment_path(self.directory, segment), 'ab')
+
+    def append(self, tab_name, row):
+        self.fw.write(json_dumps([tab_name, row]).encode() + b'\n')
+        # Handed to the OS on every row, a crash of the process does not
+        # lose it. Surviving power loss needs fsync.
+        self.fw.flush()
+        if self.fsync:
+            os.fsync(self.fw.fileno())
+
+    def drain(self, position):
+        '''
+        Everything up to `position` is in the database. Drained segments
+        are removed and a full one is replaced with a fresh segment.
+        '''
+        self.drained = position
+        for number in segments(self.directory):
+            if number < position[0]:
+                os.unlink(segment_path(self.directory, number))
+        if position == self.position and position[1] >= self.segment_bytes:
+            self.open(self.segment + 1)
+
+    def close(self):
+        if self.fw:
+            self.fw.close()
+            self.fw = None
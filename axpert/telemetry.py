@@ -0,0 +1,116 @@
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock
+from time import monotonic
+
+"""
+Per command counters and latency histograms of the inverter link. The
+registry is per process, the broker owns the connector so that is where
+the numbers are gathered; other processes ask the broker for them.
+"""
+
+# Upper bounds in seconds, the last bucket is +Inf
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+PREFIX = 'godenerg'
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        cumulative, buckets = 0, []
+        for bound, count in zip(BUCKETS + ('+Inf',), self.counts):
+            cumulative += count
+            buckets.append([bound, cumulative])
+        return {'buckets': buckets, 'sum': self.sum, 'count': self.count}
+
+
+class Telemetry(object):
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = defaultdict(lambda: defaultdict(int))
+        self.histograms = defaultdict(lambda: defaultdict(Histogram))
+
+    def incr(self, name, cmd='', value=1):
+        with self.lock:
+            self.counters[name][cmd] += value
+
+    def observe(self, phase, cmd, seconds):
+        with self.lock:
+            self.histograms[phase][cmd].observe(seconds)
+
+    @contextmanager
+    def timer(self, phase, cmd):
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(phase, cmd, monotonic() - start)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': {
+                    name: dict(values)
+                    for name, values in self.counters.items()
+                },
+                'histograms': {
+                    phase: {
+                        cmd: histogram.snapshot()
+                        for cmd, histogram in values.items()
+                    }
+                    for phase, values in self.histograms.items()
+                }
+            }
+
+
+telemetry = Telemetry()
+
+
+def prometheus_text(snapshot, gauges=None):
+    '''
+    Renders a telemetry snapshot, plus a flat dict of extra gauges, in
+    the Prometheus text exposition format.
+    '''
+    lines = []
+    for name, values in sorted(snapshot['counters'].items()):
+        metric = '{}_{}_total'.format(PREFIX, name)
+        lines.append('# TYPE {} counter'.format(metric))
+        for cmd, value in sorted(values.items()):
+            lines.append('{}{{cmd="{}"}} {}'.format(metric, cmd, value))
+
+    metric = '{}_command_seconds'.format(PREFIX)
+    if snapshot['histograms']:
+        lines.append('# TYPE {} histogram'.format(metric))
+    for phase, values in sorted(snapshot['histograms'].items()):
+        for cmd, histogram in sorted(values.items()):
+            labels = 'cmd="{}",phase="{}"'.format(cmd, phase)
+            for bound, count in histogram['buckets']:
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(
+                    metric, labels, bound, count
+                ))
+            lines.append('{}_sum{{{}}} {}'.format(
+                metric, labels, histogram['sum']
+            ))
+            lines.append('{}_count{{{}}} {}'.format(
+                metric, labels, histogram['count']
+            ))
+
+    for name, value in sorted((gauges or {}).items()):
+        metric = '{}_{}'.format(PREFIX, name)
+        lines.append('# TYPE {} gauge'.format(metric))
+        lines.append('{} {}'.format(metric, value))
+
+    return '\n'.join(lines) + '\n'
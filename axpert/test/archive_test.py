@@ -0,0 +1,57 @@
+import pytest
+
+from datetime import date
+
+from axpert.archive import (
+    write_day, read_range, archived_days, day_path, day_start, DayArchive,
+    ArchiveError
+)
+
+COLS = [
+    ('datetime', 'INTEGER'), ('batt_volt', 'REAL'),
+    ('pv_watts', 'INTEGER'), ('mode', 'TEXT')
+]
+
+
+def sample_rows(start, count):
+    return [
+        (start + index * 15, 50.5 + index % 3, index * 10, 'B')
+        for index in range(count)
+    ]
+
+
+def test_write_and_read_day(tmp_path):
+    path = str(tmp_path / 'day.gda')
+    rows = sample_rows(1500000000, 100) + [(1500001500, None, None, None)]
+    write_day(path, COLS, rows)
+
+    with DayArchive(path) as archive:
+        assert archive.count == 101
+        assert archive.cols == [name for name, _ in COLS]
+        assert archive.rows() == rows
+        # Columns are read on their own
+        assert archive.column('pv_watts')[:3] == [0, 10, 20]
+
+
+def test_not_an_archive(tmp_path):
+    path = tmp_path / 'day.gda'
+    path.write_bytes(b'X' * 64)
+    with pytest.raises(ArchiveError):
+        DayArchive(str(path))
+
+
+def test_read_range_across_days(tmp_path):
+    archive_dir = str(tmp_path)
+    first, second = date(2018, 3, 1), date(2018, 3, 2)
+    for day in (first, second):
+        write_day(day_path(archive_dir, day), COLS,
+                  sample_rows(day_start(day), 10))
+
+    from_dt = day_start(first) + 100
+    to_dt = day_start(second) + 30
+    paths = archived_days(archive_dir, from_dt, to_dt)
+    assert len(paths) == 2
+
+    rows = list(read_range(paths, from_dt, to_dt, ['datetime', 'mode']))
+    assert rows == [(day_start(first) + 15 * i, 'B') for i in range(7, 10)] \
+        + [(day_start(second) + 15 * i, 'B') for i in range(3)]
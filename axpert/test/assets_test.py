@@ -0,0 +1,63 @@
+import os
+import pytest
+
+from gzip import decompress
+
+from axpert.assets import StaticAssets, accepts_gzip, content_type
+
+
+@pytest.fixture
+def root(tmp_path):
+    (tmp_path / 'img').mkdir()
+    (tmp_path / 'img' / 'sun.png').write_bytes(b'\x89PNG' + b'\x00' * 64)
+    (tmp_path / 'lib.js').write_text('var x = 1;\n' * 200)
+    (tmp_path / 'page.html').write_text(
+        '<html><script src="/lib"></script></html>'
+    )
+    return tmp_path
+
+
+def test_assets_are_compressed_and_versioned(root):
+    assets = StaticAssets(str(root), links={'/lib': 'lib.js'})
+    lib = assets.get('lib.js')
+    assert decompress(lib.gzipped) == lib.body
+    assert len(lib.gzipped) < len(lib.body)
+    assert assets.get('lib.js') is lib
+
+    page = assets.get('page.html')
+    assert '"/lib?v={}"'.format(lib.digest).encode() in page.body
+    assert page.ctype == 'text/html; charset=utf-8'
+
+    img = assets.get('img/sun.png')
+    assert img.ctype == 'image/png' and img.gzipped is None
+
+
+def test_assets_reload_on_change(root):
+    assets = StaticAssets(str(root), links={'/lib': 'lib.js'})
+    page = assets.get('page.html')
+
+    (root / 'lib.js').write_text('var x = 2;\n')
+    os.utime(str(root / 'lib.js'), ns=(1, 1))
+    lib = assets.get('lib.js')
+    assert lib.body == b'var x = 2;\n'
+    # The page links to the new version
+    assert '"/lib?v={}"'.format(lib.digest).encode() in \
+        assets.get('page.html').body
+    assert assets.get('page.html').digest != page.digest
+
+
+def test_only_files_under_root(root):
+    assets = StaticAssets(str(root / 'img'))
+    for fname in ('../lib.js', 'missing.png', ''):
+        with pytest.raises(KeyError):
+            assets.get(fname)
+
+
+def test_accepts_gzip():
+    assert accepts_gzip('gzip, deflate, br')
+    assert accepts_gzip('deflate;q=1.0, gzip;q=0.5')
+    assert accepts_gzip('*')
+    assert not accepts_gzip('gzip;q=0')
+    assert not accepts_gzip('deflate')
+    assert not accepts_gzip(None)
+    assert content_type('x.unknown') == 'application/octet-stream'
@@ -0,0 +1,73 @@
+from asyncio import run, gather, sleep as async_sleep
+from os import pipe, write, read, close, set_blocking
+from unittest.mock import Mock
+
+from axpert.broker import AsyncExecutor
+from axpert.codec import request_frame
+from axpert.connector import AsyncConnector
+from axpert.protocol import CmdSpec, Status
+
+
+class PipeConnector(AsyncConnector):
+    ''' Reads from a pipe the test writes the inverter answers into '''
+
+    def __init__(self, *args, **kwargs):
+        self.written = []
+        super(PipeConnector, self).__init__(*args, **kwargs)
+
+    def open(self):
+        self.fd, self.device_fd = pipe()
+        set_blocking(self.fd, False)
+
+    def close(self):
+        close(self.fd)
+        close(self.device_fd)
+
+    async def write(self, data):
+        self.written.append(data)
+
+    def read_chunk(self, size, timeout):
+        try:
+            return read(self.fd, size)
+        except BlockingIOError:
+            return b''
+
+    def fileno(self):
+        return self.fd
+
+
+def test_async_read_waits_for_terminator():
+
+    async def _test(connector):
+        async def _answer():
+            write(connector.device_fd, b'(B')
+            await async_sleep(0.05)
+            write(connector.device_fd, b'xx\rextra')
+
+        data, _ = await gather(connector.read(110), _answer())
+        return data
+
+    with PipeConnector(log=Mock()) as connector:
+        assert run(_test(connector)) == b'(Bxx\r'
+
+
+def test_async_read_deadline():
+    with PipeConnector(log=Mock()) as connector:
+        assert run(connector.read(5, timeout=0.05)) == b''
+
+
+def test_async_executor_coalesces():
+    cmd = CmdSpec(code='QMOD', size=5, val='', json=None)
+
+    async def _test(connector):
+        executor = AsyncExecutor(Mock(), connector, ttl=0)
+        write(connector.device_fd, request_frame('(B'))
+        responses = await gather(*(executor(cmd) for _ in range(3)))
+        return executor, responses
+
+    with PipeConnector(log=Mock()) as connector:
+        executor, responses = run(_test(connector))
+        assert len(connector.written) == 1
+        assert all(res.status == Status.NN for res in responses)
+        assert responses[0].data.startswith('(B')
+        assert executor.stats() == {'coalesced': 2, 'in_flight': 0}
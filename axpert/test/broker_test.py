@@ -0,0 +1,107 @@
+from unittest.mock import Mock
+from threading import Thread
+from time import sleep
+
+from axpert.broker import (
+    Broker, BrokerClient, wait_for_broker, BAD_FRAME_RETRIES
+)
+from axpert.protocol import CmdSpec, Status
+from axpert.codec import request_frame
+from axpert.test.axpert_test import MockConnector
+
+
+class FrameConnector(MockConnector):
+    ''' Answers with well formed frames of the requested size '''
+
+    def read(self, size):
+        return request_frame('(' + 'X' * (size - 4)).decode('latin-1')
+
+
+def start_broker(address, connector, ttl=1):
+    broker = Broker(Mock(), connector, address, ttl=ttl)
+    Thread(target=broker.serve_forever, daemon=True).start()
+    assert wait_for_broker(address, timeout=2)
+    return broker
+
+
+def test_broker_shares_cache_between_clients(tmp_path):
+    address = str(tmp_path / 'broker.sock')
+    connector = FrameConnector()
+    start_broker(address, connector)
+
+    cmd = CmdSpec(code='QMOD', size=5, val='', json=None)
+    first = BrokerClient(address)(cmd)
+    second = BrokerClient(address)(cmd)
+
+    assert first == second and first.data.startswith('(X')
+    # Only one exchange went down to the device
+    assert len(connector.write_buffer) == 1
+
+
+def test_broker_client_without_broker(tmp_path):
+    client = BrokerClient(str(tmp_path / 'missing.sock'))
+    response = client(CmdSpec(code='QMOD', size=5, val='', json=None))
+    assert response.status == Status.KO and response.data is None
+
+
+def test_broker_coalesces_in_flight_commands():
+    class SlowConnector(FrameConnector):
+        def read(self, size):
+            sleep(0.2)
+            return super(SlowConnector, self).read(size)
+
+    connector = SlowConnector()
+    # No caching at all, only in-flight exchanges are shared
+    broker = Broker(Mock(), connector, None, ttl=0)
+    cmd = CmdSpec(code='QPIGS', size=110, val='', json=None)
+
+    responses = []
+    callers = [
+        Thread(target=lambda: responses.append(broker.execute(cmd)))
+        for _ in range(5)
+    ]
+    for caller in callers:
+        caller.start()
+    for caller in callers:
+        caller.join()
+
+    assert len(connector.write_buffer) == 1
+    assert len(responses) == 5 and len(set(responses)) == 1
+    stats = broker.stats()
+    assert stats['coalesced'] == 4 and stats['in_flight'] == 0
+    assert stats['scheduler']['classes']['http']['served'] == 1
+
+
+def test_broker_retries_and_skips_caching_bad_frames():
+    connector = MockConnector()
+    broker = Broker(Mock(), connector, None)
+    cmd = CmdSpec(code='QMOD', size=5, val='', json=None)
+
+    assert broker.execute(cmd).status == Status.BF
+    assert broker.execute(cmd).status == Status.BF
+    assert len(connector.write_buffer) == 2 * (BAD_FRAME_RETRIES + 1)
+
+
+def test_broker_publish_and_fetch(tmp_path):
+    address = str(tmp_path / 'broker.sock')
+    start_broker(address, FrameConnector())
+
+    BrokerClient(address).publish('rolling', {'datetime': 1})
+    assert BrokerClient(address).fetch('rolling') == {'datetime': 1}
+    assert BrokerClient(address).fetch('missing') is None
+
+
+def test_broker_wait_for_publish(tmp_path):
+    address = str(tmp_path / 'broker.sock')
+    start_broker(address, FrameConnector())
+    client = BrokerClient(address)
+
+    assert client.wait('live', 0, timeout=0.05) == (0, None)
+    client.publish('live', {'batt_volt': 52.1})
+    assert client.wait('live', 0) == (1, {'batt_volt': 52.1})
+
+    Thread(
+        target=lambda: sleep(0.1) or BrokerClient(address).publish('live', 2),
+        daemon=True
+    ).start()
+    assert client.wait('live', 1, timeout=2) == (2, 2)
@@ -0,0 +1,30 @@
+from datetime import datetime
+from unittest.mock import Mock, patch
+
+from axpert.charger import get_rolling_avg
+from axpert.rolling import RollingStats
+
+
+def rolling_executor(seconds_of_samples):
+    now = int(datetime.now().timestamp())
+    rolling = RollingStats(['batt_volt', 'batt_charge_amps'], [1800])
+    for t in range(now - seconds_of_samples, now + 1, 2):
+        rolling.add(t, {'batt_volt': 58.4, 'batt_charge_amps': 5})
+    executor = Mock()
+    executor.fetch.return_value = rolling.snapshot()
+    return executor
+
+
+def test_rolling_avg_over_a_covered_window():
+    with patch('axpert.charger.get_avg_last') as get_avg_last:
+        volts, amps = get_rolling_avg(Mock(), rolling_executor(3600))
+        assert abs(volts - 58.4) < 1e-6 and amps == 5
+        assert not get_avg_last.called
+
+
+def test_partial_window_falls_back_to_the_database():
+    # A few seconds after a datalogger restart
+    with patch('axpert.charger.get_avg_last') as get_avg_last:
+        get_avg_last.return_value = (52.0, 20)
+        assert get_rolling_avg(Mock(), rolling_executor(10)) == (52.0, 20)
+        assert get_avg_last.call_args[1] == {'minutes': 30}
@@ -0,0 +1,63 @@
+import pytest
+
+from unittest.mock import Mock
+from struct import pack
+
+from axpert.codec import (
+    request_frame, validate_response, compile_frames, reserved_crc,
+    CRCError, TerminatorError
+)
+from axpert.protocol import CmdSpec, Status, execute
+from axpert.test.axpert_test import MockConnector
+
+
+def test_request_frame_is_built_once():
+    request_frame.cache_clear()
+    frame = request_frame('QPIGS', '')
+    assert frame == b'QPIGS' + pack('>H', 0xB7A9) + b'\r'
+    assert request_frame('QPIGS', '') is frame
+    assert request_frame.cache_info().hits == 1
+
+    frames = compile_frames(
+        {'status': CmdSpec(code='QPIGS', size=110, val='', json=None)}
+    )
+    assert frames == {'status': frame}
+
+
+@pytest.mark.parametrize(
+    'raw, payload', [
+        (request_frame('(ACK'), b'(ACK'),
+        (request_frame('(ACK') + b'\x00\x00', b'(ACK'),
+        (request_frame('(B').decode('latin-1'), b'(B')
+    ]
+)
+def test_validate_response(raw, payload):
+    assert validate_response(raw) == payload
+
+
+@pytest.mark.parametrize(
+    'raw, error', [
+        (b'(ACK\x00\x00\r', CRCError),
+        (request_frame('(ACK')[:-1], TerminatorError),
+        (b'\r', TerminatorError)
+    ]
+)
+def test_validate_bad_response(raw, error):
+    with pytest.raises(error):
+        validate_response(raw)
+
+
+def test_reserved_crc():
+    assert reserved_crc(0x280d) == 0x290e
+    assert reserved_crc(0xB7A9) == 0xB7A9
+
+
+def test_execute_bad_frame():
+    class CorruptConnector(MockConnector):
+        def read(self, size):
+            return b'(ACK\x00\x00\r'
+
+    cmd = CmdSpec(code='PBFT', val='53.0', size=7, json=None)
+    response = execute(Mock(), CorruptConnector(), cmd)
+    assert response.status == Status.BF and response.data is None
+    assert isinstance(response.error, CRCError)
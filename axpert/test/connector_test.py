@@ -1,10 +1,11 @@
 from unittest.mock import patch, Mock
+from time import monotonic
 
 from axpert.connector_serial import (
     SerialConnector, MAX_CONNECT_RETRIES
 )
 
-from axpert.connector import resolve_connector
+from axpert.connector import resolve_connector, Connector
 
 
 class MockConnectorA():
@@ -28,11 +29,11 @@ def test_serial_reconnect():
         def enable_fail(cls):
             cls.fail = True
 
-        def read(self, *args):
+        def read_until(self, *args):
             if self.fail:
                 raise MockException()
             else:
-                return 'a' * 20
+                return b'a' * 20
 
         def close(self):
             pass
@@ -45,7 +46,7 @@ def test_serial_reconnect():
         with SerialConnector(devices=['/dev/ttyUSB0'], log=Mock()) as connector:
             # Proper read
             res = connector.read(20)
-            assert res and res == 'a' * 20
+            assert res and res == b'a' * 20
 
             # Force fail and make sure we retry
             mock_serial.enable_fail()
@@ -69,3 +70,41 @@ def test_resolve_connector():
 
         bad_connector = resolve_connector({'con_c': True})
         assert bad_connector is None
+
+
+class ChunkConnector(Connector):
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.reads = 0
+        super(ChunkConnector, self).__init__()
+
+    def read_chunk(self, size, timeout):
+        self.reads += 1
+        if not self.chunks:
+            return b''
+        chunk = self.chunks.pop(0)
+        if len(chunk) > size:
+            self.chunks.insert(0, chunk[size:])
+        return chunk[:size]
+
+
+def test_framed_read_returns_on_terminator():
+    connector = ChunkConnector([b'(B', b'\xe7\xc9\r\x00\x00', b'extra'])
+    assert connector.read(110) == b'(B\xe7\xc9\r'
+    assert connector.reads == 2
+
+
+def test_framed_read_stops_at_size():
+    connector = ChunkConnector([b'(NAK', b'garbage-garbage'])
+    assert connector.read(12) == b'(NAKgarbage-'
+
+    # Whatever the expected size, there is always room for a '(NAK'
+    connector = ChunkConnector([b'(NAK\x00\x00\r'])
+    assert connector.read(5) == b'(NAK\x00\x00\r'
+
+
+def test_framed_read_deadline():
+    connector = ChunkConnector([b'(ACK'])
+    start = monotonic()
+    assert connector.read(110, timeout=0.05) == b'(ACK'
+    assert monotonic() - start < 0.5
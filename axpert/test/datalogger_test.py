@@ -0,0 +1,409 @@
+import pytest
+
+from gzip import decompress
+from io import BytesIO
+from json import loads as json_loads
+from datetime import date, datetime, timedelta
+from sqlite3 import connect, OperationalError
+from threading import Thread
+from unittest.mock import Mock, patch
+
+from axpert.datalogger import (
+    BufferedWriter, SampleRing, ensure_db_structure, set_synchronous,
+    archive_closed_days, get_range, get_last_data_datetime, export_chunks,
+    encode_chunks, iter_range, series_rows, read_connection, get_avg_last,
+    open_write_connection, BaseDataLoggerHandler, DB, INDEXES, ROLLUPS
+)
+from axpert.partitions import Partitions
+from axpert.archive import day_start, day_path, write_day, DayArchive
+from axpert.spool import Spool
+
+
+def datapoint(**values):
+    data = {col: 0 for col, _ in DB['stats'] + DB['last_stats']}
+    data.update(values)
+    return data
+
+
+def count_rows(db_conn, tab_name):
+    return db_conn.execute(
+        'SELECT COUNT(1) FROM {}'.format(tab_name)
+    ).fetchone()[0]
+
+
+@pytest.fixture
+def db_conn():
+    db_conn = connect(':memory:')
+    ensure_db_structure(Mock(), db_conn)
+    yield db_conn
+    db_conn.close()
+
+
+def test_buffered_writer_commits_in_batches(db_conn):
+    writer = BufferedWriter(Mock(), db_conn, max_rows=3, max_delay=60)
+    writer.add('stats', datapoint())
+    writer.add('last_stats', datapoint())
+    assert count_rows(db_conn, 'stats') == 0
+
+    writer.add('last_stats', datapoint())
+    assert count_rows(db_conn, 'stats') == 1
+    assert count_rows(db_conn, 'last_stats') == 2
+    assert writer.pending_rows == 0
+
+
+def test_buffered_writer_commits_on_delay(db_conn):
+    writer = BufferedWriter(Mock(), db_conn, max_rows=100, max_delay=0)
+    writer.add('stats', datapoint(batt_volt=52.1))
+    assert db_conn.execute('SELECT batt_volt FROM stats').fetchall() == \
+        [(52.1,)]
+
+
+def test_set_synchronous(db_conn):
+    set_synchronous(db_conn, 'off')
+    assert db_conn.execute('PRAGMA synchronous').fetchone() == (0,)
+    with pytest.raises(ValueError):
+        set_synchronous(db_conn, 'sometimes')
+
+
+def test_sample_ring_overwrites_oldest(db_conn):
+    with patch('axpert.datalogger.SAMPLES', 3):
+        writer = BufferedWriter(Mock(), db_conn, max_rows=1, max_delay=60)
+        for second in range(5):
+            with patch('axpert.datalogger.datetime') as mock_dt:
+                mock_dt.now.return_value.timestamp.return_value = second
+                writer.add('last_stats', datapoint())
+
+    assert db_conn.execute(
+        'SELECT slot, datetime FROM last_stats ORDER BY datetime'
+    ).fetchall() == [(2, 2), (0, 3), (1, 4)]
+
+    # A new writer carries on after the newest slot
+    ring = SampleRing(db_conn, capacity=3)
+    assert ring.slot() == 2 and ring.slot() == 0
+
+
+def test_changed_ring_table_is_recreated():
+    db_conn = connect(':memory:')
+    db_conn.execute('CREATE TABLE last_stats (datetime INTEGER)')
+    ensure_db_structure(Mock(), db_conn)
+    cols = [row[1] for row in db_conn.execute('PRAGMA table_info(last_stats)')]
+    assert cols == [col for col, _ in DB['last_stats']]
+
+
+def add_stats(writer, seconds, **values):
+    for second in seconds:
+        with patch('axpert.datalogger.datetime') as mock_dt:
+            mock_dt.now.return_value.timestamp.return_value = second
+            writer.add('stats', datapoint(
+                batt_volt=50 + (second % 7), pv_watts=second % 100, **values
+            ))
+
+
+def test_rollups_are_updated_incrementally(db_conn):
+    writer = BufferedWriter(Mock(), db_conn, max_rows=7, max_delay=60)
+    add_stats(writer, range(0, 7200, 15))
+    writer.flush()
+
+    for tab_name, resolution in ROLLUPS:
+        expected = db_conn.execute(
+            'SELECT datetime / ? * ?, COUNT(1), SUM(batt_volt), '
+            'MIN(batt_volt), MAX(pv_watts) FROM stats '
+            'GROUP BY datetime / ? ORDER BY 1',
+            [resolution] * 3
+        ).fetchall()
+        assert db_conn.execute(
+            'SELECT bucket, cnt, batt_volt_sum, batt_volt_min, pv_watts_max '
+            'FROM {} ORDER BY bucket'.format(tab_name)
+        ).fetchall() == expected
+
+
+def test_rollups_backfilled_on_creation():
+    db_conn = connect(':memory:')
+    ensure_db_structure(Mock(), db_conn)
+    add_stats(BufferedWriter(Mock(), db_conn, max_rows=1), range(0, 600, 15))
+    db_conn.execute('DROP TABLE stats_1m')
+
+    ensure_db_structure(Mock(), db_conn)
+    assert db_conn.execute(
+        'SELECT COUNT(1), SUM(cnt) FROM stats_1m'
+    ).fetchone() == (10, 40)
+
+
+def test_archived_days_are_read_back(tmp_path):
+    db_filename = str(tmp_path / 'godenerg.db')
+    archive_dir = str(tmp_path / 'archive')
+    old_day = date.today() - timedelta(days=10)
+    start = day_start(old_day)
+
+    with connect(db_filename) as db_conn:
+        ensure_db_structure(Mock(), db_conn)
+        writer = BufferedWriter(Mock(), db_conn, max_rows=1000)
+        add_stats(writer, range(start, start + 86400 + 3600, 900))
+        writer.flush()
+        archive_closed_days(Mock(), db_conn, archive_dir, keep_days=1)
+        assert count_rows(db_conn, 'stats') == 0
+
+        archive_closed_days(Mock(), db_conn, archive_dir, keep_days=20)
+        add_stats(writer, [start + 86400 + 7200])
+        writer.flush()
+
+    from_txt = old_day.strftime('%Y%m%d') + '2000'
+    to_txt = (old_day + timedelta(days=1)).strftime('%Y%m%d') + '0200'
+    with patch.dict('axpert.datalogger.datalogger_conf',
+                    db_filename=db_filename), \
+            patch('axpert.datalogger.ARCHIVE_DIR', archive_dir):
+        rows = get_range(from_txt, to_txt, ['datetime', 'pv_watts'],
+                         raw_data=True)
+
+    from_dt = start + 20 * 3600
+    expected = list(range(from_dt, start + 86400 + 3600, 900)) + \
+        [start + 86400 + 7200]
+    assert [row[0] for row in rows] == expected
+
+
+def test_stats_written_to_monthly_partitions(tmp_path):
+    db_filename = str(tmp_path / 'godenerg.db')
+    archive_dir = str(tmp_path / 'archive')
+    today = date.today()
+    old_month = date(today.year - 1, today.month, 1)
+    start = day_start(old_month)
+
+    with connect(db_filename) as db_conn:
+        ensure_db_structure(Mock(), db_conn)
+        partitions = Partitions(db_conn, DB['stats'], INDEXES['stats'])
+        writer = BufferedWriter(Mock(), db_conn, partitions=partitions)
+        now = int(datetime.now().timestamp())
+        add_stats(writer, [start, start + 3600, now - 60])
+        writer.flush()
+
+        assert count_rows(db_conn, 'main.stats') == 0
+        assert len(partitions.months()) == 2
+        # Rollups still cover every partition
+        assert db_conn.execute(
+            'SELECT SUM(cnt) FROM stats_1d'
+        ).fetchone() == (3,)
+
+    with patch.dict('axpert.datalogger.datalogger_conf',
+                    db_filename=db_filename), \
+            patch('axpert.datalogger.ARCHIVE_DIR', archive_dir):
+        rows = get_range(old_month.strftime('%Y%m%d'),
+                         today.strftime('%Y%m%d') + '235959',
+                         ['datetime'], raw_data=True)
+        assert rows == [(start,), (start + 3600,), (now - 60,)]
+        assert get_last_data_datetime(Mock()) == \
+            datetime.fromtimestamp(now - 60)
+
+    with connect(db_filename) as db_conn:
+        archive_closed_days(Mock(), db_conn, archive_dir, keep_days=1)
+        assert Partitions(db_conn).months() == [today.strftime('%Y%m')]
+
+
+def test_export_chunks():
+    rows = [(index, 50.5) for index in range(5)]
+    csv = list(export_chunks(rows, chunk_rows=2))
+    assert len(csv) == 3
+    assert ''.join(csv) == '\n'.join('{};50.5'.format(i) for i in range(5))
+
+    assert json_loads(''.join(export_chunks(rows, True, chunk_rows=2))) == \
+        [[str(i), '50.5'] for i in range(5)]
+    assert ''.join(export_chunks([], True)) == '[]'
+
+
+def test_encode_chunks_gzip():
+    chunks = ['a;1', '\nb;2']
+    assert b''.join(encode_chunks(chunks)) == b'a;1\nb;2'
+    assert decompress(b''.join(encode_chunks(chunks, True))) == b'a;1\nb;2'
+
+
+def test_iter_range_streams_rows(tmp_path):
+    db_filename = str(tmp_path / 'godenerg.db')
+    with connect(db_filename) as db_conn:
+        ensure_db_structure(Mock(), db_conn)
+        writer = BufferedWriter(Mock(), db_conn)
+        add_stats(writer, range(1000, 2000, 15))
+        writer.flush()
+
+    with patch.dict('axpert.datalogger.datalogger_conf',
+                    db_filename=db_filename), \
+            patch('axpert.datalogger.ARCHIVE_DIR', str(tmp_path)):
+        with pytest.raises(KeyError):
+            iter_range(1000, 2000, ['datetime; DROP TABLE stats'])
+        rows = iter_range(1000, 1100, ['datetime'])
+        assert next(rows) == (1000,)
+        assert list(rows) == [(second,) for second in range(1015, 1100, 15)]
+
+
+def test_series_rows_from_rollups_keep_peaks(db_conn):
+    writer = BufferedWriter(Mock(), db_conn, max_rows=1000, max_delay=60)
+    add_stats(writer, range(0, 30 * 86400, 900))
+    writer.flush()
+    db_conn.execute('UPDATE stats_15m SET batt_volt_max = 70 WHERE bucket = ?',
+                    [10 * 86400])
+
+    rows = series_rows(db_conn, 0, 30 * 86400, ['batt_volt'], points=100,
+                       method='minmax')
+    assert len(rows) <= 100
+    assert max(value for _, value in rows) == 70
+
+
+def test_read_connection_is_reused_and_read_only(tmp_path):
+    db_filename = str(tmp_path / 'godenerg.db')
+    with connect(db_filename) as db_conn:
+        ensure_db_structure(Mock(), db_conn)
+        writer = BufferedWriter(Mock(), db_conn)
+        for volt in (50.0, 52.0):
+            writer.add('last_stats', datapoint(
+                batt_volt=volt, batt_charge_amps=4
+            ))
+        writer.flush()
+
+    with patch.dict('axpert.datalogger.datalogger_conf',
+                    db_filename=db_filename):
+        db_conn = read_connection()
+        assert read_connection() is db_conn
+        assert get_avg_last(Mock(), minutes=5) == (51.0, 4.0)
+        with pytest.raises(OperationalError):
+            db_conn.execute('DELETE FROM stats')
+
+        # Every thread gets its own
+        other = []
+        thread = Thread(target=lambda: other.append(read_connection()))
+        thread.start()
+        thread.join()
+        assert other[0] is not db_conn
+
+
+def test_wal_readers_do_not_block_writer(tmp_path):
+    db_filename = str(tmp_path / 'godenerg.db')
+    db_conn = open_write_connection(db_filename, timeout=0.1)
+    ensure_db_structure(Mock(), db_conn)
+    assert db_conn.execute('PRAGMA journal_mode').fetchone() == ('wal',)
+    writer = BufferedWriter(Mock(), db_conn, max_rows=1000)
+
+    reader = connect(db_filename)
+    reader.execute('BEGIN')
+    assert reader.execute('SELECT COUNT(1) FROM stats').fetchone() == (0,)
+    add_stats(writer, [1000])
+    writer.flush()
+    assert writer.stats['rows'] == 1 and writer.stats['busy'] == 0
+    reader.rollback()
+
+    writer.checkpoint()
+    assert writer.stats['checkpoints'] == 1
+
+
+def test_busy_database_keeps_rows_pending(tmp_path):
+    db_filename = str(tmp_path / 'godenerg.db')
+    db_conn = open_write_connection(db_filename, timeout=0.1)
+    ensure_db_structure(Mock(), db_conn)
+    writer = BufferedWriter(Mock(), db_conn, max_rows=1000)
+
+    other = connect(db_filename)
+    other.execute('BEGIN IMMEDIATE')
+    add_stats(writer, [1000, 1015])
+    writer.flush()
+    assert writer.stats['busy'] == 1 and writer.pending_rows == 2
+
+    other.rollback()
+    writer.flush()
+    assert writer.pending_rows == 0
+    assert count_rows(db_conn, 'stats') == 2
+
+
+def test_spooled_rows_survive_restart(tmp_path):
+    db_conn = connect(str(tmp_path / 'godenerg.db'))
+    ensure_db_structure(Mock(), db_conn)
+    spool_dir = str(tmp_path / 'spool')
+
+    writer = BufferedWriter(
+        Mock(), db_conn, max_rows=1000, spool=Spool(spool_dir)
+    )
+    add_stats(writer, [1000, 1015])
+    writer.flush()
+    add_stats(writer, [1030, 1045])
+    assert writer.stats['spooled'] == 4
+    # Dies before the next flush
+    writer.spool.close()
+
+    writer = BufferedWriter(
+        Mock(), db_conn, max_rows=1000, spool=Spool(spool_dir)
+    )
+    assert writer.stats['replayed'] == 2
+    writer.flush()
+    assert writer.stats['spool_backlog'] == 0
+    writer.spool.close()
+
+    # Nothing left to replay once drained
+    writer = BufferedWriter(Mock(), db_conn, spool=Spool(spool_dir))
+    assert writer.pending_rows == 0
+    assert db_conn.execute('SELECT datetime FROM stats').fetchall() == \
+        [(1000,), (1015,), (1030,), (1045,)]
+
+
+def test_interrupted_archive_is_retried_without_duplicates(tmp_path):
+    db_filename = str(tmp_path / 'godenerg.db')
+    archive_dir = str(tmp_path / 'archive')
+    old_day = date.today() - timedelta(days=10)
+    start = day_start(old_day)
+    seconds = list(range(start, start + 3600, 900))
+
+    def write_then_fail(*args):
+        write_day(*args)
+        raise RuntimeError('Killed before commit')
+
+    with connect(db_filename) as db_conn:
+        ensure_db_structure(Mock(), db_conn)
+        writer = BufferedWriter(Mock(), db_conn, max_rows=1000)
+        add_stats(writer, seconds)
+        writer.flush()
+        with patch('axpert.datalogger.write_day', write_then_fail), \
+                pytest.raises(RuntimeError):
+            archive_closed_days(Mock(), db_conn, archive_dir, keep_days=1)
+        # In the day file and still in the table
+        assert count_rows(db_conn, 'stats') == 4
+
+    from_txt = old_day.strftime('%Y%m%d')
+    to_txt = (old_day + timedelta(days=1)).strftime('%Y%m%d')
+    with patch.dict('axpert.datalogger.datalogger_conf',
+                    db_filename=db_filename), \
+            patch('axpert.datalogger.ARCHIVE_DIR', archive_dir):
+        rows = get_range(from_txt, to_txt, ['pv_watts'], raw_data=True)
+        assert len(rows) == 4
+
+        with connect(db_filename) as db_conn:
+            archive_closed_days(Mock(), db_conn, archive_dir, keep_days=1)
+            assert count_rows(db_conn, 'stats') == 0
+        with DayArchive(day_path(archive_dir, old_day)) as archive:
+            assert archive.column('datetime') == seconds
+
+
+@pytest.mark.parametrize('query', [
+    {'points': ['ten']}, {'points': ['0']}, {'method': ['mean']},
+    {'points': ['2']}, {'points': ['5'], 'col_2': ['pv_watts']},
+    {'points': ['3'], 'method': ['minmax'], 'col_2': ['pv_watts']}
+])
+def test_graph_rejects_bad_downsampling(query):
+    handler = Mock(wfile=BytesIO())
+    req = dict(query, **{
+        'from': ['2018-01-01'], 'to': ['2018-01-02'], 'col_1': ['batt_volt']
+    })
+    with patch('axpert.datalogger.get_series') as get_series:
+        BaseDataLoggerHandler.plot_datalogger(handler, req)
+    handler.send_response.assert_called_once_with(400)
+    assert handler.wfile.getvalue()
+    assert not get_series.called
+
+
+@pytest.mark.parametrize('version, body', [
+    ('HTTP/1.1', b'6\r\n1;52.1\r\n0\r\n\r\n'), ('HTTP/1.0', b'1;52.1')
+])
+def test_export_is_chunked_for_http_11_only(version, body):
+    handler = Mock(wfile=BytesIO(), request_version=version)
+    req = {'from': ['20180101'], 'to': ['20180102']}
+    with patch('axpert.datalogger.iter_range', return_value=[(1, 52.1)]):
+        BaseDataLoggerHandler.export(handler, req)
+    chunked = ('Transfer-Encoding', 'chunked') in [
+        call[0] for call in handler.send_header.call_args_list
+    ]
+    assert chunked == (version == 'HTTP/1.1')
+    assert handler.wfile.getvalue() == body
@@ -0,0 +1,58 @@
+import pytest
+
+from math import sin
+
+from axpert.downsample import lttb, minmax, downsample, spread
+
+
+def series(size):
+    xs = list(range(size))
+    ys = [sin(x / 50) for x in xs]
+    ys[1234] = 10.0
+    ys[4321] = -10.0
+    return xs, ys
+
+
+def test_lttb_keeps_budget_ends_and_spikes():
+    xs, ys = series(10000)
+    selected = lttb(xs, ys, 200)
+    assert len(selected) == 200
+    assert selected == sorted(selected)
+    assert selected[0] == 0 and selected[-1] == 9999
+    assert 1234 in selected and 4321 in selected
+
+
+def test_lttb_short_series_untouched():
+    assert lttb([0, 1, 2], [5, 6, 7], 10) == [0, 1, 2]
+
+
+def test_minmax_keeps_extremes():
+    xs, ys = series(10000)
+    selected = minmax(ys, 100)
+    assert len(selected) <= 100
+    assert 1234 in selected and 4321 in selected
+
+
+def test_downsample_rows_of_two_series():
+    rows = [(x, x % 7, -(x % 11)) for x in range(5000)]
+    sampled = downsample(rows, 100, cols=(1, 2))
+    assert len(sampled) <= 100
+    assert [row[0] for row in sampled] == sorted(row[0] for row in sampled)
+    assert downsample(rows[:50], 100) == rows[:50]
+
+    with pytest.raises(ValueError):
+        downsample(rows, 100, method='average')
+
+
+@pytest.mark.parametrize('method', ['lttb', 'minmax'])
+@pytest.mark.parametrize('cols', [(1,), (1, 2)])
+def test_downsample_keeps_small_budgets(method, cols):
+    rows = [(x, x % 7, -(x % 11)) for x in range(10000)]
+    for threshold in range(1, 6):
+        assert len(downsample(rows, threshold, method, cols)) <= threshold
+
+
+def test_spread_keeps_ends():
+    assert spread(10000, 2) == [0, 9999]
+    assert spread(10000, 1) == [0]
+    assert spread(3, 5) == [0, 1, 2]
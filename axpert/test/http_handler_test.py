@@ -0,0 +1,319 @@
+from gzip import decompress
+from http.client import HTTPConnection
+from json import loads as json_loads
+from queue import Queue, Empty
+from socket import create_connection
+from threading import Event, Thread
+from unittest.mock import Mock
+
+from axpert.http_handler import (
+    BaseGodenergHandler, PooledHTTPServer, EventStream, html_response,
+    create_base_remote_cmd_handler
+)
+
+
+def make_server(started, release, **kwargs):
+
+    class Handler(BaseGodenergHandler):
+        routes = {'/fast': 'fast', '/slow': 'slow', '/broken': 'broken'}
+        slow_routes = {'/slow': 0.2}
+        log = Mock()
+
+        @html_response()
+        def fast(self, req):
+            return b'fast'
+
+        @html_response()
+        def slow(self, req):
+            started.set()
+            release.wait(5)
+            return b'slow'
+
+        @html_response()
+        def broken(self, req):
+            raise ValueError('broken')
+
+        def log_message(self, *args):
+            pass
+
+    server = PooledHTTPServer(('127.0.0.1', 0), Handler, **kwargs)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def get(server, route):
+    conn = HTTPConnection(*server.server_address, timeout=5)
+    conn.request('GET', route)
+    response = conn.getresponse()
+    return response.status, response.read()
+
+
+def background_get(server, route):
+    result = {}
+    thread = Thread(
+        target=lambda: result.update(response=get(server, route))
+    )
+    thread.start()
+    return thread, result
+
+
+def test_slow_routes_do_not_starve_fast_ones():
+    started, release = Event(), Event()
+    server = make_server(
+        started, release, workers=3, slow_workers=1, queue_size=4
+    )
+    try:
+        slow, slow_result = background_get(server, '/slow')
+        started.wait(5)
+        assert get(server, '/fast') == (200, b'fast')
+        # The only slow worker is busy, no waiting for it
+        assert get(server, '/slow')[0] == 503
+        assert get(server, '/fast') == (200, b'fast')
+
+        release.set()
+        slow.join()
+        assert slow_result['response'] == (200, b'slow')
+        assert server.stats['slow_rejected'] == 1
+    finally:
+        release.set()
+        server.shutdown()
+        server.server_close()
+
+
+def test_parked_slow_requests_leave_workers_free():
+    started, release = Event(), Event()
+    server = make_server(
+        started, release, workers=3, slow_workers=1, queue_size=8
+    )
+    try:
+        parked = [background_get(server, '/slow') for _ in range(4)]
+        started.wait(5)
+        assert get(server, '/fast') == (200, b'fast')
+        assert get(server, '/fast') == (200, b'fast')
+
+        release.set()
+        statuses = []
+        for thread, result in parked:
+            thread.join()
+            statuses.append(result['response'][0])
+        assert sorted(statuses) == [200, 503, 503, 503]
+    finally:
+        release.set()
+        server.shutdown()
+        server.server_close()
+
+
+def test_html_errors_are_sent_as_bytes():
+    server = make_server(Event(), Event())
+    try:
+        assert get(server, '/broken') == (500, b'broken')
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_full_queue_is_rejected():
+    started, release = Event(), Event()
+    server = make_server(
+        started, release, workers=1, slow_workers=1, queue_size=1
+    )
+    try:
+        busy, _ = background_get(server, '/slow')
+        started.wait(5)
+        queued, queued_result = background_get(server, '/fast')
+        while not server.requests.qsize():
+            pass
+        assert get(server, '/fast')[0] == 503
+        assert server.stats['rejected'] == 1
+
+        release.set()
+        busy.join()
+        queued.join()
+        assert queued_result['response'] == (200, b'fast')
+    finally:
+        release.set()
+        server.shutdown()
+        server.server_close()
+
+
+class QueueBoard(object):
+    ''' Stand in for BrokerClient.wait over a local queue '''
+
+    def __init__(self):
+        self.values = Queue()
+
+    def wait(self, name, seq=0, timeout=None):
+        try:
+            return seq + 1, self.values.get(timeout=timeout)
+        except Empty:
+            return seq, None
+
+
+def read_event(conn):
+    data = b''
+    while not data.endswith((b'\n\n', b'\r\n\r\n')):
+        data += conn.recv(1)
+    return data
+
+
+def test_stream_pushes_samples_to_every_viewer():
+    board = QueueBoard()
+    events = EventStream(Mock(), board, keepalive=5)
+    handler = create_base_remote_cmd_handler(
+        Mock(), Mock(), {'status': Mock(), 'operation_mode': Mock()}, events
+    )
+    server = PooledHTTPServer(('127.0.0.1', 0), handler, workers=1)
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        viewers = []
+        for query in ('cmd=status', 'cmd=status&cmd=operation_mode'):
+            conn = create_connection(server.server_address, timeout=5)
+            conn.sendall('GET /stream?{} HTTP/1.0\r\n\r\n'.format(query)
+                         .encode())
+            assert b'text/event-stream' in read_event(conn)
+            viewers.append(conn)
+
+        # The single worker was handed back, viewers do not hold it
+        assert get(server, '/stream?cmd=bogus')[0] == 400
+        board.values.put({
+            'status': {'batt_volt': 52.1}, 'operation_mode': {'mode': 'B'}
+        })
+        assert read_event(viewers[0]) == \
+            b'id: 1\nevent: sample\ndata: {"batt_volt": 52.1}\n\n'
+        assert json_loads(read_event(viewers[1]).split(b'data: ')[1]) == {
+            'status': {'batt_volt': 52.1}, 'operation_mode': {'mode': 'B'}
+        }
+        for conn in viewers:
+            conn.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class FixedSnapshot(object):
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.reads = 0
+
+    def fresh(self):
+        self.reads += 1
+        return self.snapshot
+
+
+def test_cmds_are_cached_per_sample():
+    sample = {'status': {'batt_volt': 52.1}, 'operation_mode': {'mode': 'B'}}
+    snapshot = FixedSnapshot((2, 1500000000.0, sample))
+    comms_executor = Mock()
+    handler = create_base_remote_cmd_handler(
+        Mock(), comms_executor, {'status': Mock(), 'operation_mode': Mock()},
+        snapshot=snapshot
+    )
+    server = PooledHTTPServer(('127.0.0.1', 0), handler, workers=1)
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    def request(headers=None):
+        conn = HTTPConnection(*server.server_address, timeout=5)
+        conn.request(
+            'GET', '/cmds?cmd=status&cmd=operation_mode&merge=1',
+            headers=headers or {}
+        )
+        response = conn.getresponse()
+        return response.status, response.getheader('ETag'), response.read()
+
+    try:
+        status, etag, body = request()
+        assert status == 200 and etag
+        assert json_loads(body) == {'batt_volt': 52.1, 'mode': 'B'}
+        assert request({'If-None-Match': etag}) == (304, etag, b'')
+        assert request({
+            'If-Modified-Since': 'Fri, 14 Jul 2017 02:40:00 GMT'
+        })[0] == 304
+
+        snapshot.snapshot = (4, 1500000002.0, sample)
+        status, new_etag, _ = request({'If-None-Match': etag})
+        assert status == 200 and new_etag != etag
+        assert not comms_executor.called
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_partial_snapshot_is_read_once():
+    snapshot = FixedSnapshot((2, 1500000000.0, {'status': {'batt_volt': 1}}))
+    comms_executor = Mock()
+    cmds = {'status': Mock(), 'operation_mode': Mock()}
+    cmds['operation_mode'].json.return_value = {'mode': 'B'}
+    handler = create_base_remote_cmd_handler(
+        Mock(), comms_executor, cmds, snapshot=snapshot
+    )
+    server = PooledHTTPServer(('127.0.0.1', 0), handler, workers=1)
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        status, body = get(server, '/cmds?cmd=status&cmd=operation_mode')
+        assert status == 200
+        assert json_loads(body) == {
+            'status': {'batt_volt': 1}, 'operation_mode': {'mode': 'B'}
+        }
+        assert snapshot.reads == 1
+        comms_executor.assert_called_once_with(cmds['operation_mode'])
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_static_assets_are_cached():
+    handler = create_base_remote_cmd_handler(Mock(), Mock(), {})
+    server = PooledHTTPServer(('127.0.0.1', 0), handler, workers=1)
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    def request(route, headers=None):
+        conn = HTTPConnection(*server.server_address, timeout=5)
+        conn.request('GET', route, headers=headers or {})
+        response = conn.getresponse()
+        return response, response.read()
+
+    try:
+        response, body = request('/viewer', {'Accept-Encoding': 'gzip'})
+        assert response.getheader('Content-Encoding') == 'gzip'
+        assert response.getheader('Cache-Control') == 'no-cache'
+        digest = handler.assets.get('jquery-3.2.1.min.js').digest
+        assert '/jquery?v={}'.format(digest).encode() in decompress(body)
+
+        response, body = request('/jquery?v=' + digest)
+        assert 'immutable' in response.getheader('Cache-Control')
+        assert response.getheader('Content-Encoding') is None
+        response, body = request('/jquery', {
+            'If-None-Match': response.getheader('ETag')
+        })
+        assert response.status == 304 and body == b''
+
+        response, _ = request('/img?src=solar.png')
+        assert response.getheader('Content-type') == 'image/png'
+        assert request('/img?src=../../settings.py')[0].status == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_stream_survives_bad_samples():
+    board = QueueBoard()
+    events = EventStream(Mock(), board, keepalive=5)
+    handler = create_base_remote_cmd_handler(
+        Mock(), Mock(), {'status': Mock()}, events
+    )
+    server = PooledHTTPServer(('127.0.0.1', 0), handler, workers=1)
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        conn = create_connection(server.server_address, timeout=5)
+        conn.sendall(b'GET /stream?cmd=status HTTP/1.0\r\n\r\n')
+        read_event(conn)
+
+        board.values.put(['not', 'a', 'sample'])
+        board.values.put({'status': {'batt_volt': 52.1}})
+        assert read_event(conn).endswith(b'data: {"batt_volt": 52.1}\n\n')
+        assert events.thread.is_alive()
+        conn.close()
+    finally:
+        server.shutdown()
+        server.server_close()
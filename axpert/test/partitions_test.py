@@ -0,0 +1,73 @@
+from datetime import datetime
+from os.path import exists
+from sqlite3 import connect
+
+from axpert.partitions import (
+    Partitions, months_between, month_of, partition_path, MAX_ATTACHED
+)
+
+COLS = [('datetime', 'INTEGER'), ('batt_volt', 'REAL')]
+
+
+def timestamp(*args):
+    return int(datetime(*args).timestamp())
+
+
+def test_months_between():
+    assert months_between(timestamp(2017, 11, 20), timestamp(2018, 2, 1)) \
+        == ['201711', '201712', '201801', '201802']
+    assert month_of(timestamp(2018, 3, 31, 23, 59)) == '201803'
+
+
+def test_partition_path():
+    assert partition_path('/home/pi/godenerg.db', '201801') == \
+        '/home/pi/godenerg-201801.db'
+
+
+def test_partitions_attach_on_demand(tmp_path):
+    db_conn = connect(str(tmp_path / 'godenerg.db'))
+    db_conn.execute('CREATE TABLE stats (datetime INTEGER, batt_volt REAL)')
+    partitions = Partitions(db_conn, COLS, ['batt_volt'])
+
+    months = ['2017{:02d}'.format(month) for month in range(1, 13)]
+    for index, month in enumerate(months):
+        table = partitions.table(month, create=True)
+        db_conn.execute('INSERT INTO {} VALUES (?, ?)'.format(table),
+                        [index, 50.0])
+        db_conn.commit()
+    assert len(partitions.attached) == MAX_ATTACHED
+    assert Partitions(db_conn).months() == months
+    assert partitions.table('201901') is None
+
+    reader = Partitions(connect(str(tmp_path / 'godenerg.db')))
+    tables = reader.tables(timestamp(2017, 3, 15), timestamp(2017, 5, 1))
+    assert [
+        reader.db_conn.execute(
+            'SELECT COUNT(1) FROM {}'.format(table)
+        ).fetchone()[0] for table in tables
+    ] == [0, 1, 1, 1]
+
+
+def test_memory_database_has_no_partitions():
+    partitions = Partitions(connect(':memory:'))
+    assert partitions.months() == []
+    assert list(partitions.tables()) == ['main.stats']
+
+
+def test_partition_attached_elsewhere_is_not_dropped(tmp_path):
+    db_filename = str(tmp_path / 'godenerg.db')
+    db_conn = connect(db_filename)
+    db_conn.execute('PRAGMA journal_mode = WAL')
+    partitions = Partitions(db_conn, COLS)
+    partitions.table('201801', create=True)
+    path = partition_path(db_filename, '201801')
+
+    reader = Partitions(connect(db_filename))
+    assert reader.table('201801') == 'p201801.stats'
+    assert not partitions.drop('201801')
+    assert exists(path) and not partitions.attached
+
+    reader.db_conn.close()
+    assert partitions.drop('201801')
+    assert not exists(path)
+    assert partitions.months() == []
@@ -5,8 +5,9 @@ from json import loads as json_loads
 from axpert.protocol import (
     status_json_formatter, parse_device_status,
     SOLAR_CHARGING, AC_CHARGING, Status,
-    parse_response_status
+    parse_response_status, parse_status, StatusRecord
 )
+from axpert.datalogger import DB
 
 
 def test_status_format():
@@ -44,6 +45,25 @@ def test_status_format():
     assert result['sbu_priority_version'] is False
 
 
+def test_parse_status():
+    test_raw_data = \
+        '(000.0 00.0 230.0 50.0 0184 0071 003 404 50.10 000 ' \
+        '079 0049 0000 000.0 00.00 00001 01010000 00 00 00000 010\x1d\xb9\r'
+
+    record = parse_status(test_raw_data)
+    assert isinstance(record, StatusRecord)
+    assert record.batt_volt == 50.1 and record.temp == 49
+    assert record.raw_status == '01010000' and record.mask_d == '010'
+
+    assert parse_status(test_raw_data[:40]) is None
+    assert parse_status(None) is None
+
+
+def test_status_record_matches_stats_columns():
+    stats_cols = [col for col, _ in DB['stats']]
+    assert all(field in stats_cols for field in StatusRecord._fields)
+
+
 @pytest.mark.parametrize(
     'data, expected', [
         ('00000000',
@@ -0,0 +1,58 @@
+from random import Random
+
+from axpert.rolling import RollingWindow, RollingStats
+
+
+def brute_force(samples, now, seconds):
+    values = [v for t, v in samples if t > now - seconds]
+    return sum(values), len(values), min(values), max(values)
+
+
+def test_window_matches_brute_force():
+    rng = Random(3)
+    window = RollingWindow(60)
+    samples = []
+    for t in range(0, 1000, 2):
+        value = rng.uniform(45, 58)
+        samples.append((t, value))
+        window.add(t, value)
+
+        stats = window.snapshot()
+        total, count, low, high = brute_force(samples, t, 60)
+        assert stats['count'] == count == min(len(samples), 30)
+        assert abs(stats['sum'] - total) < 1e-6
+        assert stats['min'] == low and stats['max'] == high
+
+
+def test_window_slope_and_ewma():
+    window = RollingWindow(300)
+    for t in range(10000, 10600, 2):
+        window.add(t, 50 + 0.01 * t)
+
+    stats = window.snapshot()
+    assert abs(stats['slope'] - 0.01) < 1e-9
+    # A steady ramp leaves the filtered value lagging behind the last one
+    assert stats['min'] < stats['ewma'] < stats['max']
+
+
+def test_window_constant_value():
+    window = RollingWindow(10)
+    window.add(5, 52.0)
+    assert window.snapshot()['slope'] == 0.0
+    window.add(7, 52.0)
+    stats = window.snapshot()
+    assert stats['avg'] == stats['ewma'] == 52.0
+    assert stats['slope'] == 0.0
+
+
+def test_stats_snapshot_per_column_and_window():
+    rolling = RollingStats(['batt_volt', 'pv_watts'], [4, 10])
+    for t in range(0, 20, 2):
+        rolling.add(t, {'batt_volt': float(t), 'pv_watts': None})
+
+    stats = rolling.snapshot()
+    assert stats['datetime'] == 18
+    assert stats['batt_volt'][4]['avg'] == 17.0
+    assert stats['batt_volt'][10]['min'] == 10.0
+    assert stats['pv_watts'][10]['count'] == 0
+    assert stats['pv_watts'][10]['avg'] is None
@@ -0,0 +1,69 @@
+from threading import Thread, Event
+from time import sleep
+from unittest.mock import Mock
+
+from axpert.protocol import CmdSpec, Response, Status
+from axpert.scheduler import (
+    CommandScheduler, LinkBudget, frame_cost,
+    WRITE, CHARGER, DATALOGGER, HTTP
+)
+
+STATUS = CmdSpec(code='QPIGS', size=110, val='', json=None)
+
+
+def test_link_budget():
+    budget = LinkBudget(100)
+    assert budget.wait_time(50) == 0
+    budget.consume(100)
+    assert 0.4 < budget.wait_time(50) <= 0.5
+    # Costs over a second worth of bytes only wait for a full bucket
+    assert budget.wait_time(1000) <= 1
+
+
+def test_frame_cost():
+    assert frame_cost(STATUS) == len(b'QPIGS') + 3 + 110
+
+
+def test_scheduler_serves_by_priority():
+    served, release = [], Event()
+
+    def _run(cmd):
+        if cmd.code == 'BLOCK':
+            release.wait()
+        served.append(cmd.code)
+        return Response(status=Status.OK, data=cmd.code)
+
+    scheduler = CommandScheduler(Mock(), _run, rate=10 ** 6)
+
+    def _submit(code, priority):
+        cmd = CmdSpec(code=code, size=1, val='', json=None)
+        Thread(target=scheduler.submit, args=[cmd, priority]).start()
+        sleep(0.05)
+
+    # Keep the worker busy while the rest of commands queue up
+    _submit('BLOCK', HTTP)
+    for code, priority in (('H', HTTP), ('D', DATALOGGER),
+                           ('C', CHARGER), ('W', WRITE)):
+        _submit(code, priority)
+
+    assert scheduler.stats()['queue_depth'] == 4
+    release.set()
+    sleep(0.1)
+    assert served == ['BLOCK', 'W', 'C', 'D', 'H']
+
+
+def test_scheduler_expires_queued_commands():
+    release = Event()
+
+    def _run(cmd):
+        release.wait()
+        return Response(status=Status.OK, data=None)
+
+    scheduler = CommandScheduler(Mock(), _run, rate=10 ** 6)
+    Thread(target=scheduler.submit, args=[STATUS, HTTP]).start()
+    sleep(0.05)
+
+    Thread(target=lambda: (sleep(0.2), release.set())).start()
+    response = scheduler.submit(STATUS, DATALOGGER, timeout=0.1)
+    assert response.status == Status.KO
+    assert scheduler.stats()['classes']['datalogger']['expired'] == 1
@@ -0,0 +1,66 @@
+import pytest
+
+from os import close
+from threading import Thread
+from unittest.mock import Mock
+
+from axpert.connector_serial import SerialConnector
+from axpert.protocol import (
+    CMD_REL, CmdSpec, Status, execute, parse_inverter_conf
+)
+from axpert.simulator import InverterSimulator, Battery, open_pty
+
+
+@pytest.fixture
+def simulated(request):
+    options = getattr(request, 'param', {})
+    master, slave, slave_path = open_pty()
+    simulator = InverterSimulator(
+        master, baud=10 ** 6, latency=0, seed=1, **options
+    )
+    Thread(target=simulator.serve_forever, daemon=True).start()
+    with SerialConnector(devices=[slave_path], log=Mock()) as connector:
+        yield simulator, connector
+    close(slave)
+
+
+def test_simulated_status(simulated):
+    simulator, connector = simulated
+    cmd = CMD_REL['status']
+    response = execute(Mock(), connector, cmd)
+    assert response.status == Status.NN
+
+    data = cmd.json(response.data, serialize=False)
+    assert 46 < data['batt_volt'] < 60
+    assert data['ac_watt'] == 300
+
+    response = execute(Mock(), connector, CMD_REL['operation_mode'])
+    assert CMD_REL['operation_mode'].json(response.data) == '{"mode": "BT"}'
+
+
+def test_simulated_float_setting(simulated):
+    simulator, connector = simulated
+    pbft = CmdSpec(code='PBFT', size=11, val='53.6', json=None)
+    assert execute(Mock(), connector, pbft).status == Status.OK
+
+    response = execute(Mock(), connector, CMD_REL['settings'])
+    assert parse_inverter_conf(response.data).float_volt == 53.6
+
+
+@pytest.mark.parametrize(
+    'simulated, status', [
+        ({'nak_rate': 1}, Status.KO),
+        ({'drop_rate': 0.5}, Status.BF)
+    ], indirect=['simulated']
+)
+def test_simulated_link_errors(simulated, status):
+    simulator, connector = simulated
+    cmd = CmdSpec(code='QMOD', size=5, val='', json=None)
+    assert execute(Mock(), connector, cmd).status == status
+
+
+def test_battery_tapers_at_target_voltage():
+    battery = Battery(soc=0.95)
+    battery.step(0.01, 60, 56.0)
+    assert battery.volt() < 56.01
+    assert 0 < battery.amps < 60
@@ -0,0 +1,56 @@
+import pytest
+
+from multiprocessing.shared_memory import SharedMemory
+from struct import pack_into
+from uuid import uuid4
+
+from axpert.snapshot import SnapshotWriter, SnapshotReader, SEQ
+
+
+@pytest.fixture
+def name():
+    name = 'godenerg_test_' + uuid4().hex[:8]
+    yield name
+    # Attached with the resource tracker on, unlink is balanced
+    shm = SharedMemory(name)
+    shm.unlink()
+    shm.close()
+
+
+def test_publish_and_read(name):
+    reader = SnapshotReader(name, max_age=5)
+    assert reader.read() is None
+
+    writer = SnapshotWriter(name)
+    sample = {'status': {'batt_volt': 52.1}, 'operation_mode': {'mode': 'B'}}
+    writer.publish(sample, acquired=1000.0)
+    # Attaching again happens at most every few seconds
+    reader.attached = None
+    assert reader.read() == (2, 1000.0, sample)
+    assert reader.fresh() is None
+
+    writer.publish(sample)
+    assert reader.fresh()[::2] == (4, sample)
+    assert reader.stats == dict(hits=1, misses=1)
+
+
+def test_writer_keeps_sequence_across_restarts(name):
+    SnapshotWriter(name).publish({'a': 1})
+    writer = SnapshotWriter(name)
+    writer.publish({'a': 2})
+    assert SnapshotReader(name).read()[:1] == (4,)
+
+
+def test_torn_sample_is_not_read(name):
+    writer = SnapshotWriter(name)
+    writer.publish({'a': 1})
+    reader = SnapshotReader(name)
+    # Writer half way through the next sample
+    pack_into(SEQ, writer.shm.buf, 0, writer.seq + 1)
+    assert reader.read() is None
+
+    pack_into(SEQ, writer.shm.buf, 0, writer.seq)
+    writer.shm.buf[-1:] = b'x'
+    assert reader.read()[2] == {'a': 1}
+    writer.shm.buf[30:31] = b'#'
+    assert reader.read() is None
@@ -0,0 +1,46 @@
+from axpert.spool import Spool, segments, segment_path
+
+
+def test_replay_after_position(tmp_path):
+    spool = Spool(str(tmp_path))
+    assert spool.replay() == []
+    spool.append('stats', [1000, 52.1])
+    position = spool.position
+    spool.append('stats', [1015, 52.2])
+    spool.append('last_stats', [3, 1015, 52.2])
+    spool.close()
+
+    spool = Spool(str(tmp_path))
+    assert spool.replay(position) == [
+        ('stats', [1015, 52.2]), ('last_stats', [3, 1015, 52.2])
+    ]
+    # Appending goes on in a new segment
+    spool.append('stats', [1030, 52.3])
+    assert spool.position[0] == position[0] + 1
+    assert spool.backlog() > 0
+
+
+def test_torn_line_is_not_replayed(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.replay()
+    spool.append('stats', [1000, 52.1])
+    spool.close()
+    with open(segment_path(str(tmp_path), 1), 'ab') as fw:
+        fw.write(b'["stats", [10')
+
+    assert Spool(str(tmp_path)).replay() == [('stats', [1000, 52.1])]
+
+
+def test_drain_removes_old_segments(tmp_path):
+    spool = Spool(str(tmp_path), segment_bytes=64)
+    spool.replay()
+    for second in range(10):
+        spool.append('stats', [second, 52.1])
+    spool.drain(spool.position)
+    # Full and drained, the next rows go to a fresh segment
+    assert spool.position == (2, 0)
+    assert spool.backlog() == 0
+
+    spool.append('stats', [10, 52.1])
+    spool.drain(spool.position)
+    assert segments(str(tmp_path)) == [2]
@@ -0,0 +1,51 @@
+from unittest.mock import Mock, patch
+
+from axpert.protocol import CmdSpec, execute
+from axpert.telemetry import Telemetry, Histogram, prometheus_text
+from axpert.test.axpert_test import MockConnector
+
+
+def test_histogram_buckets():
+    histogram = Histogram()
+    for value in (0.001, 0.3, 0.3, 20):
+        histogram.observe(value)
+
+    snapshot = histogram.snapshot()
+    buckets = dict((str(bound), count) for bound, count in snapshot['buckets'])
+    assert buckets['0.005'] == 1 and buckets['0.5'] == 3
+    assert buckets['10'] == 3 and buckets['+Inf'] == 4
+    assert snapshot['count'] == 4
+
+
+def test_prometheus_text():
+    telemetry = Telemetry()
+    telemetry.incr('naks', 'PBFT')
+    telemetry.observe('read', 'QPIGS', 0.4)
+
+    text = prometheus_text(telemetry.snapshot(), {'queue_depth': 2})
+    assert 'godenerg_naks_total{cmd="PBFT"} 1' in text
+    assert 'godenerg_command_seconds_bucket{cmd="QPIGS",phase="read",' \
+        'le="0.5"} 1' in text
+    assert 'godenerg_command_seconds_count{cmd="QPIGS",phase="read"} 1' \
+        in text
+    assert 'godenerg_queue_depth 2' in text
+
+
+def test_execute_records_telemetry():
+    class EmptyConnector(MockConnector):
+        def read(self, size):
+            return b''
+
+    telemetry = Telemetry()
+    cmd = CmdSpec(code='QMOD', size=5, val='', json=None)
+    with patch('axpert.protocol.telemetry', telemetry):
+        execute(Mock(), EmptyConnector(), cmd)
+        # Mock connector answers have no terminator, as a timed out read
+        execute(Mock(), MockConnector(), cmd)
+
+    snapshot = telemetry.snapshot()
+    assert snapshot['counters']['empty_reads'] == {'QMOD': 1}
+    assert snapshot['counters']['timeouts'] == {'QMOD': 1}
+    assert snapshot['counters']['exchanges'] == {'QMOD': 2}
+    for phase in ('write', 'read', 'parse'):
+        assert snapshot['histograms'][phase]['QMOD']['count'] == 2